@@ -18,15 +18,20 @@
 
 /*
  * This is a very simple conservative GC implementation for single-threaded
- * x86_64/AMD64.
+ * x86_64/AMD64.  Only the mark phase can optionally use multiple threads.
  */
 
+#define _GNU_SOURCE                             // pthread_getattr_np()
 #include <assert.h>
+#include <pthread.h>
+#include <sched.h>
+#include <semaphore.h>
 #include <stdbool.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <time.h>
 #include <unistd.h>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -46,6 +51,25 @@
 #define GC_MAX_ROOT_SIZE        0x40000000      // 1 GB
 #define GC_MAX_MARK_PUSH        1024
 #define GC_PAGESIZE             4096
+#define GC_MAX_MARK_THREADS     64
+#define GC_MARK_CHUNK           4096            // Words scanned per work item.
+#define GC_MARK_BUFFER_LEN      256
+#define GC_GEN_MAJOR_INTERVAL   8               // Minor GCs per major GC.
+#define GC_CACHE_BYTES          4096            // Thread cache refill size.
+#define GC_RECENT_LEN           8               // Recent allocations kept.
+#if GC_HEAP == 0
+#define GC_SIG_SUSPEND          SIGPWR          // Stop a thread.
+#define GC_SIG_RESUME           SIGXCPU         // Restart a thread.
+#else       /* GC_HEAP */
+// Each heap needs its own signals.
+#define GC_SIG_SUSPEND          (SIGRTMIN + 2*GC_HEAP - 2)
+#define GC_SIG_RESUME           (SIGRTMIN + 2*GC_HEAP - 1)
+#endif      /* GC_HEAP */
+#define GC_MAX_LAYOUTS          4096            // Registered object layouts.
+#define GC_MAX_LAYOUT_RUNS      64              // Pointer runs per layout.
+#define GC_MAX_HUGE_RANGES      65536           // Layout ranges per object.
+#define GC_HUGE_MEMORY          (GC_MEMORY + GC_HUGE_IDX_OFFSET*GC_REGION_SIZE)
+#define GC_HUGE_END             (GC_MEMORY + GC_NUM_REGIONS*GC_REGION_SIZE)
 
 /*
  * A GC free-list node.
@@ -68,6 +92,48 @@ struct gc_markstack_s
 typedef struct gc_markstack_s *gc_markstack_t;
 typedef uint64_t gc_markunit_t;
 
+/*
+ * Object layout: the runs of consecutive pointer fields of a type.
+ */
+struct gc_layoutrun_s
+{
+    uint32_t offset;                            // Run offset (bytes).
+    uint32_t length;                            // Run length (words).
+};
+struct gc_layout_s
+{
+    size_t size;                                // Type size.
+    size_t numruns;                             // Number of runs.
+    struct gc_layoutrun_s runs[];               // Pointer runs.
+};
+typedef struct gc_layout_s *gc_layout_t;
+
+/*
+ * Huge object (or free extent of the huge memory).
+ */
+struct gc_huge_s
+{
+    void *ptr;                                  // Start pointer.
+    size_t size;                                // Size (whole pages).
+    struct gc_huge_s *prev;                     // Previous extent.
+    struct gc_huge_s *next;                     // Next extent.
+    bool free;                                  // Free extent?
+    bool marked;                                // Mark bit.
+    bool noscan;                                // Atomic object?
+    bool wprotected;                            // Write-protected?
+    uint16_t layout;                            // Layout id.
+};
+typedef struct gc_huge_s *gc_huge_t;
+
+/*
+ * Huge memory map entry (one per GC_HUGE_UNIT chunk).
+ */
+struct gc_hugemap_s
+{
+    gc_huge_t start;                            // Object starting in chunk.
+    gc_huge_t cover;                            // Object over chunk start.
+};
+
 /*
  * Root node.
  */
@@ -82,6 +148,50 @@ struct gc_root_s
 };
 typedef struct gc_root_s *gc_root_t;
 
+/*
+ * Parallel marking worker.
+ *
+ * Each worker owns a mark stack.  The owner pushes and pops at the 'top',
+ * other workers steal from the 'bottom'.  Both ends are protected by 'lock'.
+ */
+struct gc_markworker_s
+{
+    pthread_spinlock_t lock;                    // Mark stack lock.
+    gc_markstack_t stack;                       // Mark stack memory.
+    size_t bottom;                              // Steal end.
+    size_t top;                                 // Owner end.
+    size_t used;                                // Bytes marked.
+    unsigned long epoch;                        // Last mark epoch seen.
+    pthread_t thread;                           // Worker thread.
+};
+typedef struct gc_markworker_s *gc_markworker_t;
+
+/*
+ * Registered thread (multi-threaded allocation).
+ *
+ * Each thread caches free small objects of each region.  A collection reuses
+ * the memory of the cached objects, so the caches are only valid during the
+ * collection cycle 'epoch'.
+ *
+ * The last GC_RECENT_LEN objects allocated by each thread are kept alive:
+ * the caller may hold them where the GC cannot see them (e.g. in a Python
+ * object) until it stores them somewhere reachable, while another thread
+ * collects.
+ */
+struct gc_thread_s
+{
+    pthread_t thread;                           // The thread.
+    void *stackbottom;                          // Stack bottom.
+    struct gc_root_s root;                      // Stack (while stopped).
+    struct gc_root_s recentroot;                // Recent allocations.
+    void *recent[GC_RECENT_LEN];                // Recent allocations.
+    size_t recentidx;                           // Next recent slot.
+    long epoch;                                 // Cache collection cycle.
+    gc_freelist_t cache[GC_BIG_IDX_OFFSET];     // Small object caches.
+    struct gc_thread_s *next;                   // Next thread.
+};
+typedef struct gc_thread_s *gc_thread_t;
+
 /*
  * GC globals.
  */
@@ -89,6 +199,9 @@ typedef struct gc_root_s *gc_root_t;
 // General:
 static bool gc_inited = false;                  // Is GC initialised?
 static bool gc_enabled = true;                  // Is collection enabled?
+static bool gc_opened = false;                  // Is the memory mapped?
+static int gc_hugepages = GC_HUGEPAGES_NONE;    // Huge page mode.
+static size_t gc_granule = GC_PAGESIZE;         // Protect/release unit.
 static void *gc_stackbottom;                    // Stack bottom.
 struct gc_region_s __gc_regions[GC_NUM_REGIONS] = {{0}};
 static void *gc_markstack;                      // Mark-stack.
@@ -101,6 +214,53 @@ static ssize_t gc_alloc_size = 0;               // Total allocation (since GC).
 static ssize_t gc_trigger_size = GC_MIN_TRIGGER;// GC trigger size.
 static ssize_t gc_used_size  = 0;               // Total used memory.
 static long gc_collections = 0;                 // Number of GC collections done so far
+static struct gc_stats_s gc_stats;              // See GC_get_stats().
+
+// Lazy sweeping:
+static bool gc_lazy_sweep = false;              // Is lazy sweeping enabled?
+static size_t gc_unswept = 0;                   // Number of unswept regions.
+static size_t gc_sweep_cursor = 0;              // Next region to sweep.
+
+// Parallel marking:
+static size_t gc_mark_threads = 1;              // Number of marking threads.
+static size_t gc_mark_pool_size = 0;            // Number of started workers.
+static struct gc_markworker_s gc_mark_workers[GC_MAX_MARK_THREADS];
+static pthread_mutex_t gc_mark_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t gc_mark_start_cond = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t gc_mark_done_cond = PTHREAD_COND_INITIALIZER;
+static unsigned long gc_mark_epoch = 0;         // Incremented for each mark.
+static size_t gc_mark_running = 0;              // Busy helper threads.
+static size_t gc_mark_idle = 0;                 // Workers without work.
+static bool gc_mark_shutdown = false;           // Stop the helper threads.
+static bool gc_mark_atfork = false;             // atfork handler installed?
+
+// Generational collection:
+static bool gc_generational = false;            // Is generational GC enabled?
+static bool gc_gen_valid = false;               // Can the next GC be minor?
+static size_t gc_gen_minors = 0;                // Minor GCs since last major.
+static gc_root_t gc_gen_roots = NULL;           // Dirty page roots memory.
+
+// Multi-threaded allocation:
+static bool gc_threaded = false;                // Are threads enabled?
+static pthread_mutex_t gc_alloc_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_key_t gc_thread_key;             // Thread exit destructor.
+static gc_thread_t gc_threads = NULL;           // Registered threads.
+static __thread gc_thread_t gc_self = NULL;     // Current thread.
+static sem_t gc_suspend_ack;                    // A thread has stopped.
+static unsigned long gc_world_epoch = 0;        // Incremented on restart.
+static size_t gc_stack_size = 0;                // Stack bytes last scanned.
+
+// Object layouts:
+static gc_layout_t gc_layouts[GC_MAX_LAYOUTS];  // Registered layouts.
+static size_t gc_num_layouts = 1;               // Layout 0 is conservative.
+static pthread_mutex_t gc_layout_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+// Huge objects:
+static gc_huge_t gc_huge_first = NULL;          // First extent.
+static gc_huge_t gc_huge_last = NULL;           // Last extent.
+static void *gc_huge_top = GC_HUGE_MEMORY;      // End of the last extent.
+static struct gc_hugemap_s *gc_huge_map = NULL; // Chunk map.
+static uint8_t *gc_huge_cards = NULL;           // Dirty page bits.
 
 /*
  * GC debugging.
@@ -136,10 +296,28 @@ extern size_t GC_get_memsize(void)
  */
 static void __attribute__((noinline)) *gc_stacktop(void);
 static void gc_add_root(gc_root_t root);
-static void gc_mark_init(void);
+static void gc_collect_gen(bool major);
+static void gc_free_object(void *ptr);
+static size_t gc_sweep_pending_regions(size_t max);
+static void *gc_thread_malloc(size_t idx);
+static void gc_thread_free(void *ptr);
+static gc_thread_t gc_thread_self(void);
+static void gc_stop_world(void);
+static void gc_start_world(void);
+static gc_root_t gc_thread_roots(gc_root_t roots);
+static double gc_time(void);
+static void gc_mark_init(bool clear);
 static void gc_mark(gc_root_t roots);
+static void gc_mark_parallel(gc_root_t roots);
 static void gc_sweep(void);
+static void gc_sweep_region(gc_region_t region, bool returning);
 static inline bool gc_is_marked_index(uint8_t *markptr_0, uint32_t idx);
+static bool gc_gen_scan_cards(gc_root_t *rootsptr);
+static void gc_gen_protect(void);
+static void *gc_huge_malloc(size_t size, bool noscan, uint16_t layout);
+static void *gc_huge_realloc(void *ptr, size_t size);
+static gc_huge_t gc_huge_lookup(void *ptr);
+static gc_huge_t gc_huge_free(gc_huge_t obj);
 
 #define gc_read_prefetch(ptr)   __builtin_prefetch((ptr), 0, 1)
 #define gc_write_prefetch(ptr)  __builtin_prefetch((ptr), 1)
@@ -253,6 +431,10 @@ static void *gc_get_memory(const char* path, bool init)
 #     else       /* __APPLE__ */
         flags = MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE | MAP_FIXED;
 #     endif      /* __APPLE__ */
+#     ifdef MAP_HUGETLB
+        if (gc_hugepages == GC_HUGEPAGES_HUGETLB)
+            flags |= MAP_HUGETLB;
+#     endif      /* MAP_HUGETLB */
         fd = -1;
     }
     else {
@@ -260,7 +442,11 @@ static void *gc_get_memory(const char* path, bool init)
         int shm_flags = O_RDWR;
         if (init)
             shm_flags |= O_CREAT;
-        fd = shm_open(path, shm_flags, 0660);
+        // hugetlbfs files are always backed by huge pages
+        if (gc_hugepages == GC_HUGEPAGES_HUGETLB)
+            fd = open(path, shm_flags, 0660);
+        else
+            fd = shm_open(path, shm_flags, 0660);
         if (fd == -1) {
             gc_debug("Cannot open %s: %s", path, strerror(errno));
             return NULL;
@@ -284,6 +470,16 @@ static void *gc_get_memory(const char* path, bool init)
     if (ptr == MAP_FAILED)
         return NULL;
 
+#ifdef MADV_HUGEPAGE
+    if (gc_hugepages == GC_HUGEPAGES_THP &&
+            madvise(ptr, memsize, MADV_HUGEPAGE) != 0)
+    {
+        gc_debug("Cannot use transparent huge pages: %s", strerror(errno));
+        gc_hugepages = GC_HUGEPAGES_NONE;
+        gc_granule = GC_PAGESIZE;
+    }
+#endif      /* MADV_HUGEPAGE */
+
     if (!init)
         install_sigsegv_handler();
 
@@ -314,6 +510,10 @@ static void gc_free_memory(void *ptr, size_t size)
 }
 static int gc_protect_memory(void *ptr, size_t size)
 {
+    // hugetlbfs pages can only be protected as a whole, but there is no need
+    // to: the memory is mapped read/write, and it is never write-protected.
+    if (gc_hugepages == GC_HUGEPAGES_HUGETLB)
+        return 0;
     return mprotect(ptr, size, PROT_READ | PROT_WRITE);
 }
 static void *gc_get_stackbottom(void)
@@ -342,8 +542,9 @@ static void *gc_get_stackbottom(void)
  */
 static void __attribute__((noinline)) *gc_stacktop(void)
 {
-    void *dummy;
-    return (void *)&dummy;
+    // Note: returning the address of a local variable is folded to NULL by
+    //       recent versions of gcc, so use the frame address instead.
+    return __builtin_frame_address(0);
 }
 
 /*
@@ -369,7 +570,197 @@ static double gc_reciprocal(uint32_t size)
 extern bool GC_open(const char* path)
 {
     void *gc_memory = gc_get_memory(path, false);
-    return gc_memory == GC_MEMORY;
+    gc_opened = (gc_memory == GC_MEMORY);
+    return gc_opened;
+}
+
+/*
+ * GC huge pages.
+ */
+extern bool GC_set_hugepages(int mode)
+{
+    if (gc_inited || gc_opened)
+        return (mode == gc_hugepages);
+    switch (mode)
+    {
+        case GC_HUGEPAGES_NONE:
+            break;
+#ifdef MADV_HUGEPAGE
+        case GC_HUGEPAGES_THP:
+            break;
+#endif      /* MADV_HUGEPAGE */
+#if defined(MAP_HUGETLB) && !defined(__MINGW32__)
+        case GC_HUGEPAGES_HUGETLB:
+            if (gc_generational)
+                return false;
+            break;
+#endif      /* MAP_HUGETLB */
+        default:
+            return false;
+    }
+    gc_hugepages = mode;
+    gc_granule = (mode == GC_HUGEPAGES_NONE? GC_PAGESIZE: GC_HUGEPAGE_SIZE);
+    return true;
+}
+
+extern int GC_get_hugepages(void)
+{
+    return gc_hugepages;
+}
+
+/*
+ * GC extents.
+ */
+extern size_t GC_get_extents(struct gc_extent_s *extents, size_t n)
+{
+    if (gc_threaded)
+        pthread_mutex_lock(&gc_alloc_mutex);
+    size_t count = 0;
+    for (size_t i = 0; i < GC_HUGE_IDX_OFFSET; i++)
+    {
+        gc_region_t region = __gc_regions + i;
+        if (region->freeptr == region->startptr)
+            continue;
+        if (count < n)
+        {
+            extents[count].start = region->startptr;
+            extents[count].size = region->freeptr - region->startptr;
+        }
+        count++;
+    }
+    for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+    {
+        if (ext->free)
+            continue;
+        if (count < n)
+        {
+            extents[count].start = ext->ptr;
+            extents[count].size = ext->size;
+        }
+        count++;
+    }
+    if (gc_threaded)
+        pthread_mutex_unlock(&gc_alloc_mutex);
+    return count;
+}
+
+/*
+ * GC prefetch.
+ *
+ * The process which calls it may not own the GC memory, so the objects are
+ * found with the extents only: small objects by the size of their region,
+ * huge objects are whole extents.
+ */
+static void *gc_prefetch_object(void *ptr, const struct gc_extent_s *extents,
+    size_t nextents, size_t *sizeptr)
+{
+    if ((char *)ptr < GC_MEMORY || (char *)ptr >= GC_HUGE_END)
+        return NULL;
+    size_t lo = 0, hi = nextents;
+    while (lo < hi)
+    {
+        size_t mid = (lo + hi) / 2;
+        if (extents[mid].start <= ptr)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    if (lo == 0)
+        return NULL;
+    const struct gc_extent_s *ext = extents + lo - 1;
+    if ((char *)ptr >= (char *)ext->start + ext->size)
+        return NULL;
+    size_t idx = gc_index(ptr);
+    if (idx >= GC_HUGE_IDX_OFFSET)
+    {
+        *sizeptr = ext->size;
+        return ext->start;
+    }
+    size_t unit = gc_index_unit(idx);
+    size_t size = (idx - gc_unit_offset(unit))*unit + unit;
+    void *startptr = gc_index_region(idx);
+    *sizeptr = size;
+    return startptr + ((ptr - startptr) / size)*size;
+}
+
+extern size_t GC_prefetch(void **roots, size_t nroots,
+    const struct gc_extent_s *extents, size_t nextents)
+{
+    size_t setsize = 1024, setused = 0;
+    void **set = (void **)calloc(setsize, sizeof(void *));
+    size_t stacksize = 1024, stackused = 0;
+    void **stack = (void **)malloc(stacksize*sizeof(void *));
+    size_t total = 0;
+    if (set == NULL || stack == NULL)
+        goto prefetch_exit;
+
+    for (size_t i = 0; i < nroots || stackused != 0; )
+    {
+        void *ptr;
+        if (stackused != 0)
+            ptr = stack[--stackused];
+        else
+            ptr = roots[i++];
+        size_t size;
+        void *obj = gc_prefetch_object(ptr, extents, nextents, &size);
+        if (obj == NULL)
+            continue;
+
+        // Visit each object once: the set of the visited objects is an open
+        // addressing hash table, which is never more than half full.
+        size_t h = ((uintptr_t)obj >> 4) & (setsize - 1);
+        while (set[h] != NULL && set[h] != obj)
+            h = (h + 1) & (setsize - 1);
+        if (set[h] == obj)
+            continue;
+        set[h] = obj;
+        if (++setused*2 > setsize)
+        {
+            size_t newsize = setsize*2;
+            void **newset = (void **)calloc(newsize, sizeof(void *));
+            if (newset == NULL)
+                goto prefetch_exit;
+            for (size_t j = 0; j < setsize; j++)
+            {
+                if (set[j] == NULL)
+                    continue;
+                size_t k = ((uintptr_t)set[j] >> 4) & (newsize - 1);
+                while (newset[k] != NULL)
+                    k = (k + 1) & (newsize - 1);
+                newset[k] = set[j];
+            }
+            free(set);
+            set = newset;
+            setsize = newsize;
+        }
+
+        // Huge objects are read sequentially: ask the kernel to read ahead.
+        if (size > GC_PAGESIZE)
+            madvise(obj, size, MADV_WILLNEED);
+        total += size;
+        void **words = (void **)obj;
+        for (size_t j = 0; j < size / sizeof(void *); j++)
+        {
+            void *p = words[j];
+            if ((char *)p < GC_MEMORY || (char *)p >= GC_HUGE_END)
+                continue;
+            if (stackused == stacksize)
+            {
+                void **newstack = (void **)realloc(stack,
+                    2*stacksize*sizeof(void *));
+                if (newstack == NULL)
+                    goto prefetch_exit;
+                stack = newstack;
+                stacksize *= 2;
+            }
+            stack[stackused++] = p;
+        }
+    }
+
+prefetch_exit:
+    free(set);
+    free(stack);
+    return total;
 }
 
 extern bool GC_init(const char* path)
@@ -412,6 +803,11 @@ extern bool GC_init(const char* path)
         region->markstartptr = startptr;
         region->markendptr   = startptr;
         region->markptr      = NULL;
+        region->noscanptr    = NULL;
+        region->layoutptr    = NULL;
+        region->swept        = true;
+        region->cardptr      = NULL;
+        region->wprotectptr  = startptr;
     }
 
     // Reserve virtual space for the mark stack.
@@ -484,6 +880,32 @@ extern bool GC_dynamic_root(void **ptrptr, size_t *sizeptr, size_t elemsize)
     return true;
 }
 
+/*
+ * GC dynamic root removal.
+ */
+extern bool GC_remove_dynamic_root(void **ptrptr)
+{
+    // Collections scan the roots with the allocation lock held.
+    if (gc_threaded)
+        pthread_mutex_lock(&gc_alloc_mutex);
+    gc_root_t root = NULL;
+    for (gc_root_t *link = &gc_roots; *link != NULL; link = &(*link)->next)
+    {
+        if ((*link)->ptrptr == ptrptr)
+        {
+            root = *link;
+            *link = root->next;
+            break;
+        }
+    }
+    if (gc_threaded)
+        pthread_mutex_unlock(&gc_alloc_mutex);
+    if (root == NULL)
+        return false;
+    free(root);
+    return true;
+}
+
 /*
  * Add a root to the global list.
  */
@@ -523,17 +945,16 @@ extern void GC_handle_error(bool fatal, int err)
 /*
  * GC should collect?
  */
-static inline void gc_maybe_collect(uint32_t size)
+static inline void gc_maybe_collect(size_t size)
 {
     gc_alloc_size += size;
     if (gc_alloc_size >= gc_trigger_size)
     {
         if (!gc_enabled)
             return;
-        gc_collect();
+        gc_collect_gen(gc_gen_minors >= GC_GEN_MAJOR_INTERVAL);
         size_t gc_scan_size = 0;
-        size_t stacksize = gc_stackbottom - gc_stacktop();
-        gc_scan_size += 2*stacksize;
+        gc_scan_size += 2*gc_stack_size;
         gc_root_t root = gc_roots;
         while (root != NULL)
         {
@@ -564,14 +985,10 @@ extern void GC_free_noinline(void *ptr) {
 /*
  * GC memory allocation.
  */
-extern void *GC_malloc_index(size_t idx)
+static inline void *gc_alloc_object(gc_region_t region)
 {
-    gc_region_t region = __gc_regions + idx;
     void *ptr;
 
-    // (0) Check if we need to collect.
-    gc_maybe_collect(region->size);
-    
     // (1) First, attempt to allocate from the freelist.
     gc_freelist_t freelist = region->freelist, next;
     if (freelist != NULL)
@@ -623,6 +1040,8 @@ nonempty_freelist:
         size_t protectlen = GC_PROTECT_LEN*GC_PAGESIZE;
         protectlen = (protectlen < region->size? region->size:
             protectlen);
+        // Whole huge pages, so that protectptr stays aligned.
+        protectlen = (protectlen + gc_granule - 1) / gc_granule * gc_granule;
         if (gc_protect_memory(protectptr, protectlen) != 0)
         {
             gc_debug("protect failed");
@@ -635,6 +1054,233 @@ nonempty_freelist:
     return ptr;
 }
 
+static inline void *gc_malloc_object(size_t idx)
+{
+    if (gc_threaded)
+        return gc_thread_malloc(idx);
+
+    gc_region_t region = __gc_regions + idx;
+
+    // (0) Check if we need to collect.
+    gc_maybe_collect(region->size);
+    if (!region->swept)
+        gc_sweep_region(region, false);
+    return gc_alloc_object(region);
+}
+
+/*
+ * Atomic (no-scan) objects.
+ *
+ * Each region which ever contained an atomic object has a bitmap, indexed
+ * like the mark bits, telling which objects must not be scanned.  The bit is
+ * set by GC_malloc_atomic() and cleared when the memory is reused by
+ * GC_malloc().
+ */
+static uint8_t *gc_get_noscan_bits(gc_region_t region)
+{
+    uint8_t *noscanptr = __atomic_load_n(&region->noscanptr, __ATOMIC_ACQUIRE);
+    if (noscanptr != NULL)
+        return noscanptr;
+    size_t size = GC_REGION_SIZE / (region->size*8) + GC_PAGESIZE;
+    noscanptr = (uint8_t *)gc_get_mark_memory(size);
+    if (noscanptr == NULL)
+        gc_handle_error(true, 0);
+    uint8_t *expected = NULL;
+    if (!__atomic_compare_exchange_n(&region->noscanptr, &expected,
+            noscanptr, false, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE))
+    {
+        // Another thread allocated the bitmap first.
+        gc_free_memory(noscanptr, size);
+        noscanptr = expected;
+    }
+    return noscanptr;
+}
+
+static inline void gc_set_noscan(gc_region_t region, void *ptr, bool noscan)
+{
+    gc_markunit_t *noscanptr = (gc_markunit_t *)region->noscanptr;
+    uint32_t idx = gc_objidx(ptr);
+    uint32_t unitidx = (idx / (sizeof(gc_markunit_t)*8));
+    uint32_t bitidx  = (idx % (sizeof(gc_markunit_t)*8));
+    gc_markunit_t markmask = (gc_markunit_t)0x01 << bitidx;
+    bool isset = ((noscanptr[unitidx] & markmask) != 0);
+    if (noscan && !isset)
+        __atomic_fetch_or(noscanptr + unitidx, markmask, __ATOMIC_RELAXED);
+    else if (!noscan && isset)
+        __atomic_fetch_and(noscanptr + unitidx, ~markmask, __ATOMIC_RELAXED);
+}
+
+static inline bool gc_is_noscan(gc_region_t region, uint32_t ptridx)
+{
+    return (region->noscanptr != NULL &&
+        gc_is_marked_index(region->noscanptr, ptridx));
+}
+
+/*
+ * Object layouts.
+ *
+ * Each region which ever contained an object with a (non-conservative)
+ * layout has a side table, indexed like the mark bits, holding the layout id
+ * of each object.  The id is set by GC_malloc_layout() and reset to 0 when
+ * the memory is reused by GC_malloc() or GC_malloc_atomic().
+ */
+static uint16_t *gc_get_layout_ids(gc_region_t region)
+{
+    uint16_t *layoutptr = __atomic_load_n(&region->layoutptr,
+        __ATOMIC_ACQUIRE);
+    if (layoutptr != NULL)
+        return layoutptr;
+    size_t size = (GC_REGION_SIZE / region->size)*sizeof(uint16_t) +
+        GC_PAGESIZE;
+    layoutptr = (uint16_t *)gc_get_mark_memory(size);
+    if (layoutptr == NULL)
+        gc_handle_error(true, 0);
+    uint16_t *expected = NULL;
+    if (!__atomic_compare_exchange_n(&region->layoutptr, &expected,
+            layoutptr, false, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE))
+    {
+        // Another thread allocated the table first.
+        gc_free_memory(layoutptr, size);
+        layoutptr = expected;
+    }
+    return layoutptr;
+}
+
+static inline gc_layout_t gc_get_layout(gc_region_t region, uint32_t ptridx)
+{
+    if (region->layoutptr == NULL)
+        return NULL;
+    return gc_layouts[region->layoutptr[ptridx]];
+}
+
+static int gc_offset_compare(const void *a, const void *b)
+{
+    size_t x = *(const size_t *)a, y = *(const size_t *)b;
+    return (x < y? -1: x > y);
+}
+
+extern uint16_t GC_register_layout(size_t size, const size_t *offsets,
+    size_t n)
+{
+    if (size == 0 || size % sizeof(void *) != 0 || n == 0)
+        return 0;
+    size_t *sorted = (size_t *)malloc(n*sizeof(size_t));
+    if (sorted == NULL)
+        return 0;
+    memcpy(sorted, offsets, n*sizeof(size_t));
+    qsort(sorted, n, sizeof(size_t), gc_offset_compare);
+
+    // Merge the pointer fields into runs:
+    struct gc_layoutrun_s runs[GC_MAX_LAYOUT_RUNS];
+    size_t numruns = 0;
+    for (size_t i = 0; i < n; i++)
+    {
+        size_t offset = sorted[i];
+        if (offset % sizeof(void *) != 0 || offset + sizeof(void *) > size)
+        {
+            free(sorted);
+            return 0;
+        }
+        if (i > 0 && offset == sorted[i-1])
+            continue;
+        struct gc_layoutrun_s *last = runs + numruns - 1;
+        if (numruns > 0 &&
+                last->offset + last->length*sizeof(void *) == offset)
+        {
+            last->length++;
+            continue;
+        }
+        if (numruns == GC_MAX_LAYOUT_RUNS)
+        {
+            // Too fragmented; scanning conservatively is as good.
+            free(sorted);
+            return 0;
+        }
+        runs[numruns].offset = offset;
+        runs[numruns].length = 1;
+        numruns++;
+    }
+    free(sorted);
+
+    pthread_mutex_lock(&gc_layout_mutex);
+    uint16_t id = 0;
+    for (size_t i = 1; i < gc_num_layouts; i++)
+    {
+        gc_layout_t layout = gc_layouts[i];
+        if (layout->size == size && layout->numruns == numruns &&
+                memcmp(layout->runs, runs, numruns*sizeof(runs[0])) == 0)
+        {
+            id = i;
+            break;
+        }
+    }
+    if (id == 0 && gc_num_layouts < GC_MAX_LAYOUTS)
+    {
+        gc_layout_t layout = (gc_layout_t)malloc(sizeof(struct gc_layout_s) +
+            numruns*sizeof(runs[0]));
+        if (layout != NULL)
+        {
+            layout->size = size;
+            layout->numruns = numruns;
+            memcpy(layout->runs, runs, numruns*sizeof(runs[0]));
+            id = gc_num_layouts;
+            __atomic_store_n(gc_layouts + id, layout, __ATOMIC_RELEASE);
+            gc_num_layouts++;
+        }
+    }
+    pthread_mutex_unlock(&gc_layout_mutex);
+    return id;
+}
+
+static inline void gc_set_layout(gc_region_t region, void *ptr, uint16_t id)
+{
+    if (id != 0)
+        gc_get_layout_ids(region);
+    else if (region->layoutptr == NULL)
+        return;
+    region->layoutptr[gc_objidx(ptr)] = id;
+}
+
+extern void *GC_malloc_index(size_t idx)
+{
+    if (idx >= GC_HUGE_IDX_OFFSET)
+        return gc_huge_malloc(gc_index_size(idx), false, 0);
+    void *ptr = gc_malloc_object(idx);
+    gc_region_t region = __gc_regions + idx;
+    if (ptr != NULL)
+    {
+        if (region->noscanptr != NULL)
+            gc_set_noscan(region, ptr, false);
+        gc_set_layout(region, ptr, 0);
+    }
+    return ptr;
+}
+
+extern void *GC_malloc_atomic_index(size_t idx)
+{
+    if (idx >= GC_HUGE_IDX_OFFSET)
+        return gc_huge_malloc(gc_index_size(idx), true, 0);
+    void *ptr = gc_malloc_object(idx);
+    gc_region_t region = __gc_regions + idx;
+    if (ptr != NULL)
+    {
+        gc_get_noscan_bits(region);
+        gc_set_noscan(region, ptr, true);
+        gc_set_layout(region, ptr, 0);
+    }
+    return ptr;
+}
+
+extern void *GC_malloc_layout(size_t size, uint16_t layout)
+{
+    if (size > GC_HUGE_UNIT)
+        return gc_huge_malloc(size, false, layout);
+    void *ptr = gc_malloc(size);
+    if (ptr != NULL && layout != 0)
+        gc_set_layout(__gc_regions + gc_index(ptr), ptr, layout);
+    return ptr;
+}
+
 /*
  * GC memory reallocation.
  */
@@ -643,15 +1289,35 @@ extern void *GC_realloc(void *ptr, size_t size)
     // As per realloc(), if ptr == NULL then gc_realloc() becomes gc_malloc().
     if (ptr == NULL)
         return gc_malloc(size);
-    size_t idx_size = gc_size_index(size);
     size_t idx_ptr = gc_index(ptr);
+    if (idx_ptr >= GC_HUGE_IDX_OFFSET && size > GC_HUGE_UNIT)
+        return gc_huge_realloc(ptr, size);
+    size_t idx_size = gc_size_index(size);
     if (idx_size == idx_ptr)
         return ptr;
-    void *newptr = gc_malloc(size);
+    bool noscan;
+    uint16_t layout;
+    size_t oldsize;
+    if (idx_ptr >= GC_HUGE_IDX_OFFSET)
+    {
+        gc_huge_t obj = gc_huge_lookup(ptr);
+        noscan = obj->noscan;
+        layout = obj->layout;
+        oldsize = obj->size;
+    }
+    else
+    {
+        gc_region_t region = __gc_regions + idx_ptr;
+        uint32_t ptridx = gc_objidx(ptr);
+        noscan = gc_is_noscan(region, ptridx);
+        layout = (region->layoutptr == NULL? 0: region->layoutptr[ptridx]);
+        oldsize = region->size;
+    }
+    void *newptr = (noscan? gc_malloc_atomic(size):
+        gc_malloc_layout(size, layout));
     if (newptr == NULL)
         return NULL;
-    gc_region_t region = __gc_regions + idx_ptr;
-    size_t cpy_size = (size < region->size? size: region->size);
+    size_t cpy_size = (size < oldsize? size: oldsize);
     memcpy(newptr, ptr, cpy_size);
     GC_free_nonnull(ptr);
     return newptr;
@@ -661,10 +1327,30 @@ extern void *GC_realloc(void *ptr, size_t size)
  * GC memory explicit deallocation.
  */
 extern void GC_free_nonnull(void *ptr)
+{
+    if (gc_threaded)
+        gc_thread_free(ptr);
+    else
+        gc_free_object(ptr);
+}
+
+static void gc_free_object(void *ptr)
 {
     // Add ptr to the appropriate freelist.  Do no error checking whatsoever.
     size_t idx = gc_index(ptr);
+    if (idx >= GC_HUGE_IDX_OFFSET)
+    {
+        gc_huge_t obj = gc_huge_lookup(ptr);
+        if (obj != NULL)
+        {
+            gc_alloc_size -= (ssize_t)obj->size;
+            gc_huge_free(obj);
+        }
+        return;
+    }
     gc_region_t region = __gc_regions + idx;
+    if (!region->swept)
+        gc_sweep_region(region, false);
     gc_freelist_t newfreelist = (gc_freelist_t)ptr;
     gc_freelist_t oldfreelist = region->freelist;
     newfreelist->next = gc_hide(oldfreelist);
@@ -673,48 +1359,551 @@ extern void GC_free_nonnull(void *ptr)
 }
 
 /*
- * GC collection.
+ * GC huge objects.
+ *
+ * Objects bigger than GC_HUGE_UNIT are allocated from the address range of
+ * the huge regions with a page granularity.  Each object, and each free
+ * extent between two objects, is described by a gc_huge_s record; the
+ * records form a list in address order, and the memory after the last one
+ * is free.  Allocation is first-fit.  Since a huge object is bigger than
+ * GC_HUGE_UNIT, at most one object starts in each GC_HUGE_UNIT chunk:
+ * gc_huge_map records this object, and the object which covers the start of
+ * the chunk, so that interior pointers are resolved in constant time.
+ *
+ * NOTE: the caller must hold gc_alloc_mutex if threads are enabled.
  */
-extern long GC_total_collections()
+static inline size_t gc_huge_pages(size_t size)
 {
-    return gc_collections;
+    return (size + GC_PAGESIZE - 1) / GC_PAGESIZE * GC_PAGESIZE;
 }
 
-extern void GC_collect(void)
+static void gc_huge_map_cover(void *startptr, void *endptr, gc_huge_t obj)
 {
-    // Is collection enabled?
-    if (!gc_enabled)
-        return;
+    // Set the map for the chunks whose start is in [startptr, endptr).
+    size_t chunk = ((char *)startptr - GC_HUGE_MEMORY + GC_HUGE_UNIT - 1) /
+        GC_HUGE_UNIT;
+    size_t end = ((char *)endptr - GC_HUGE_MEMORY + GC_HUGE_UNIT - 1) /
+        GC_HUGE_UNIT;
+    for (; chunk < end; chunk++)
+        gc_huge_map[chunk].cover = obj;
+}
 
-    gc_collections++;
-    // Initialize marking
-    gc_debug("collect [stage=init_marks]");
-    gc_mark_init();
+static void gc_huge_map_set(gc_huge_t obj, gc_huge_t value)
+{
+    size_t chunk = ((char *)obj->ptr - GC_HUGE_MEMORY) / GC_HUGE_UNIT;
+    gc_huge_map[chunk].start = value;
+    gc_huge_map_cover(obj->ptr, obj->ptr + obj->size, value);
+}
 
-    gc_debug("collect [stage=mark]");
-    struct gc_root_s root_0;
-    gc_root_t root = &root_0;
-    root->ptr = (void *)gc_stacktop();
-    root->size = gc_stackbottom - root->ptr;
-    root->ptrptr = &root->ptr;
-    root->sizeptr = &root->size;
-    root->elemsize = 1;
-    root->next = gc_roots;
-    gc_root_t roots = root;
+static gc_huge_t gc_huge_lookup(void *ptr)
+{
+    if (gc_huge_map == NULL || (char *)ptr < GC_HUGE_MEMORY ||
+            ptr >= gc_huge_top)
+        return NULL;
+    struct gc_hugemap_s *entry = gc_huge_map +
+        ((char *)ptr - GC_HUGE_MEMORY) / GC_HUGE_UNIT;
+    gc_huge_t obj = entry->start;
+    if (obj == NULL || ptr < obj->ptr)
+        obj = entry->cover;
+    if (obj == NULL || ptr >= obj->ptr + obj->size)
+        return NULL;
+    return obj;
+}
 
-    gc_mark(roots);
-    gc_sweep();
+static gc_huge_t gc_huge_extent(void *ptr, size_t size, gc_huge_t prev)
+{
+    // Create a new extent after 'prev' (or first, if NULL).
+    gc_huge_t ext = (gc_huge_t)calloc(1, sizeof(struct gc_huge_s));
+    if (ext == NULL)
+        gc_handle_error(true, ENOMEM);
+    ext->ptr = ptr;
+    ext->size = size;
+    ext->prev = prev;
+    ext->next = (prev == NULL? gc_huge_first: prev->next);
+    if (ext->next != NULL)
+        ext->next->prev = ext;
+    else
+        gc_huge_last = ext;
+    if (prev != NULL)
+        prev->next = ext;
+    else
+        gc_huge_first = ext;
+    return ext;
+}
+
+static void gc_huge_unlink(gc_huge_t ext)
+{
+    if (ext->prev != NULL)
+        ext->prev->next = ext->next;
+    else
+        gc_huge_first = ext->next;
+    if (ext->next != NULL)
+        ext->next->prev = ext->prev;
+    else
+        gc_huge_last = ext->prev;
+    free(ext);
+}
+
+static void gc_huge_release(void *ptr, size_t size)
+{
+    // Return the pages to the OS: only the whole huge pages, if we use them.
+    void *startptr = (void *)(((uintptr_t)ptr + gc_granule - 1) / gc_granule *
+        gc_granule);
+    void *endptr = (void *)(((uintptr_t)ptr + size) / gc_granule * gc_granule);
+    if (endptr <= startptr)
+        return;
+    size = endptr - startptr;
+#ifndef __MINGW32__
+    madvise(startptr, size, MADV_DONTNEED);
+#endif      /* __MINGW32__ */
+    gc_stats.madvise_pages += size / GC_PAGESIZE;
+}
+
+static void gc_huge_set_cards(void *ptr, size_t size, bool dirty)
+{
+    size_t page = ((char *)ptr - GC_HUGE_MEMORY) / GC_PAGESIZE;
+    size_t end = page + size / GC_PAGESIZE;
+    gc_markunit_t *cards = (gc_markunit_t *)gc_huge_cards;
+    size_t unitbits = sizeof(gc_markunit_t)*8;
+    for (; page < end; page++)
+    {
+        gc_markunit_t mask = (gc_markunit_t)0x01 << (page % unitbits);
+        if (dirty)
+            cards[page / unitbits] |= mask;
+        else
+            cards[page / unitbits] &= ~mask;
+    }
 }
 
 /*
- * Initialize marking.
+ * Allocate 'size' bytes of huge memory, from the first free extent big
+ * enough, or from the end of the used memory if 'attop'.
  */
-static void gc_mark_init(void)
+static gc_huge_t gc_huge_alloc(size_t size, bool attop)
 {
-    gc_total_size = 0;
-
-    // Zero all mark bits.
-    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+    if (gc_huge_map == NULL)
+    {
+        size_t mapsize = (GC_HUGE_END - GC_HUGE_MEMORY) / GC_HUGE_UNIT *
+            sizeof(struct gc_hugemap_s);
+        gc_huge_map = (struct gc_hugemap_s *)gc_get_mark_memory(mapsize);
+        if (gc_huge_map == NULL)
+            return NULL;
+    }
+
+    size = gc_huge_pages(size);
+    gc_huge_t obj = NULL;
+    if (!attop)
+    {
+        for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+        {
+            if (ext->free && ext->size >= size)
+            {
+                obj = ext;
+                break;
+            }
+        }
+    }
+    if (obj == NULL)
+    {
+        if (size > (size_t)(GC_HUGE_END - (char *)gc_huge_top))
+            return NULL;
+        if (gc_protect_memory(gc_huge_top, size) != 0)
+            return NULL;
+        obj = gc_huge_extent(gc_huge_top, size, gc_huge_last);
+        gc_huge_top += size;
+    }
+    else
+    {
+        if (gc_protect_memory(obj->ptr, size) != 0)
+            return NULL;
+        if (obj->size > size)
+            gc_huge_extent(obj->ptr + size, obj->size - size, obj)->free =
+                true;
+        obj->size = size;
+    }
+    obj->free = false;
+    obj->marked = false;
+    obj->noscan = false;
+    obj->wprotected = false;
+    obj->layout = 0;
+    gc_huge_map_set(obj, obj);
+    return obj;
+}
+
+/*
+ * Free a huge object.  Returns the resulting free extent, or NULL if it was
+ * the last one.
+ */
+static gc_huge_t gc_huge_free(gc_huge_t obj)
+{
+    gc_huge_map_set(obj, NULL);
+    if (obj->wprotected)
+    {
+        mprotect(obj->ptr, obj->size, PROT_READ | PROT_WRITE);
+        obj->wprotected = false;
+    }
+    gc_huge_release(obj->ptr, obj->size);
+    obj->free = true;
+
+    // Coalesce with the neighbouring free extents:
+    gc_huge_t next = obj->next;
+    if (next != NULL && next->free)
+    {
+        obj->size += next->size;
+        gc_huge_unlink(next);
+    }
+    gc_huge_t prev = obj->prev;
+    if (prev != NULL && prev->free)
+    {
+        prev->size += obj->size;
+        gc_huge_unlink(obj);
+        obj = prev;
+    }
+    if (obj->next == NULL)
+    {
+        gc_huge_top = obj->ptr;
+        gc_huge_unlink(obj);
+        return NULL;
+    }
+    return obj;
+}
+
+/*
+ * Resize a huge object in place.  Returns false if the following memory is
+ * not free.
+ */
+static bool gc_huge_resize(gc_huge_t obj, size_t size)
+{
+    size = gc_huge_pages(size);
+    void *oldend = obj->ptr + obj->size;
+    void *newend = obj->ptr + size;
+    gc_huge_t next = obj->next;
+    if (size < obj->size)
+    {
+        // Shrink: the tail becomes free.
+        size_t extra = obj->size - size;
+        gc_huge_map_cover(newend, oldend, NULL);
+        if (obj->wprotected)
+            mprotect(newend, extra, PROT_READ | PROT_WRITE);
+        gc_huge_release(newend, extra);
+        obj->size = size;
+        if (next == NULL)
+            gc_huge_top = newend;
+        else if (next->free)
+        {
+            next->ptr = newend;
+            next->size += extra;
+        }
+        else
+            gc_huge_extent(newend, extra, obj)->free = true;
+        return true;
+    }
+
+    size_t extra = size - obj->size;
+    if (next == NULL)
+    {
+        if (extra > (size_t)(GC_HUGE_END - (char *)gc_huge_top))
+            return false;
+    }
+    else if (!next->free || next->size < extra)
+        return false;
+    if (gc_protect_memory(oldend, extra) != 0)
+        return false;
+    if (next == NULL)
+        gc_huge_top += extra;
+    else if (next->size == extra)
+        gc_huge_unlink(next);
+    else
+    {
+        next->ptr += extra;
+        next->size -= extra;
+    }
+    obj->size = size;
+    gc_huge_map_cover(oldend, newend, obj);
+    if (obj->wprotected)
+    {
+        // The new pages are not write-protected: consider them dirty.
+        gc_huge_set_cards(oldend, extra, true);
+    }
+    return true;
+}
+
+static void *gc_huge_malloc(size_t size, bool noscan, uint16_t layout)
+{
+    gc_thread_t self = NULL;
+    if (gc_threaded)
+    {
+        self = gc_thread_self();
+        pthread_mutex_lock(&gc_alloc_mutex);
+    }
+    gc_maybe_collect(size);
+    gc_huge_t obj = gc_huge_alloc(size, false);
+    void *ptr = NULL;
+    if (obj != NULL)
+    {
+        obj->noscan = noscan;
+        obj->layout = layout;
+        ptr = obj->ptr;
+    }
+    if (self != NULL)
+    {
+        self->recent[self->recentidx++ % GC_RECENT_LEN] = ptr;
+        pthread_mutex_unlock(&gc_alloc_mutex);
+    }
+    if (ptr == NULL)
+        gc_handle_error(false, ENOMEM);
+    return ptr;
+}
+
+extern void *GC_malloc_huge(size_t size)
+{
+    return gc_huge_malloc(size, false, 0);
+}
+
+extern void *GC_malloc_atomic_huge(size_t size)
+{
+    return gc_huge_malloc(size, true, 0);
+}
+
+static void *gc_huge_realloc(void *ptr, size_t size)
+{
+    gc_thread_t self = NULL;
+    if (gc_threaded)
+    {
+        self = gc_thread_self();
+        pthread_mutex_lock(&gc_alloc_mutex);
+    }
+    gc_huge_t obj = gc_huge_lookup(ptr);
+    if (gc_huge_pages(size) > obj->size)
+        gc_maybe_collect(gc_huge_pages(size) - obj->size);
+    if (!gc_huge_resize(obj, size))
+    {
+        // Move the object to the end of the used memory, where it can grow
+        // in place the next time.
+        gc_huge_t newobj = gc_huge_alloc(size, true);
+        if (newobj == NULL)
+            ptr = NULL;
+        else
+        {
+            newobj->noscan = obj->noscan;
+            newobj->layout = obj->layout;
+            memcpy(newobj->ptr, obj->ptr, obj->size);
+            gc_huge_free(obj);
+            ptr = newobj->ptr;
+        }
+    }
+    if (self != NULL)
+    {
+        self->recent[self->recentidx++ % GC_RECENT_LEN] = ptr;
+        pthread_mutex_unlock(&gc_alloc_mutex);
+    }
+    if (ptr == NULL)
+        gc_handle_error(false, ENOMEM);
+    return ptr;
+}
+
+extern size_t GC_huge_size(void *ptr)
+{
+    gc_huge_t obj = gc_huge_lookup(ptr);
+    return (obj == NULL? 0: obj->size);
+}
+
+extern void *GC_huge_base(void *ptr)
+{
+    gc_huge_t obj = gc_huge_lookup(ptr);
+    return (obj == NULL? NULL: obj->ptr);
+}
+
+/*
+ * Mark a huge object, see gc_mark_ptr().
+ */
+static bool gc_mark_huge(void *ptr, void **objptr, size_t *objsize,
+    gc_layout_t *objlayout, bool atomic)
+{
+    gc_huge_t obj = gc_huge_lookup(ptr);
+    if (obj == NULL)
+        return false;
+    if (atomic? __atomic_test_and_set(&obj->marked, __ATOMIC_RELAXED):
+            obj->marked)
+        return false;
+    obj->marked = true;
+    *objsize = obj->size;
+    if (obj->noscan)
+        return false;
+    gc_read_prefetch(obj->ptr);
+    *objptr = obj->ptr;
+    *objlayout = gc_layouts[obj->layout];
+    if (*objlayout != NULL && obj->size / (*objlayout)->size *
+            (*objlayout)->numruns > GC_MAX_HUGE_RANGES)
+    {
+        // Too many ranges for the mark stack: scan it conservatively.
+        *objlayout = NULL;
+    }
+    return true;
+}
+
+/*
+ * Free the unmarked huge objects.
+ */
+static void gc_huge_sweep(void)
+{
+    gc_huge_t ext = gc_huge_first;
+    while (ext != NULL)
+    {
+        if (!ext->free && !ext->marked)
+        {
+            ext = gc_huge_free(ext);
+            if (ext == NULL)
+                break;
+        }
+        ext = ext->next;
+    }
+}
+
+/*
+ * GC collection.
+ */
+extern long GC_total_collections()
+{
+    return gc_collections;
+}
+
+extern void GC_collect(void)
+{
+    if (!gc_threaded)
+    {
+        gc_collect_gen(true);
+        return;
+    }
+    gc_thread_self();
+    pthread_mutex_lock(&gc_alloc_mutex);
+    gc_collect_gen(true);
+    pthread_mutex_unlock(&gc_alloc_mutex);
+}
+
+extern void GC_collect_minor(void)
+{
+    if (!gc_threaded)
+    {
+        gc_collect_gen(false);
+        return;
+    }
+    gc_thread_self();
+    pthread_mutex_lock(&gc_alloc_mutex);
+    gc_collect_gen(false);
+    pthread_mutex_unlock(&gc_alloc_mutex);
+}
+
+static void gc_collect_gen(bool major)
+{
+    // Is collection enabled?
+    if (!gc_enabled)
+        return;
+
+    double start_time = gc_time();
+    gc_collections++;
+    major = (major || !gc_generational || !gc_gen_valid);
+
+    // Spill the callee-saved registers, which may contain pointers, onto
+    // the stack.
+    __builtin_unwind_init();
+
+    struct gc_root_s root_0;
+    gc_root_t root = &root_0;
+    root->ptr = (void *)gc_stacktop();
+    root->size = gc_stackbottom - root->ptr;
+    root->ptrptr = &root->ptr;
+    root->sizeptr = &root->size;
+    root->elemsize = 1;
+    root->next = gc_roots;
+    gc_stack_size = root->size;
+    if (gc_threaded)
+    {
+        gc_stop_world();
+        root->size = gc_self->stackbottom - root->ptr;
+        gc_stack_size = root->size;
+        root->next = gc_thread_roots(gc_roots);
+    }
+    gc_root_t roots = root;
+
+    // A minor collection keeps the old objects marked, and also scans the
+    // old objects which have been written to since the last collection.
+    if (!major && !gc_gen_scan_cards(&roots))
+    {
+        roots = root;
+        major = true;
+    }
+    ssize_t old_size = (major? 0: gc_used_size);
+
+    // Initialize marking
+    gc_debug("collect [stage=init_marks]");
+    double mark_init_time = gc_time();
+    gc_mark_init(major);
+
+    gc_debug("collect [stage=mark]");
+    double mark_time = gc_time();
+    if (gc_mark_threads > 1)
+        gc_mark_parallel(roots);
+    else
+        gc_mark(roots);
+    gc_used_size += old_size;
+    double sweep_time = gc_time();
+    gc_sweep();
+    double end_time = gc_time();
+
+    if (gc_generational)
+    {
+        gc_gen_minors = (major? 0: gc_gen_minors + 1);
+        gc_gen_protect();
+        end_time = gc_time();
+    }
+    if (gc_threaded)
+        gc_start_world();
+
+    // Update the statistics:
+    struct gc_stats_s *stats = &gc_stats;
+    stats->minor_collections += (major? 0: 1);
+    stats->last_mark_init_time = mark_time - mark_init_time;
+    stats->last_mark_time = sweep_time - mark_time;
+    stats->last_sweep_time = end_time - sweep_time;
+    stats->last_pause_time = end_time - start_time;
+    stats->total_mark_init_time += stats->last_mark_init_time;
+    stats->total_mark_time += stats->last_mark_time;
+    stats->total_sweep_time += stats->last_sweep_time;
+    stats->total_pause_time += stats->last_pause_time;
+    stats->pauses[(gc_collections-1) % GC_STATS_PAUSES] =
+        stats->last_pause_time;
+}
+
+/*
+ * GC statistics.
+ */
+static double gc_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double)ts.tv_sec + (double)ts.tv_nsec * 1e-9;
+}
+
+extern void GC_get_stats(struct gc_stats_s *stats)
+{
+    *stats = gc_stats;
+    stats->collections = gc_collections;
+    stats->used_size = gc_used_size;
+    stats->total_size = gc_total_size;
+    stats->alloc_size = gc_alloc_size;
+    stats->trigger_size = gc_trigger_size;
+}
+
+/*
+ * Initialize marking.
+ */
+static void gc_mark_init(bool clear)
+{
+    gc_total_size = 0;
+
+    // Zero all mark bits (unless this is a minor collection).
+    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
     {
         gc_region_t region = __gc_regions + i;
         size_t regionsize = region->freeptr - region->startptr;
@@ -730,12 +1919,20 @@ static void gc_mark_init(void)
                 gc_handle_error(true, 0);
             region->markptr = (uint8_t *)markptr;
         }
-        else
+        else if (clear)
         {
             size_t marksize = (regionsize + 7) / 8;
             gc_zero_memory(region->markptr, marksize);
         }
     }
+    for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+    {
+        if (ext->free)
+            continue;
+        gc_total_size += ext->size;
+        if (clear)
+            ext->marked = false;
+    }
 }
 
 /*
@@ -756,6 +1953,22 @@ static inline bool gc_mark_index(uint8_t *markptr_0, uint32_t idx)
     return true;
 }
 
+/*
+ * Atomically mark the given index (parallel marking).
+ */
+static inline bool gc_mark_index_atomic(uint8_t *markptr_0, uint32_t idx)
+{
+    gc_markunit_t *markptr = (gc_markunit_t *)markptr_0;
+    uint32_t unitidx = (idx / (sizeof(gc_markunit_t)*8));
+    uint32_t bitidx  = (idx % (sizeof(gc_markunit_t)*8));
+    gc_markunit_t markmask = (gc_markunit_t)0x01 << bitidx;
+    if (__atomic_load_n(markptr + unitidx, __ATOMIC_RELAXED) & markmask)
+        return false;
+    gc_markunit_t markunit = __atomic_fetch_or(markptr + unitidx, markmask,
+        __ATOMIC_RELAXED);
+    return ((markunit & markmask) == 0);
+}
+
 /*
  * Test if the given index is marked.
  */
@@ -770,6 +1983,86 @@ static inline bool gc_is_marked_index(uint8_t *markptr_0, uint32_t idx)
     return ((markunit & markmask) != 0);
 }
 
+/*
+ * Mark the object pointed to by 'ptr', if any.
+ *
+ * Returns true if 'ptr' points to a GC object that was not marked yet, and
+ * that may contain pointers.  In that case the start of the object is
+ * returned in 'objptr', and the caller must scan it: all of it if 'objlayout'
+ * is NULL, else only the pointer fields of its layout.  The size of any
+ * newly marked object (including atomic ones) is returned in 'objsize'.
+ */
+static inline bool gc_mark_ptr(void *ptr, void **objptr, size_t *objsize,
+    gc_layout_t *objlayout, bool atomic)
+{
+    if (!gc_isptr(ptr))
+    {
+        // 'ptr' is not a value that points to anywhere in the GC's
+        // reserved virtual memory addresses; not a GC pointer.
+        return false;
+    }
+    size_t idx = gc_index(ptr);
+    gc_region_t region = __gc_regions + idx;
+    if (ptr >= region->freeptr)
+    {
+        if (idx >= GC_HUGE_IDX_OFFSET)
+            return gc_mark_huge(ptr, objptr, objsize, objlayout, atomic);
+
+        // 'ptr' points to memory that hasn't been allocated yet, or
+        // cannot be collected yet; not a GC pointer.
+        return false;
+    }
+
+    // 'ptr' has been deemed to be a GC pointer; check if it has been
+    // marked;
+    uint32_t size = region->size;
+    uint32_t ptridx = gc_objidx(ptr);
+    bool marked = (atomic? gc_mark_index_atomic(region->markptr, ptridx):
+        gc_mark_index(region->markptr, ptridx));
+    if (!marked)
+    {
+        // 'ptr' is already marked; no need to follow it.
+        return false;
+    }
+
+    *objsize = size;
+    if (gc_is_noscan(region, ptridx))
+    {
+        // Atomic object: contains no pointers.
+        return false;
+    }
+
+    ptr = region->startptr + (size_t)ptridx*(size_t)size;
+    gc_read_prefetch(ptr);
+    *objptr = ptr;
+    *objlayout = gc_get_layout(region, ptridx);
+    return true;
+}
+
+/*
+ * Write the ranges holding the pointer fields of the object 'ptr' of 'size'
+ * bytes, an array of 'layout' typed elements, below 'top' (i.e. at top[-1],
+ * top[-2], ...).  Returns the number of ranges written.
+ */
+static inline size_t gc_layout_ranges(gc_layout_t layout, void *ptr,
+    size_t size, gc_markstack_t top)
+{
+    size_t count = 0;
+    void *endptr = ptr + size;
+    for (void *elem = ptr; elem + layout->size <= endptr;
+            elem += layout->size)
+    {
+        for (size_t i = 0; i < layout->numruns; i++)
+        {
+            count++;
+            top[-count].startptr = (void **)(elem + layout->runs[i].offset);
+            top[-count].endptr = top[-count].startptr +
+                layout->runs[i].length;
+        }
+    }
+    return count;
+}
+
 /*
  * GC marking.
  */
@@ -814,41 +2107,31 @@ gc_mark_loop_inner:
             void *ptr = *ptrptr;
             ptrptr++;
 
-            if (!gc_isptr(ptr))
-            {
-                // 'ptr' is not a value that points to anywhere in the GC's
-                // reserved virtual memory addresses; not a GC pointer.
+            size_t size = 0;
+            gc_layout_t layout;
+            bool scan = gc_mark_ptr(ptr, &ptr, &size, &layout, false);
+            gc_used_size += size;
+            if (!scan)
                 continue;
-            }
             gc_read_prefetch(ptrptr);
-            size_t idx = gc_index(ptr);
-            gc_region_t region = __gc_regions + idx;
-            if (ptr >= region->freeptr) 
+
+            // Push onto mark stack:
+            if (layout == NULL)
             {
-                // 'ptr' points to memory that hasn't been allocated yet, or
-                // cannot be collected yet; not a GC pointer.
-                continue;
+                stack--;
+                stack->startptr = (void **)ptr;
+                stack->endptr = (void **)(ptr + size);
             }
-
-            //fprintf(stderr, "GC: considering ptr %p\n", ptr);
-            // 'ptr' has been deemed to be a GC pointer; check if it has been
-            // marked;
-            uint32_t size = region->size;
-            uint32_t ptridx = gc_objidx(ptr);
-            if (!gc_mark_index(region->markptr, ptridx))
+            else
             {
-                // 'ptr' is already marked; no need to follow it.
-                continue;
+                // Push the pointer fields only; they count as a single
+                // push below.
+                size_t count = gc_layout_ranges(layout, ptr, size, stack);
+                if (count == 0)
+                    continue;
+                stack -= count;
+                pushed += count - 1;
             }
- 
-            gc_used_size += size;
-            ptr = region->startptr + (size_t)ptridx*(size_t)size;
-            gc_read_prefetch(ptr);
-
-            // Push onto mark stack:
-            stack--;
-            stack->startptr = (void **)ptr;
-            stack->endptr = (void **)(ptr + size);
 
             if (pushed > GC_MAX_MARK_PUSH)
             {
@@ -866,68 +2149,1054 @@ gc_mark_loop_inner:
 }
 
 /*
- * GC sweeping.
+ * Parallel marking.
+ *
+ * The collecting thread acts as worker 0, and the helper threads as workers
+ * 1..n-1.  Each worker scans the ranges found on its own mark stack, and
+ * steals from the other workers' stacks when it runs out of work.  Large
+ * ranges are split in chunks of GC_MARK_CHUNK words, so that big roots and
+ * objects can be shared among the workers.  Mark bits are set atomically.
+ *
+ * Termination: a worker becomes idle only when its own stack is empty and
+ * it failed to steal, and an idle worker never pushes.  Therefore, once all
+ * the workers are idle, all the stacks are empty and marking is done.
  */
-static void gc_sweep(void)
+static bool gc_mark_pop(gc_markworker_t worker, gc_markstack_t range)
 {
-    static size_t sweep_count = 0;
-    sweep_count++;
-    bool returning = (sweep_count % GC_RETURN_SWEEP == 0);
+    bool found = false;
+    pthread_spin_lock(&worker->lock);
+    if (worker->top > worker->bottom)
+    {
+        worker->top--;
+        *range = worker->stack[worker->top];
+        found = true;
+        if (worker->top == worker->bottom)
+            worker->top = worker->bottom = 0;
+    }
+    pthread_spin_unlock(&worker->lock);
+    return found;
+}
 
-    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+static bool gc_mark_steal(gc_markworker_t worker, gc_markstack_t range)
+{
+    size_t n = gc_mark_threads;
+    size_t self = worker - gc_mark_workers;
+    for (size_t i = 1; i < n; i++)
     {
-        gc_region_t region = __gc_regions + i;
-        if (region->freeptr == region->startptr)
+        gc_markworker_t victim = gc_mark_workers + (self + i) % n;
+        if (__atomic_load_n(&victim->top, __ATOMIC_RELAXED) <=
+                __atomic_load_n(&victim->bottom, __ATOMIC_RELAXED))
             continue;
-        void *ptr = region->freeptr - region->size;
-        uint32_t size = region->size;
-        uint8_t *markptr = region->markptr;
+        bool found = false;
+        pthread_spin_lock(&victim->lock);
+        if (victim->top > victim->bottom)
+        {
+            *range = victim->stack[victim->bottom];
+            victim->bottom++;
+            found = true;
+            if (victim->top == victim->bottom)
+                victim->top = victim->bottom = 0;
+        }
+        pthread_spin_unlock(&victim->lock);
+        if (found)
+            return true;
+    }
+    return false;
+}
+
+static void gc_mark_push(gc_markworker_t worker, gc_markstack_t ranges,
+    size_t len)
+{
+    pthread_spin_lock(&worker->lock);
+    if (worker->top + len > GC_MARK_STACK_SIZE / sizeof(struct gc_markstack_s))
+    {
+        pthread_spin_unlock(&worker->lock);
+        gc_debug("mark stack overflow");
+        gc_handle_error(true, ENOMEM);
+    }
+    memcpy(worker->stack + worker->top, ranges,
+        len * sizeof(struct gc_markstack_s));
+    worker->top += len;
+    pthread_spin_unlock(&worker->lock);
+}
+
+static bool gc_mark_has_work(void)
+{
+    for (size_t i = 0; i < gc_mark_threads; i++)
+    {
+        gc_markworker_t worker = gc_mark_workers + i;
+        if (__atomic_load_n(&worker->top, __ATOMIC_RELAXED) >
+                __atomic_load_n(&worker->bottom, __ATOMIC_RELAXED))
+            return true;
+    }
+    return false;
+}
+
+static void gc_mark_work(gc_markworker_t worker)
+{
+    struct gc_markstack_s buffer[GC_MARK_BUFFER_LEN];
+    struct gc_markstack_s range;
+    size_t used = 0;
+
+    while (true)
+    {
+        if (!gc_mark_pop(worker, &range) && !gc_mark_steal(worker, &range))
+        {
+            // No work left for us; wait until somebody else pushes some, or
+            // until every worker is idle.
+            size_t n = gc_mark_threads;
+            bool done = false;
+            __atomic_add_fetch(&gc_mark_idle, 1, __ATOMIC_ACQ_REL);
+            while (true)
+            {
+                if (__atomic_load_n(&gc_mark_idle, __ATOMIC_ACQUIRE) == n)
+                {
+                    done = true;
+                    break;
+                }
+                if (gc_mark_has_work())
+                {
+                    __atomic_sub_fetch(&gc_mark_idle, 1, __ATOMIC_ACQ_REL);
+                    break;
+                }
+                sched_yield();
+            }
+            if (done)
+                break;
+            continue;
+        }
+
+        void **ptrptr = range.startptr;
+        void **endptr = range.endptr;
+        if (endptr - ptrptr > GC_MARK_CHUNK)
+        {
+            // Leave the rest of the range to us or to the thieves.
+            struct gc_markstack_s rest = {ptrptr + GC_MARK_CHUNK, endptr};
+            gc_mark_push(worker, &rest, 1);
+            endptr = ptrptr + GC_MARK_CHUNK;
+        }
+
+        size_t pushed = 0;
+        while (ptrptr < endptr)
+        {
+            void *ptr = *ptrptr;
+            ptrptr++;
+
+            size_t size = 0;
+            gc_layout_t layout;
+            bool scan = gc_mark_ptr(ptr, &ptr, &size, &layout, true);
+            used += size;
+            if (!scan)
+                continue;
+            gc_read_prefetch(ptrptr);
+
+            if (layout != NULL)
+            {
+                // Push the pointer fields only, one element at a time.
+                void *objend = ptr + size;
+                for (void *elem = ptr; elem + layout->size <= objend;
+                        elem += layout->size)
+                {
+                    if (pushed + layout->numruns > GC_MARK_BUFFER_LEN)
+                    {
+                        gc_mark_push(worker, buffer, pushed);
+                        pushed = 0;
+                    }
+                    pushed += gc_layout_ranges(layout, elem, layout->size,
+                        buffer + pushed + layout->numruns);
+                }
+                continue;
+            }
+
+            buffer[pushed].startptr = (void **)ptr;
+            buffer[pushed].endptr = (void **)(ptr + size);
+            pushed++;
+            if (pushed == GC_MARK_BUFFER_LEN)
+            {
+                gc_mark_push(worker, buffer, pushed);
+                pushed = 0;
+            }
+        }
+        if (pushed != 0)
+            gc_mark_push(worker, buffer, pushed);
+    }
+
+    worker->used = used;
+}
+
+static void *gc_mark_thread(void *arg)
+{
+    gc_markworker_t worker = (gc_markworker_t)arg;
+    unsigned long epoch = worker->epoch;
+    while (true)
+    {
+        pthread_mutex_lock(&gc_mark_mutex);
+        while (gc_mark_epoch == epoch && !gc_mark_shutdown)
+            pthread_cond_wait(&gc_mark_start_cond, &gc_mark_mutex);
+        if (gc_mark_shutdown)
+        {
+            pthread_mutex_unlock(&gc_mark_mutex);
+            return NULL;
+        }
+        epoch = gc_mark_epoch;
+        pthread_mutex_unlock(&gc_mark_mutex);
+
+        gc_mark_work(worker);
+
+        pthread_mutex_lock(&gc_mark_mutex);
+        gc_mark_running--;
+        if (gc_mark_running == 0)
+            pthread_cond_signal(&gc_mark_done_cond);
+        pthread_mutex_unlock(&gc_mark_mutex);
+    }
+}
+
+/*
+ * Start/stop the helper threads.
+ */
+static void gc_mark_pool_stop(void)
+{
+    if (gc_mark_pool_size == 0)
+        return;
+    pthread_mutex_lock(&gc_mark_mutex);
+    gc_mark_shutdown = true;
+    pthread_cond_broadcast(&gc_mark_start_cond);
+    pthread_mutex_unlock(&gc_mark_mutex);
+    for (size_t i = 1; i < gc_mark_pool_size; i++)
+        pthread_join(gc_mark_workers[i].thread, NULL);
+    gc_mark_shutdown = false;
+    gc_mark_pool_size = 0;
+}
+
+static bool gc_mark_pool_start(size_t n)
+{
+    for (size_t i = 0; i < n; i++)
+    {
+        gc_markworker_t worker = gc_mark_workers + i;
+        if (worker->stack == NULL)
+        {
+            worker->stack =
+                (gc_markstack_t)gc_get_mark_memory(GC_MARK_STACK_SIZE);
+            if (worker->stack == NULL)
+                return false;
+            pthread_spin_init(&worker->lock, PTHREAD_PROCESS_PRIVATE);
+        }
+    }
+
+    // The helper threads must not receive any signal meant for the
+    // program.
+    sigset_t sigset, oldset;
+    sigfillset(&sigset);
+    pthread_sigmask(SIG_SETMASK, &sigset, &oldset);
+    bool ok = true;
+    for (size_t i = 1; i < n; i++)
+    {
+        // Helper threads must only start working at the next epoch.
+        gc_mark_workers[i].epoch = gc_mark_epoch;
+        if (pthread_create(&gc_mark_workers[i].thread, NULL, gc_mark_thread,
+                gc_mark_workers + i) != 0)
+        {
+            ok = false;
+            break;
+        }
+        gc_mark_pool_size = i + 1;
+    }
+    pthread_sigmask(SIG_SETMASK, &oldset, NULL);
+    return ok;
+}
+
+/*
+ * After fork() only the forking thread exists in the child.
+ */
+static void gc_mark_atfork_child(void)
+{
+    pthread_mutex_init(&gc_mark_mutex, NULL);
+    pthread_cond_init(&gc_mark_start_cond, NULL);
+    pthread_cond_init(&gc_mark_done_cond, NULL);
+    gc_mark_pool_size = 0;
+    gc_mark_shutdown = false;
+    gc_mark_running = 0;
+}
+
+extern bool GC_set_mark_threads(size_t n)
+{
+    if (n < 1)
+        n = 1;
+    if (n > GC_MAX_MARK_THREADS)
+    {
+        errno = EINVAL;
+        return false;
+    }
+    if (!gc_mark_atfork)
+    {
+        pthread_atfork(NULL, NULL, gc_mark_atfork_child);
+        gc_mark_atfork = true;
+    }
+    gc_mark_pool_stop();
+    gc_mark_threads = 1;
+    if (n == 1)
+        return true;
+    if (!gc_mark_pool_start(n))
+    {
+        int saved_errno = errno;
+        gc_mark_pool_stop();
+        errno = saved_errno;
+        return false;
+    }
+    gc_mark_threads = n;
+    return true;
+}
+
+extern size_t GC_get_mark_threads(void)
+{
+    return gc_mark_threads;
+}
+
+static void gc_mark_parallel(gc_root_t roots)
+{
+    size_t n = gc_mark_threads;
+    if (gc_mark_pool_size != n)
+    {
+        // The helper threads have been lost, e.g. by a fork().
+        if (!GC_set_mark_threads(n))
+            gc_handle_error(true, 0);
+    }
+
+    // Hand all the roots to worker 0; the others will steal from it.
+    for (size_t i = 0; i < n; i++)
+    {
+        gc_markworker_t worker = gc_mark_workers + i;
+        worker->top = worker->bottom = 0;
+        worker->used = 0;
+    }
+    gc_markworker_t self = gc_mark_workers;
+    for (; roots != NULL; roots = roots->next)
+    {
+        struct gc_markstack_s range;
+        range.startptr = (void **)*roots->ptrptr;
+        size_t size = (*roots->sizeptr)*roots->elemsize;
+        range.endptr = range.startptr + size/sizeof(void *);
+        if (range.startptr < range.endptr)
+            gc_mark_push(self, &range, 1);
+    }
+
+    gc_used_size = 0;
+    gc_mark_idle = 0;
+    pthread_mutex_lock(&gc_mark_mutex);
+    gc_mark_running = n - 1;
+    gc_mark_epoch++;
+    pthread_cond_broadcast(&gc_mark_start_cond);
+    pthread_mutex_unlock(&gc_mark_mutex);
+
+    gc_mark_work(self);
+
+    pthread_mutex_lock(&gc_mark_mutex);
+    while (gc_mark_running != 0)
+        pthread_cond_wait(&gc_mark_done_cond, &gc_mark_mutex);
+    pthread_mutex_unlock(&gc_mark_mutex);
+
+    for (size_t i = 0; i < n; i++)
+        gc_used_size += gc_mark_workers[i].used;
+    gc_debug("collect [stage=sweep]");
+}
+
+/*
+ * GC sweeping.
+ */
+static void gc_sweep(void)
+{
+    static size_t sweep_count = 0;
+    sweep_count++;
+    bool returning = (sweep_count % GC_RETURN_SWEEP == 0);
+
+    gc_unswept = 0;
+    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+    {
+        gc_region_t region = __gc_regions + i;
+        if (region->freeptr == region->startptr)
+        {
+            region->swept = true;
+            continue;
+        }
+
+        if (gc_lazy_sweep)
+        {
+            // Sweep on demand, see GC_malloc_index().
+            region->swept = false;
+            gc_unswept++;
+            continue;
+        }
 
         if (i == GC_BIG_IDX_OFFSET)
             returning = true;
+        region->swept = true;
+        gc_sweep_region(region, returning);
+    }
+    gc_huge_sweep();
+}
+
+/*
+ * Sweep a single region.
+ */
+static void gc_sweep_region(gc_region_t region, bool returning)
+{
+    if (!region->swept)
+    {
+        region->swept = true;
+        gc_unswept--;
+    }
+
+    void *ptr = region->freeptr - region->size;
+    uint32_t size = region->size;
+    uint8_t *markptr = region->markptr;
 
-        // Return memory to the OS:
-        int32_t ptridx = (int32_t)gc_objidx(ptr);
-        int32_t target = ptridx / 2, freesize = 0;
-        bool start = true;
-        while (true)
+    // Return memory to the OS:
+    int32_t ptridx = (int32_t)gc_objidx(ptr);
+    int32_t target = ptridx / 2, freesize = 0;
+    bool start = true;
+    while (true)
+    {
+        if (ptridx < target || gc_is_marked_index(markptr, ptridx))
         {
-            if (ptridx < target || gc_is_marked_index(markptr, ptridx))
+            if (freesize >= 3*(int32_t)gc_granule)
             {
-                if (freesize >= 3*GC_PAGESIZE)
-                {
-                    uint32_t offset = size * (ptridx + 1);
-                    int32_t diff = offset % GC_PAGESIZE;
-                    diff = (diff == 0? 0: GC_PAGESIZE - diff);
-                    offset += diff;
-                    freesize -= diff;
-                    void *freeptr = region->startptr + offset;
-                    freesize -= freesize % GC_PAGESIZE;
+                // Release whole (huge) pages only:
+                uint32_t offset = size * (ptridx + 1);
+                int32_t diff = offset % gc_granule;
+                diff = (diff == 0? 0: gc_granule - diff);
+                offset += diff;
+                freesize -= diff;
+                void *freeptr = region->startptr + offset;
+                freesize -= freesize % gc_granule;
 #ifndef __MINGW32__
-                    madvise(freeptr, freesize, MADV_DONTNEED);
+                madvise(freeptr, freesize, MADV_DONTNEED);
 #endif      /* __MINGW32__ */
-                }
-                freesize = 0;
-                if (start)
+                gc_stats.madvise_pages += freesize / GC_PAGESIZE;
+            }
+            freesize = 0;
+            if (start)
+            {
+                void *ptr = region->startptr + size * (ptridx + 1);
+                region->freeptr = ptr;
+                if (!returning)
+                    break;
+                start = false;
+            }
+            if (ptridx < target)
+                break;
+        }
+        else
+            freesize += size;
+        ptridx--;
+    }
+
+    region->markstartptr = region->startptr;
+    region->markendptr = region->freeptr;
+    region->freelist = NULL;
+}
+
+/*
+ * GC lazy sweeping.
+ */
+extern void GC_set_lazy_sweep(bool enabled)
+{
+    gc_lazy_sweep = enabled;
+    if (!enabled)
+        GC_sweep_pending(SIZE_MAX);
+}
+
+extern size_t GC_sweep_pending(size_t max)
+{
+    if (!gc_threaded)
+        return gc_sweep_pending_regions(max);
+    pthread_mutex_lock(&gc_alloc_mutex);
+    size_t count = gc_sweep_pending_regions(max);
+    pthread_mutex_unlock(&gc_alloc_mutex);
+    return count;
+}
+
+static size_t gc_sweep_pending_regions(size_t max)
+{
+    size_t count = 0;
+    for (size_t i = 0; i < GC_NUM_REGIONS && count < max && gc_unswept != 0;
+            i++)
+    {
+        gc_region_t region = __gc_regions + gc_sweep_cursor;
+        gc_sweep_cursor = (gc_sweep_cursor + 1) % GC_NUM_REGIONS;
+        if (region->swept)
+            continue;
+        gc_sweep_region(region, true);
+        count++;
+    }
+    return count;
+}
+
+/*
+ * GC generational collection.
+ *
+ * Mark bits are sticky: an object which survived a collection stays marked
+ * (old) until the next major collection.  After each collection, the pages
+ * which may contain old objects are write-protected.  The first write to such
+ * a page is caught by gc_gen_sigsegv_handler(), which sets the page's bit in
+ * the region's card table and makes the page writable again.  A young object
+ * can only be referenced by an old one through a write done after the last
+ * collection, so the marked objects in the dirty pages are enough to find all
+ * the live young objects.
+ */
+static struct sigaction gc_gen_old_handler;
+static bool gc_gen_handler = false;             // Handler installed?
+
+static void gc_gen_unprotect(void)
+{
+    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+    {
+        gc_region_t region = __gc_regions + i;
+        if (region->wprotectptr == region->startptr)
+            continue;
+        mprotect(region->startptr, region->wprotectptr - region->startptr,
+            PROT_READ | PROT_WRITE);
+        region->wprotectptr = region->startptr;
+    }
+    for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+    {
+        if (!ext->wprotected)
+            continue;
+        mprotect(ext->ptr, ext->size, PROT_READ | PROT_WRITE);
+        ext->wprotected = false;
+    }
+}
+
+static void gc_gen_sigsegv_handler(int signum, siginfo_t *si, void *context)
+{
+    void *addr = si->si_addr;
+    gc_huge_t obj = gc_huge_lookup(addr);
+    if (obj != NULL && obj->wprotected)
+    {
+        void *pageptr = (void *)((uintptr_t)addr / GC_PAGESIZE * GC_PAGESIZE);
+        gc_mark_index_atomic(gc_huge_cards,
+            ((char *)pageptr - GC_HUGE_MEMORY) / GC_PAGESIZE);
+        if (mprotect(pageptr, GC_PAGESIZE, PROT_READ | PROT_WRITE) != 0)
+        {
+            gc_gen_unprotect();
+            gc_gen_valid = false;
+        }
+        return;
+    }
+    if (gc_isptr(addr))
+    {
+        gc_region_t region = __gc_regions + gc_index(addr);
+        if (addr >= region->startptr && addr < region->wprotectptr)
+        {
+            size_t page = (size_t)(addr - region->startptr) / GC_PAGESIZE;
+            gc_mark_index_atomic(region->cardptr, page);
+            if (mprotect(region->startptr + page*GC_PAGESIZE, GC_PAGESIZE,
+                    PROT_READ | PROT_WRITE) != 0)
+            {
+                // Probably too many mappings: stop recording the writes, the
+                // next collection will be a major one.
+                gc_gen_unprotect();
+                gc_gen_valid = false;
+            }
+            return;
+        }
+    }
+
+    // Not caused by the write protection: chain to the previous handler.
+    if (gc_gen_old_handler.sa_flags & SA_SIGINFO)
+        gc_gen_old_handler.sa_sigaction(signum, si, context);
+    else if (gc_gen_old_handler.sa_handler != SIG_DFL &&
+             gc_gen_old_handler.sa_handler != SIG_IGN)
+        gc_gen_old_handler.sa_handler(signum);
+    else
+    {
+        // Restore the default action and retry the faulting access.
+        sigaction(signum, &gc_gen_old_handler, NULL);
+    }
+}
+
+/*
+ * Write-protect the old objects, and clear the card tables.
+ */
+static void gc_gen_protect(void)
+{
+    size_t cardsize = GC_REGION_SIZE / (GC_PAGESIZE*8);
+    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+    {
+        gc_region_t region = __gc_regions + i;
+        void *startptr = region->startptr;
+        void *endptr = (void *)((((uintptr_t)region->freeptr + GC_PAGESIZE - 1)
+            / GC_PAGESIZE) * GC_PAGESIZE);
+        if (region->wprotectptr > startptr)
+        {
+            size_t npages = (region->wprotectptr - startptr) / GC_PAGESIZE;
+            size_t units = (npages + sizeof(gc_markunit_t)*8 - 1) /
+                (sizeof(gc_markunit_t)*8);
+            memset(region->cardptr, 0, units*sizeof(gc_markunit_t));
+            if (region->wprotectptr > endptr)
+                mprotect(endptr, region->wprotectptr - endptr,
+                    PROT_READ | PROT_WRITE);
+        }
+        region->wprotectptr = startptr;
+        if (endptr == startptr)
+            continue;
+        if (region->cardptr == NULL)
+        {
+            region->cardptr = (uint8_t *)gc_get_mark_memory(cardsize);
+            if (region->cardptr == NULL)
+                gc_handle_error(true, 0);
+        }
+        region->wprotectptr = endptr;
+        if (mprotect(startptr, endptr - startptr, PROT_READ) != 0)
+        {
+            gc_gen_unprotect();
+            gc_gen_valid = false;
+            return;
+        }
+    }
+
+    // Huge objects are protected one by one (atomic ones never need to).
+    for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+    {
+        if (ext->free || ext->noscan)
+            continue;
+        if (gc_huge_cards == NULL)
+        {
+            gc_huge_cards = (uint8_t *)gc_get_mark_memory(
+                (GC_HUGE_END - GC_HUGE_MEMORY) / (GC_PAGESIZE*8));
+            if (gc_huge_cards == NULL)
+                gc_handle_error(true, 0);
+        }
+        if (ext->wprotected)
+            gc_huge_set_cards(ext->ptr, ext->size, false);
+        ext->wprotected = true;
+        if (mprotect(ext->ptr, ext->size, PROT_READ) != 0)
+        {
+            gc_gen_unprotect();
+            gc_gen_valid = false;
+            return;
+        }
+    }
+    gc_gen_valid = true;
+}
+
+/*
+ * Add the runs of marked objects found in the dirty pages to the roots.
+ * Returns false if there are too many of them.
+ */
+static bool gc_gen_scan_cards(gc_root_t *rootsptr)
+{
+    if (gc_gen_roots == NULL)
+    {
+        gc_gen_roots = (gc_root_t)gc_get_mark_memory(GC_MARK_STACK_SIZE);
+        if (gc_gen_roots == NULL)
+            return false;
+    }
+    size_t maxroots = GC_MARK_STACK_SIZE / sizeof(struct gc_root_s);
+    size_t numroots = 0;
+    gc_root_t roots = *rootsptr;
+
+    for (size_t i = 0; i < GC_NUM_REGIONS; i++)
+    {
+        gc_region_t region = __gc_regions + i;
+        if (region->wprotectptr == region->startptr)
+            continue;
+        size_t npages = (region->wprotectptr - region->startptr) / GC_PAGESIZE;
+        size_t unitbits = sizeof(gc_markunit_t)*8;
+        gc_markunit_t *cards = (gc_markunit_t *)region->cardptr;
+        uint32_t size = region->size;
+        for (size_t j = 0; j*unitbits < npages; j++)
+        {
+            gc_markunit_t unit = cards[j];
+            while (unit != 0)
+            {
+                size_t page = j*unitbits + __builtin_ctzll(unit);
+                unit &= unit - 1;
+                void *pageptr = region->startptr + page*GC_PAGESIZE;
+                void *pageend = pageptr + GC_PAGESIZE;
+                if (pageend > region->freeptr)
+                    pageend = region->freeptr;
+
+                // Objects may straddle the page boundaries, but only the
+                // part inside the page can have been written to.
+                uint32_t ptridx = gc_objidx(pageptr);
+                void *ptr = region->startptr + (size_t)ptridx*(size_t)size;
+                void *runptr = NULL;
+                while (true)
                 {
-                    void *ptr = region->startptr + size * (ptridx + 1);
-                    region->freeptr = ptr;
-                    if (!returning)
+                    bool marked = (ptr < pageend &&
+                        gc_is_marked_index(region->markptr, ptridx) &&
+                        !gc_is_noscan(region, ptridx));
+                    if (marked && runptr == NULL)
+                        runptr = (ptr < pageptr? pageptr: ptr);
+                    else if (!marked && runptr != NULL)
+                    {
+                        if (numroots == maxroots)
+                            return false;
+                        gc_root_t root = gc_gen_roots + numroots++;
+                        root->ptr = runptr;
+                        root->size = (ptr < pageend? ptr: pageend) - runptr;
+                        root->ptrptr = &root->ptr;
+                        root->sizeptr = &root->size;
+                        root->elemsize = 1;
+                        root->next = roots;
+                        roots = root;
+                        runptr = NULL;
+                    }
+                    if (ptr >= pageend)
                         break;
-                    start = false;
+                    ptr += size;
+                    ptridx++;
                 }
-                if (ptridx < target)
-                    break;
             }
-            else
-                freesize += size;
-            ptridx--;
         }
+    }
+
+    // The dirty pages of the huge objects:
+    for (gc_huge_t ext = gc_huge_first; ext != NULL; ext = ext->next)
+    {
+        if (!ext->wprotected)
+            continue;
+        size_t page = ((char *)ext->ptr - GC_HUGE_MEMORY) / GC_PAGESIZE;
+        size_t npages = ext->size / GC_PAGESIZE;
+        void *runptr = NULL;
+        for (size_t j = 0; j <= npages; j++)
+        {
+            bool dirty = (j < npages &&
+                gc_is_marked_index(gc_huge_cards, page + j));
+            void *pageptr = ext->ptr + j*GC_PAGESIZE;
+            if (dirty && runptr == NULL)
+                runptr = pageptr;
+            else if (!dirty && runptr != NULL)
+            {
+                if (numroots == maxroots)
+                    return false;
+                gc_root_t root = gc_gen_roots + numroots++;
+                root->ptr = runptr;
+                root->size = pageptr - runptr;
+                root->ptrptr = &root->ptr;
+                root->sizeptr = &root->size;
+                root->elemsize = 1;
+                root->next = roots;
+                roots = root;
+                runptr = NULL;
+            }
+        }
+    }
+    *rootsptr = roots;
+    return true;
+}
+
+extern bool GC_set_generational(bool enabled)
+{
+    if (enabled && gc_hugepages == GC_HUGEPAGES_HUGETLB)
+        return false;
+    if (enabled && !gc_gen_handler)
+    {
+        struct sigaction sa;
+        sa.sa_flags = SA_SIGINFO | SA_RESTART;
+        sigemptyset(&sa.sa_mask);
+        sa.sa_sigaction = gc_gen_sigsegv_handler;
+        if (sigaction(SIGSEGV, &sa, &gc_gen_old_handler) != 0)
+            return false;
+        gc_gen_handler = true;
+    }
+    if (!enabled)
+        gc_gen_unprotect();
+    gc_generational = enabled;
+    gc_gen_valid = false;
+    gc_gen_minors = 0;
+    return true;
+}
+
+extern void GC_gen_invalidate(void)
+{
+    gc_gen_unprotect();
+    gc_gen_valid = false;
+}
+
+/*
+ * GC multi-threaded allocation.
+ *
+ * All the global allocator state is protected by gc_alloc_mutex.  Small
+ * objects are allocated from per-thread caches, which are refilled in
+ * batches of GC_CACHE_BYTES under the lock.  A collection stops all the
+ * other registered threads with GC_SIG_SUSPEND: the signal handler saves
+ * the registers on the stack, which is then scanned like the collecting
+ * thread's one.
+ *
+ * A collection reuses the memory of the cached objects, thus each cache is
+ * tagged with the collection cycle it was filled in, and stale caches are
+ * discarded.  The cycle is checked *after* popping an object from the cache:
+ * if a collection happens after the check, the object is reachable from the
+ * thread's registers or stack.
+ */
+static void gc_suspend_handler(int signum, siginfo_t *si, void *context)
+{
+    int saved_errno = errno;
+    gc_thread_t self = gc_self;
+    self->root.ptr = __builtin_frame_address(0);
+    unsigned long epoch = __atomic_load_n(&gc_world_epoch, __ATOMIC_ACQUIRE);
+    sem_post(&gc_suspend_ack);
+
+    // GC_SIG_RESUME is blocked while running this handler.  Note that the
+    // world may have been restarted and stopped again before we wake up:
+    // the new GC_SIG_SUSPEND is then handled after returning.
+    sigset_t mask;
+    sigfillset(&mask);
+    sigdelset(&mask, GC_SIG_RESUME);
+    do
+        sigsuspend(&mask);
+    while (__atomic_load_n(&gc_world_epoch, __ATOMIC_ACQUIRE) == epoch);
+    errno = saved_errno;
+}
+
+static void gc_resume_handler(int signum)
+{
+    // Nothing to do; just interrupt sigsuspend().
+}
+
+static void gc_stop_world(void)
+{
+    size_t count = 0;
+    for (gc_thread_t thread = gc_threads; thread != NULL;
+            thread = thread->next)
+    {
+        if (thread != gc_self &&
+                pthread_kill(thread->thread, GC_SIG_SUSPEND) == 0)
+            count++;
+    }
+    for (size_t i = 0; i < count; i++)
+    {
+        while (sem_wait(&gc_suspend_ack) != 0 && errno == EINTR)
+            ;
+    }
+}
+
+static void gc_start_world(void)
+{
+    __atomic_add_fetch(&gc_world_epoch, 1, __ATOMIC_RELEASE);
+    for (gc_thread_t thread = gc_threads; thread != NULL;
+            thread = thread->next)
+    {
+        if (thread != gc_self)
+            pthread_kill(thread->thread, GC_SIG_RESUME);
+    }
+}
+
+/*
+ * Add the stacks of the stopped threads to the roots.
+ */
+static gc_root_t gc_thread_roots(gc_root_t roots)
+{
+    for (gc_thread_t thread = gc_threads; thread != NULL;
+            thread = thread->next)
+    {
+        thread->recentroot.next = roots;
+        roots = &thread->recentroot;
+        if (thread == gc_self)
+            continue;
+        gc_root_t root = &thread->root;
+        root->size = thread->stackbottom - root->ptr;
+        root->next = roots;
+        roots = root;
+        gc_stack_size += root->size;
+    }
+    return roots;
+}
+
+static void gc_thread_unregister(void *arg)
+{
+    gc_thread_t self = (gc_thread_t)arg;
+    pthread_mutex_lock(&gc_alloc_mutex);
+    gc_thread_t *prev = &gc_threads;
+    while (*prev != self)
+        prev = &(*prev)->next;
+    *prev = self->next;
+    pthread_mutex_unlock(&gc_alloc_mutex);
+    gc_self = NULL;
+    free(self);
+}
+
+static gc_thread_t gc_thread_self(void)
+{
+    gc_thread_t self = gc_self;
+    if (self != NULL)
+        return self;
+
+    self = (gc_thread_t)calloc(1, sizeof(struct gc_thread_s));
+    if (self == NULL)
+        gc_handle_error(true, ENOMEM);
+    self->thread = pthread_self();
+    pthread_attr_t attr;
+    void *stackaddr;
+    size_t stacksize;
+    if (pthread_getattr_np(self->thread, &attr) != 0 ||
+            pthread_attr_getstack(&attr, &stackaddr, &stacksize) != 0)
+        gc_handle_error(true, 0);
+    pthread_attr_destroy(&attr);
+    self->stackbottom = stackaddr + stacksize - sizeof(void *);
+    self->root.ptrptr = &self->root.ptr;
+    self->root.sizeptr = &self->root.size;
+    self->root.elemsize = 1;
+    self->recentroot.ptr = self->recent;
+    self->recentroot.size = sizeof(self->recent);
+    self->recentroot.ptrptr = &self->recentroot.ptr;
+    self->recentroot.sizeptr = &self->recentroot.size;
+    self->recentroot.elemsize = 1;
+    self->epoch = -1;
+
+    pthread_mutex_lock(&gc_alloc_mutex);
+    self->next = gc_threads;
+    gc_threads = self;
+    gc_self = self;
+    pthread_mutex_unlock(&gc_alloc_mutex);
+    pthread_setspecific(gc_thread_key, self);
+    return self;
+}
+
+/*
+ * Reset the cache if a collection happened since it was filled.
+ */
+static inline void gc_thread_check_cache(gc_thread_t self)
+{
+    if (self->epoch == gc_collections)
+        return;
+    memset(self->cache, 0, sizeof(self->cache));
+    self->epoch = gc_collections;
+}
+
+static void *gc_thread_malloc(size_t idx)
+{
+    gc_thread_t self = gc_thread_self();
+    if (idx < GC_BIG_IDX_OFFSET)
+    {
+        gc_freelist_t freelist = self->cache[idx];
+        if (freelist != NULL)
+        {
+            self->cache[idx] = gc_unhide(freelist->next);
+            if (self->epoch == __atomic_load_n(&gc_collections,
+                    __ATOMIC_ACQUIRE))
+            {
+                self->recent[self->recentidx++ % GC_RECENT_LEN] = freelist;
+                return (void *)freelist;
+            }
+        }
+    }
+
+    // Refill the cache, or allocate a big object, under the lock:
+    pthread_mutex_lock(&gc_alloc_mutex);
+    gc_region_t region = __gc_regions + idx;
+    size_t count = 1;
+    if (idx < GC_BIG_IDX_OFFSET)
+        count = (GC_CACHE_BYTES + region->size - 1) / region->size;
+    gc_maybe_collect(count*region->size);
+    if (!region->swept)
+        gc_sweep_region(region, false);
+    void *ptr = gc_alloc_object(region);
+    if (ptr != NULL && idx < GC_BIG_IDX_OFFSET)
+    {
+        gc_thread_check_cache(self);
+        gc_freelist_t freelist = self->cache[idx];
+        for (size_t i = 1; i < count; i++)
+        {
+            gc_freelist_t freenode = (gc_freelist_t)gc_alloc_object(region);
+            if (freenode == NULL)
+                break;
+            freenode->next = gc_hide(freelist);
+            freelist = freenode;
+        }
+        self->cache[idx] = freelist;
+    }
+    self->recent[self->recentidx++ % GC_RECENT_LEN] = ptr;
+    pthread_mutex_unlock(&gc_alloc_mutex);
+    return ptr;
+}
+
+static void gc_thread_free(void *ptr)
+{
+    gc_thread_t self = gc_thread_self();
+    size_t idx = gc_index(ptr);
+    if (idx < GC_BIG_IDX_OFFSET &&
+            self->epoch == __atomic_load_n(&gc_collections, __ATOMIC_ACQUIRE))
+    {
+        gc_freelist_t freenode = (gc_freelist_t)ptr;
+        freenode->next = gc_hide(self->cache[idx]);
+        self->cache[idx] = freenode;
+        return;
+    }
+    pthread_mutex_lock(&gc_alloc_mutex);
+    gc_free_object(ptr);
+    pthread_mutex_unlock(&gc_alloc_mutex);
+}
+
+/*
+ * fork() is done with the lock held, and only the forking thread exists in
+ * the child.
+ */
+static void gc_thread_atfork_prepare(void)
+{
+    pthread_mutex_lock(&gc_alloc_mutex);
+}
+
+static void gc_thread_atfork_parent(void)
+{
+    pthread_mutex_unlock(&gc_alloc_mutex);
+}
 
-        region->markstartptr = region->startptr;
-        region->markendptr = region->freeptr;
-        region->freelist = NULL;
+static void gc_thread_atfork_child(void)
+{
+    pthread_mutex_init(&gc_alloc_mutex, NULL);
+    sem_init(&gc_suspend_ack, 0, 0);
+    gc_thread_t thread = gc_threads;
+    while (thread != NULL)
+    {
+        gc_thread_t next = thread->next;
+        if (thread != gc_self)
+            free(thread);
+        thread = next;
     }
+    gc_threads = gc_self;
+    if (gc_self != NULL)
+        gc_self->next = NULL;
+}
+
+extern bool GC_enable_threads(void)
+{
+    if (gc_threaded)
+        return true;
+    if (sem_init(&gc_suspend_ack, 0, 0) != 0 ||
+            pthread_key_create(&gc_thread_key, gc_thread_unregister) != 0)
+        return false;
+
+    struct sigaction sa;
+    sa.sa_flags = SA_SIGINFO | SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    sigaddset(&sa.sa_mask, GC_SIG_RESUME);
+    sa.sa_sigaction = gc_suspend_handler;
+    if (sigaction(GC_SIG_SUSPEND, &sa, NULL) != 0)
+        return false;
+    sa.sa_flags = SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    sa.sa_handler = gc_resume_handler;
+    if (sigaction(GC_SIG_RESUME, &sa, NULL) != 0)
+        return false;
+    pthread_atfork(gc_thread_atfork_prepare, gc_thread_atfork_parent,
+        gc_thread_atfork_child);
+
+    gc_thread_self();
+    gc_threaded = true;
+    return true;
+}
+
+extern bool GC_register_thread(void)
+{
+    if (!gc_threaded)
+    {
+        errno = EINVAL;
+        return false;
+    }
+    gc_thread_self();
+    return true;
 }
 
 /*
@@ -28,6 +28,19 @@
 #define GC_INLINE static inline __attribute__((__always_inline__))
 #endif      /* GC_INLINE */
 
+/*
+ * GC heap.
+ *
+ * Several independent heaps can be used by the same process: each one is a
+ * separate build of the library, with its own GC_HEAP.  The memory (and the
+ * library itself, see the Makefile) of heap N is placed N*GC_HEAP_STRIDE
+ * bytes after the one of heap 0.
+ */
+#ifndef GC_HEAP
+#define GC_HEAP             0
+#endif      /* GC_HEAP */
+#define GC_HEAP_STRIDE      ((size_t)0x40000000000)     // 4TB
+
 /*
  * GC memory base address.
  *
@@ -44,7 +57,7 @@
  * DEFAULT: Address 0x100000000000 (linux, macosx), 0x100000000 (windows)
  */
 #ifndef __MINGW32__
-#define GC_MEMORY           ((char *)0x1000000000)
+#define GC_MEMORY           ((char *)0x1000000000 + GC_HEAP*GC_HEAP_STRIDE)
 #else       /* __MINGW32__ */
 #define GC_MEMORY           ((char *)0x100000000)
 #endif      /* __MINGW32__ */
@@ -118,6 +131,11 @@ struct gc_region_s
     void *markstartptr;                         // Marked (start) pointer.
     void *markendptr;                           // Marked (end) pointer.
     uint8_t *markptr;                           // Mark memory pointer.
+    uint8_t *noscanptr;                         // No-scan (atomic) bits.
+    uint16_t *layoutptr;                        // Object layout ids.
+    bool swept;                                 // Swept since last GC?
+    uint8_t *cardptr;                           // Dirty page bits.
+    void *wprotectptr;                          // Write-protect pointer.
 };
 typedef struct gc_region_s *gc_region_t;
 extern struct gc_region_s __gc_regions[GC_NUM_REGIONS];
@@ -215,11 +233,15 @@ GC_INLINE void *GC_size_region(size_t size)
 /*
  * GC size.
  *
- * Object sizes.
+ * Object sizes.  Huge objects (> GC_HUGE_UNIT) are sized in pages.
  */
+extern size_t GC_huge_size(void *ptr);
 GC_INLINE size_t GC_size(void *ptr)
 {
-    return __gc_regions[GC_index(ptr)].size;
+    size_t idx = GC_index(ptr);
+    if (idx >= GC_HUGE_IDX_OFFSET)
+        return GC_huge_size(ptr);
+    return __gc_regions[idx].size;
 }
 GC_INLINE size_t GC_index_size(size_t idx)
 {
@@ -309,9 +331,13 @@ GC_INLINE uint32_t GC_objidx(void *ptr)
  * Given an interior pointer to an object, this function returns a pointer to
  * the start of the object.
  */
+extern void *GC_huge_base(void *ptr);
 GC_INLINE void *GC_base(void *ptr)
 {
-    gc_region_t region = __gc_regions + gc_index(ptr);
+    size_t idx = gc_index(ptr);
+    if (idx >= GC_HUGE_IDX_OFFSET)
+        return GC_huge_base(ptr);
+    gc_region_t region = __gc_regions + idx;
     ptr = (char *)region->startptr + GC_objidx(ptr) * region->size;
     return ptr;
 }
@@ -363,6 +389,58 @@ extern bool GC_init(const char* path);
 extern bool GC_open(const char* path);
 #define gc_open             GC_open
 
+/*
+ * GC huge pages.
+ *
+ * Back the GC memory with huge pages, to reduce the TLB misses.  It must be
+ * called before GC_init() or GC_open(), by all the processes which use the
+ * memory; afterwards it only succeeds if the mode is the one in use.
+ *
+ * With GC_HUGEPAGES_THP the mapping is advised with MADV_HUGEPAGE: for shared
+ * memory, /sys/kernel/mm/transparent_hugepage/shmem_enabled must be "advise"
+ * or "always".  With GC_HUGEPAGES_HUGETLB the path must be a file in a
+ * hugetlbfs mount (or NULL, for an anonymous MAP_HUGETLB mapping).
+ *
+ * The memory is then made accessible and returned to the OS in units of
+ * GC_HUGEPAGE_SIZE.  Generational collection is not available with
+ * GC_HUGEPAGES_HUGETLB, since it write-protects single pages.
+ * GC_get_hugepages() returns the mode in use: if the kernel refuses
+ * MADV_HUGEPAGE, it is GC_HUGEPAGES_NONE.
+ */
+#define GC_HUGEPAGES_NONE   0
+#define GC_HUGEPAGES_THP    1
+#define GC_HUGEPAGES_HUGETLB 2
+#define GC_HUGEPAGE_SIZE    ((size_t)0x200000)  // 2MB
+extern bool GC_set_hugepages(int mode);
+extern int GC_get_hugepages(void);
+#define gc_set_hugepages    GC_set_hugepages
+#define gc_get_hugepages    GC_get_hugepages
+
+/*
+ * GC extents.
+ *
+ * The used parts of the GC memory: one extent per small object region, from
+ * its start to its free pointer, plus one per huge object, sorted by
+ * address.  GC_get_extents() stores at most n extents and returns their total
+ * number: the process which allocates can publish them, so that the ones
+ * which only open the memory know where the objects are.
+ *
+ * GC_prefetch() can be called by any process: it reads all the objects which
+ * are reachable from the given roots, conservatively, so that their pages
+ * are faulted in.  Only the pointers inside the given extents are followed.
+ * It returns the total size of the objects read.
+ */
+struct gc_extent_s
+{
+    void *start;                                // Start pointer.
+    size_t size;                                // Size in bytes.
+};
+extern size_t GC_get_extents(struct gc_extent_s *extents, size_t n);
+extern size_t GC_prefetch(void **roots, size_t nroots,
+    const struct gc_extent_s *extents, size_t nextents);
+#define gc_get_extents      GC_get_extents
+#define gc_prefetch         GC_prefetch
+
 
 /*
  * GC root registration.
@@ -387,13 +465,27 @@ extern bool GC_root(void *ptr, size_t size);
 extern bool GC_dynamic_root(void **ptrptr, size_t *sizeptr, size_t elemsize);
 #define gc_dynamic_root     GC_dynamic_root
 
+/*
+ * GC dynamic root removal.
+ *
+ * Unregister the dynamic root registered with the given ptrptr, so that the
+ * memory holding the pointer and the size can be released.  Returns false if
+ * there is no such root.
+ */
+extern bool GC_remove_dynamic_root(void **ptrptr);
+#define gc_remove_dynamic_root  GC_remove_dynamic_root
+
 /*
  * GC memory allocation.
  *
  * This is the GC's replacement of stdlib malloc().  All memory returned by
  * gc_malloc() is aligned to an address that is a multiple of GC_ALIGNMENT.
+ * Huge objects (> GC_HUGE_UNIT) are allocated by GC_malloc_huge() with a
+ * page granularity, and can be grown in place by gc_realloc().
  */
 extern void *GC_malloc_index(size_t idx) __attribute__((__malloc__));
+extern void *GC_malloc_huge(size_t size) __attribute__((__malloc__));
+extern void *GC_malloc_atomic_huge(size_t size) __attribute__((__malloc__));
 extern void *GC_malloc_noinline(size_t size) __attribute__((__malloc__));
 GC_INLINE void *GC_malloc(size_t size)
 {
@@ -405,22 +497,60 @@ GC_INLINE void *GC_malloc(size_t size)
     else if (size1 < GC_HUGE_UNIT)
         idx = GC_BIG_IDX_OFFSET + size1 / GC_BIG_UNIT;
     else
-    {
-        idx = GC_HUGE_IDX_OFFSET + size1 / GC_HUGE_UNIT;
-        if (idx >= GC_NUM_REGIONS)
-            GC_handle_error(true, EINVAL);
-    }
+        return GC_malloc_huge(size);
     return GC_malloc_index(idx);
 }
 #define gc_malloc           GC_malloc
 
+/*
+ * GC atomic memory allocation.
+ *
+ * Like gc_malloc(), except that the GC never scans the returned memory for
+ * pointers: use it for objects which cannot contain GC pointers, such as
+ * strings and numeric arrays.  gc_realloc() of atomic memory returns atomic
+ * memory.
+ */
+extern void *GC_malloc_atomic_index(size_t idx) __attribute__((__malloc__));
+GC_INLINE void *GC_malloc_atomic(size_t size)
+{
+    size_t idx, size1 = size-1;
+    if (size1 < GC_BIG_UNIT)
+        idx = size1 / GC_UNIT;
+    else if (size1 < GC_HUGE_UNIT)
+        idx = GC_BIG_IDX_OFFSET + size1 / GC_BIG_UNIT;
+    else
+        return GC_malloc_atomic_huge(size);
+    return GC_malloc_atomic_index(idx);
+}
+#define gc_malloc_atomic    GC_malloc_atomic
+
+/*
+ * GC object layouts (precise marking).
+ *
+ * gc_register_layout() registers a type of 'size' bytes whose only pointer
+ * fields are at the (word aligned) byte offsets 'offsets[0..n-1]', and
+ * returns its layout id, or 0 if the layout cannot be registered.  Memory
+ * allocated with gc_malloc_layout() is treated as an array of that type: the
+ * GC only follows its pointer fields.  Layout 0 is the conservative layout,
+ * i.e. gc_malloc_layout(size, 0) is gc_malloc(size).
+ */
+extern uint16_t GC_register_layout(size_t size, const size_t *offsets,
+    size_t n);
+extern void *GC_malloc_layout(size_t size, uint16_t layout)
+    __attribute__((__malloc__));
+#define gc_register_layout  GC_register_layout
+#define gc_malloc_layout    GC_malloc_layout
+
 /*
  * GC memory reallocation.
  *
  * This is the GC's replacement of stdlib realloc().  Memory returned by
  * gc_realloc() has the same guarantees as that returned by gc_malloc().
  * After the call to gc_realloc(ptr, size), the memory pointed to by 'ptr'
- * has been explicitly freed, and should no longer be used.
+ * has been explicitly freed, and should no longer be used.  Huge objects are
+ * resized in place when the following pages are free; otherwise they are
+ * moved to the end of the used huge memory, so that the next growth is
+ * likely to happen in place.
  */
 extern void *GC_realloc(void *ptr, size_t size);
 #define gc_realloc          GC_realloc
@@ -456,6 +586,107 @@ extern long GC_total_collections(void);
 extern void GC_collect(void) __attribute__((__noinline__));
 #define gc_collect          GC_collect
 
+/*
+ * GC parallel marking.
+ *
+ * Set/get the number of threads used by the mark phase.  With n <= 1 (the
+ * default) marking is done by the collecting thread only.  Otherwise n-1
+ * helper threads are started, and all threads mark in parallel using
+ * work-stealing mark stacks.
+ */
+extern bool GC_set_mark_threads(size_t n);
+extern size_t GC_get_mark_threads(void);
+#define gc_set_mark_threads GC_set_mark_threads
+#define gc_get_mark_threads GC_get_mark_threads
+
+/*
+ * GC lazy sweeping.
+ *
+ * If enabled, a collection does not sweep the regions.  Instead, each region
+ * is swept the first time memory is allocated from it.  Memory is not
+ * returned to the OS by on-demand sweeps: call GC_sweep_pending() to sweep
+ * (up to 'max' of) the remaining regions and return their free pages.
+ * Disabling lazy sweeping sweeps all the pending regions.
+ */
+extern void GC_set_lazy_sweep(bool enabled);
+extern size_t GC_sweep_pending(size_t max);
+#define gc_set_lazy_sweep   GC_set_lazy_sweep
+#define gc_sweep_pending    GC_sweep_pending
+
+/*
+ * GC generational collection.
+ *
+ * If enabled, the objects which survived a collection are old, and the pages
+ * containing them are write-protected after each collection so that writes
+ * to old objects are recorded.  A minor collection only traces and frees the
+ * objects allocated since the previous collection, using the old objects in
+ * the written pages as extra roots.  Automatic collections are minor, with a
+ * major (full) collection every few minor ones.  GC_collect() always does a
+ * major collection.
+ *
+ * GC_gen_invalidate() must be called before changing the protection of the
+ * GC memory by other means: the next collection will be a major one.
+ *
+ * Note: the kernel cannot write into write-protected pages, e.g. read() into
+ *       an old object fails with EFAULT.
+ */
+extern bool GC_set_generational(bool enabled);
+extern void GC_collect_minor(void) __attribute__((__noinline__));
+extern void GC_gen_invalidate(void);
+#define gc_set_generational GC_set_generational
+#define gc_collect_minor    GC_collect_minor
+#define gc_gen_invalidate   GC_gen_invalidate
+
+/*
+ * GC multi-threaded allocation.
+ *
+ * After GC_enable_threads(), GC_malloc(), GC_free() and GC_collect() can be
+ * called from several threads at once.  Each thread allocates small objects
+ * from its own cache, and only takes the allocator lock to refill it.
+ * A collection stops the other threads with signals (SIGPWR and SIGXCPU)
+ * and scans their stacks, plus the last few objects allocated by each thread.
+ * Threads are registered automatically the first time they allocate; a
+ * thread which manipulates GC pointers without allocating must call
+ * GC_register_thread().  All the other GC functions (e.g. configuration
+ * ones) must not be called concurrently.
+ */
+extern bool GC_enable_threads(void);
+extern bool GC_register_thread(void);
+#define gc_enable_threads   GC_enable_threads
+#define gc_register_thread  GC_register_thread
+
+/*
+ * GC statistics.
+ *
+ * Times are wall-clock times in seconds.  The 'last_*' fields refer to the
+ * last collection, the 'total_*' fields to all the collections so far.  The
+ * durations of the last GC_STATS_PAUSES collections are kept in the 'pauses'
+ * ring buffer: the pause of the n-th collection (counting from 0) is stored
+ * at index n % GC_STATS_PAUSES.
+ */
+#define GC_STATS_PAUSES     64
+struct gc_stats_s
+{
+    long collections;                           // Number of collections.
+    long minor_collections;                     // Number of minor ones.
+    double last_mark_init_time;                 // gc_mark_init() time.
+    double last_mark_time;                      // gc_mark() time.
+    double last_sweep_time;                     // gc_sweep() time.
+    double last_pause_time;                     // Whole collection time.
+    double total_mark_init_time;
+    double total_mark_time;
+    double total_sweep_time;
+    double total_pause_time;
+    size_t used_size;                           // Bytes marked live.
+    size_t total_size;                          // Bytes in use before GC.
+    size_t alloc_size;                          // Allocated since GC.
+    size_t trigger_size;                        // Next GC trigger.
+    size_t madvise_pages;                       // Pages returned to the OS.
+    double pauses[GC_STATS_PAUSES];             // Pause times ring buffer.
+};
+extern void GC_get_stats(struct gc_stats_s *stats);
+#define gc_get_stats        GC_get_stats
+
 /*
  * GC strdup
  *
@@ -0,0 +1,89 @@
+"""
+Compare the hash and comparison functions of composite dict keys when the
+fieldspec is interpreted (the default) and when they are compiled to C
+(``compiled_hash=True``).
+
+The keys are structs of two longs and a string, and immutable lists of 4
+longs. ``N`` keys are inserted with a single put_many() call, then looked up
+with get_many() through other objects with the same content, so that every
+lookup hashes the key and compares it with the entry. Only the C calls are
+timed, and the lookups are the best of REPEAT. Usage:
+
+    python bench/compiled_keys.py [N...]
+"""
+
+import sys
+import time
+import cffi
+from shm.sharedmem import sharedmem
+from shm.pyffi import PyFFI
+from shm.dict import DictType
+
+REPEAT = 5
+
+CDEF = """
+    typedef struct {
+        long x;
+        long y;
+        const char* name;
+    } Point;
+"""
+
+def make_types(compiled):
+    ffi = cffi.FFI()
+    ffi.cdef(CDEF)
+    pyffi = PyFFI(ffi)
+    Point = pyffi.struct('Point', compiled_hash=compiled)
+    LT = pyffi.list('long', immutable=True, compiled_hash=compiled,
+                    cname='LongList')
+    return [('struct', pyffi, 'Point*',
+             lambda i: Point(i, i * 7, 'point-%d' % (i % 1000))),
+            ('list', pyffi, 'LongList*',
+             lambda i: LT([i, i + 1, i * 3, -i]))]
+
+def measure(pyffi, keytype, make, engine, n):
+    DT = DictType(pyffi, keytype, 'long', engine=engine)
+    d = DT(expected_size=n)
+    t = d.dictype
+    keys = [make(i) for i in xrange(n)]
+    lookup_keys = [make(i) for i in xrange(n)]
+    karr, keepalive = d._key_array(keys)
+    varr = pyffi.ffi.new('long[]', range(n))
+    values = pyffi.ffi.new('void*[]', n)
+    found = pyffi.ffi.new('char[]', n)
+    with sharedmem.gc_disabled:
+        a = time.time()
+        t.htlib.put_many(d.ht, karr, t.keysize,
+                         pyffi.ffi.cast('void**', varr), n)
+        put = time.time() - a
+    larr, keepalive2 = d._key_array(lookup_keys)
+    get = float('inf')
+    for i in range(REPEAT):
+        b = time.time()
+        count = t.htlib.get_many(d.ht, larr, t.keysize, n, values, found)
+        c = time.time()
+        assert count == len(d) == n
+        get = min(get, c - b)
+    return put/n, get/n
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [10**4, 10**5]
+    sharedmem.init('/cffi-shm-bench')
+    types = {False: make_types(False), True: make_types(True)}
+    print '%10s %8s %8s %10s %10s %10s %10s' % (
+        'entries', 'key', 'engine', 'put (ns)', 'compiled', 'get (ns)',
+        'compiled')
+    for n in sizes:
+        for k in range(2):
+            for engine in ('chain', 'open'):
+                res = []
+                for compiled in (False, True):
+                    name, pyffi, keytype, make = types[compiled][k]
+                    res.append(measure(pyffi, keytype, make, engine, n))
+                (put, get), (cput, cget) = res
+                print '%10d %8s %8s %10.1f %10.1f %10.1f %10.1f' % (
+                    n, name, engine, put*1e9, cput*1e9, get*1e9, cget*1e9)
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compare the dict engines: cfuhash ('chain') and openhash ('open').
+
+A dict of ``N`` sparse long keys is filled in a scattered order, then all
+the keys are looked up in another scattered order (looking them up in the
+insertion order would favour 'chain', whose entries are allocated in that
+order). The loops are in C, to measure the hash tables rather than
+the Python conversions; the memory per entry is the growth of the live GC
+memory. 10**8 entries need ~8GB of RAM for 'chain'. Usage:
+
+    python bench/dict_engines.py [N...]
+"""
+
+import sys
+import time
+import cffi
+import py
+from shm import gclib
+from shm.sharedmem import sharedmem
+from shm.pyffi import PyFFI
+from shm.dict import DictType
+
+LIBCFU = py.path.local(__file__).dirpath('..', 'shm', 'libcfu')
+
+ffi = cffi.FFI()
+ffi.cdef("""
+    void fill(int open, void *ht, long n);
+    long lookup(int open, void *ht, long n);
+""")
+lib = ffi.verify("""
+    #include "cfuhash.h"
+    #include "openhash.h"
+
+    /* primes, coprime with n: i*STEP % n visits all the numbers below n
+       in a scattered order.  The keys are spread by an odd multiplier */
+    #define STEP 2654435761UL
+    #define LOOKUP_STEP 40503UL
+    #define KEY(i, n) ((void *)(((i) * STEP % (n)) * 0xff51afd7ed558ccdUL))
+
+    void fill(int open, void *ht, long n)
+    {
+        long i;
+        for (i = 0; i < n; i++) {
+            void *key = KEY(i, n);
+            if (open)
+                openhash_put_data(ht, key, 0, key, 0, NULL);
+            else
+                cfuhash_put_data(ht, key, 0, key, 0, NULL);
+        }
+    }
+
+    long lookup(int open, void *ht, long n)
+    {
+        long i, found = 0;
+        void *r;
+        for (i = 0; i < n; i++) {
+            void *key = KEY(i * LOOKUP_STEP % n, n);
+            if (open)
+                found += openhash_get_data(ht, key, 0, &r, NULL);
+            else
+                found += cfuhash_get_data(ht, key, 0, &r, NULL);
+        }
+        return found;
+    }
+""", sources=[str(LIBCFU.join('cfuhash.c')), str(LIBCFU.join('openhash.c'))],
+     include_dirs=[str(LIBCFU)], extra_compile_args=['-O2'])
+
+def measure(pyffi, engine, n):
+    gclib.collect()
+    before = gclib.stats()['used_size']
+    DT = DictType(pyffi, 'long', 'long', engine=engine)
+    d = DT()
+    open = (engine == 'open')
+    a = time.time()
+    lib.fill(open, d.ht, n)
+    b = time.time()
+    found = lib.lookup(open, d.ht, n)
+    c = time.time()
+    gclib.collect()
+    memory = gclib.stats()['used_size'] - before
+    assert found == len(d) == n
+    return (b-a)/n, (c-b)/n, float(memory)/n
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [10**6, 10**7, 10**8]
+    sharedmem.init('/cffi-shm-bench')
+    pyffi = PyFFI(cffi.FFI())
+    print '%10s %8s %10s %10s %14s' % ('entries', 'engine', 'put (ns)',
+                                       'get (ns)', 'bytes/entry')
+    for n in sizes:
+        for engine in ('chain', 'open'):
+            put, get, memory = measure(pyffi, engine, n)
+            print '%10d %8s %10.1f %10.1f %14.1f' % (n, engine, put*1e9,
+                                                     get*1e9, memory)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
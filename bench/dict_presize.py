@@ -0,0 +1,134 @@
+"""
+Measure what presizing a dict saves when it is bulk loaded.
+
+A dict of ``N`` long keys is filled from empty, and then again after
+``reserve(N)``, which is what ``DictType(expected_size=N)`` does. The table
+reports the number of rehashes, the bytes allocated while filling it (in
+total and at peak: during a rehash both bucket arrays are alive) and the
+time. The tables use a malloc function which counts the bytes and calls the
+GC one, and the fill loop is in C, like in dict_engines.py. Usage:
+
+    python bench/dict_presize.py [N...]
+"""
+
+import sys
+import time
+import cffi
+import py
+from shm import gclib
+from shm.sharedmem import sharedmem
+from shm.pyffi import PyFFI
+from shm.dict import DictType
+
+LIBCFU = py.path.local(__file__).dirpath('..', 'shm', 'libcfu')
+
+ffi = cffi.FFI()
+ffi.cdef("""
+    void setup(void *gc_malloc, void *gc_free);
+    void *new_table(int open);
+    void fill(int open, void *ht, long n);
+    extern size_t allocated, live, peak;
+""")
+lib = ffi.verify("""
+    #include "cfuhash.h"
+    #include "openhash.h"
+
+    size_t allocated, live, peak;
+    static cfuhash_malloc_fn_t gc_malloc;
+    static cfuhash_free_fn_t gc_free;
+
+    /* the size is stored before the block, to count the frees */
+    static void *counting_malloc(size_t size)
+    {
+        size_t *p = gc_malloc(size + 16);
+        if (!p)
+            return NULL;
+        p[0] = size;
+        allocated += size;
+        live += size;
+        if (live > peak)
+            peak = live;
+        return p + 2;
+    }
+
+    static void counting_free(void *ptr)
+    {
+        size_t *p = (size_t *)ptr - 2;
+        live -= p[0];
+        gc_free(p);
+    }
+
+    void setup(void *malloc_fn, void *free_fn)
+    {
+        gc_malloc = malloc_fn;
+        gc_free = free_fn;
+        allocated = live = peak = 0;
+    }
+
+    /* the same flags as DictType('long', 'long') */
+    void *new_table(int open)
+    {
+        if (open) {
+            openhash_table_t *ht = openhash_new_with_malloc_fn(counting_malloc,
+                                                               counting_free);
+            openhash_set_flag(ht, OPENHASH_NOCOPY_KEYS);
+            return ht;
+        }
+        else {
+            cfuhash_table_t *ht = cfuhash_new_with_malloc_fn(counting_malloc,
+                                                             counting_free);
+            cfuhash_set_flag(ht, CFUHASH_NO_LOCKING | CFUHASH_NOCOPY_KEYS);
+            return ht;
+        }
+    }
+
+    void fill(int open, void *ht, long n)
+    {
+        long i;
+        for (i = 0; i < n; i++) {
+            void *key = (void *)(i * 0xff51afd7ed558ccdUL);
+            if (open)
+                openhash_put_data(ht, key, 0, key, 0, NULL);
+            else
+                cfuhash_put_data(ht, key, 0, key, 0, NULL);
+        }
+    }
+""", sources=[str(LIBCFU.join('cfuhash.c')), str(LIBCFU.join('openhash.c'))],
+     include_dirs=[str(LIBCFU)], extra_compile_args=['-O2'])
+
+def measure(pyffi, engine, n, presize):
+    htlib = DictType(pyffi, 'long', 'long', engine=engine).htlib
+    open = (engine == 'open')
+    gclib.collect()
+    with sharedmem.gc_disabled:
+        lib.setup(sharedmem.get_GC_malloc(), sharedmem.get_GC_free())
+        a = time.time()
+        ht = lib.new_table(open)
+        if presize:
+            htlib.reserve(ht, n)
+        lib.fill(open, ht, n)
+        b = time.time()
+        assert htlib.num_entries(ht) == n
+        rehashes = htlib.num_rehashes(ht)
+        htlib.destroy(ht)
+    return rehashes, lib.allocated, lib.peak, b-a
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [10**5, 10**6, 10**7]
+    sharedmem.init('/cffi-shm-bench')
+    pyffi = PyFFI(cffi.FFI())
+    print '%10s %8s %8s %9s %15s %10s %9s' % (
+        'entries', 'engine', 'presize', 'rehashes', 'allocated (MB)',
+        'peak (MB)', 'time (s)')
+    for n in sizes:
+        for engine in ('chain', 'open'):
+            for presize in (False, True):
+                rehashes, allocated, peak, t = measure(pyffi, engine, n,
+                                                       presize)
+                print '%10d %8s %8s %9d %15.1f %10.1f %9.3f' % (
+                    n, engine, presize, rehashes, allocated / 1e6,
+                    peak / 1e6, t)
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compare the pause times of full and minor collections.
+
+The heap is made of ``N`` long-lived small objects, plus a few young objects
+allocated between two collections; some of the old objects are updated to
+point to young ones. Usage:
+
+    python bench/gc_generational.py [N] [YOUNG]
+"""
+
+import sys
+import time
+import cffi
+from shm import gclib
+
+def build_heap(ffi, n, fanout=1000):
+    arrays = []
+    for i in range(0, n, fanout):
+        arr = gclib.new_array(ffi, 'void*', fanout)
+        for j in range(fanout):
+            arr[j] = gclib.lib.GC_malloc(32)
+        arrays.append(arr)
+    return arrays
+
+def mutate(heap, young):
+    for i in range(young):
+        obj = gclib.lib.GC_malloc(32)
+        if i % 10 == 0:
+            arr = heap[i % len(heap)]
+            arr[i % len(arr)] = obj
+
+def measure(heap, young, collect, repeat=5):
+    best = None
+    for i in range(repeat):
+        with gclib.disabled:
+            mutate(heap, young)
+        a = time.time()
+        collect()
+        b = time.time()
+        if best is None or b-a < best:
+            best = b-a
+    return best
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    young = int(sys.argv[2]) if len(sys.argv) > 2 else 10**4
+    gclib.init('/cffi-shm-bench')
+    ffi = cffi.FFI()
+    with gclib.disabled:
+        heap = build_heap(ffi, n)
+    print 'heap: %d old objects, %d young objects' % (n, young)
+    print '%8s %12s' % ('kind', 'pause (ms)')
+    print '%8s %12.2f' % ('full', measure(heap, young, gclib.collect)*1000)
+    gclib.set_generational(True)
+    gclib.collect()
+    print '%8s %12.2f' % ('minor', measure(heap, young, gclib.collect_minor)*1000)
+    gclib.set_generational(False)
+
+if __name__ == '__main__':
+    main()
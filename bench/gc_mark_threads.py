@@ -0,0 +1,50 @@
+"""
+Measure the GC pause time against the number of marking threads.
+
+The synthetic heap is made of ``N`` small objects, reachable from rooted
+arrays of pointers, plus some garbage. Usage:
+
+    python bench/gc_mark_threads.py [N] [THREADS...]
+"""
+
+import sys
+import time
+import cffi
+from shm import gclib
+
+def build_heap(ffi, n, fanout=1000):
+    arrays = []
+    for i in range(0, n, fanout):
+        arr = gclib.new_array(ffi, 'void*', fanout)
+        for j in range(fanout):
+            arr[j] = gclib.lib.GC_malloc(32)
+            gclib.lib.GC_malloc(32) # garbage
+        arrays.append(arr)
+    return arrays
+
+def measure(n, repeat=5):
+    best = None
+    for i in range(repeat):
+        a = time.time()
+        gclib.collect()
+        b = time.time()
+        if best is None or b-a < best:
+            best = b-a
+    return best
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    threads = map(int, sys.argv[2:]) or [1, 2, 4, 8]
+    gclib.init('/cffi-shm-bench')
+    ffi = cffi.FFI()
+    with gclib.disabled:
+        heap = build_heap(ffi, n)
+    print 'heap: %d objects' % n
+    print '%8s %12s' % ('threads', 'pause (ms)')
+    for t in threads:
+        gclib.set_mark_threads(t)
+        print '%8d %12.2f' % (t, measure(n)*1000)
+    gclib.set_mark_threads(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Measure the cost of adding and clearing GC roots.
+
+``N`` objects are rooted and then released, in FIFO or random order; the
+root table grows while they are added and shrinks while they are
+released. Usage:
+
+    python bench/gc_roots.py [N...]
+"""
+
+import sys
+import time
+import random
+import cffi
+from shm import gclib
+
+def measure(ffi, n, shuffle):
+    objs = [gclib.lib.GC_malloc(16) for i in range(n)]
+    a = time.time()
+    ptrs = [gclib.roots.add(ffi, ffi.cast('void*', obj)) for obj in objs]
+    b = time.time()
+    if shuffle:
+        random.shuffle(ptrs)
+    c = time.time()
+    del ptrs[:]
+    d = time.time()
+    return (b-a)/n, (d-c)/n
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [10**4, 10**5, 10**6]
+    gclib.init('/cffi-shm-bench')
+    ffi = cffi.FFI()
+    print '%8s %8s %12s %12s' % ('roots', 'order', 'add (us)', 'clear (us)')
+    for n in sizes:
+        for shuffle in (False, True):
+            with gclib.disabled:
+                add, clear = measure(ffi, n, shuffle)
+            order = 'random' if shuffle else 'fifo'
+            print '%8d %8s %12.2f %12.2f' % (n, order, add*1e6, clear*1e6)
+    print 'root table size: %d' % gclib.roots.gcroots.mem_size
+
+if __name__ == '__main__':
+    main()
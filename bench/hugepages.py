@@ -0,0 +1,63 @@
+"""
+Compare the dict lookup throughput with and without huge pages.
+
+A dict of ``N`` long keys is filled and then looked up in random order, so
+that most lookups touch a different page. Each mode runs in its own process,
+since it must be chosen before the GC memory is created. The modes are
+``none``, ``thp`` and ``hugetlb:PATH``, where ``PATH`` is a file in a mounted
+hugetlbfs (e.g. ``hugetlb:/dev/hugepages/cffi-shm-bench``). Usage:
+
+    python bench/hugepages.py [N] [MODE...]
+"""
+
+import sys
+import time
+import random
+import subprocess
+
+def child(mode, n, repeat=3):
+    import cffi
+    from shm import gclib
+    from shm.sharedmem import sharedmem
+    from shm.dict import DictType
+    from shm.pyffi import PyFFI
+    if mode.startswith('hugetlb:'):
+        sharedmem.init(mode[len('hugetlb:'):], hugepages='hugetlb')
+    elif mode == 'thp':
+        sharedmem.init('/cffi-shm-bench', hugepages='thp')
+    else:
+        sharedmem.init('/cffi-shm-bench')
+    DT = DictType(PyFFI(cffi.FFI()), 'long', 'long')
+    d = DT()
+    with gclib.disabled:
+        for i in range(n):
+            d[i] = i
+    keys = range(n)
+    random.shuffle(keys)
+    best = None
+    for i in range(repeat):
+        a = time.time()
+        for key in keys:
+            d[key]
+        b = time.time()
+        if best is None or b-a < best:
+            best = b-a
+    print '%20s %8s %12.2f' % (mode, gclib.get_hugepages(), n/best/1e6)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        return
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    modes = sys.argv[2:] or ['none', 'thp']
+    print 'dict: %d keys' % n
+    print '%20s %8s %12s' % ('mode', 'in use', 'Mlookups/s')
+    sys.stdout.flush()
+    for mode in modes:
+        ret = subprocess.call([sys.executable, __file__, '--child', mode, str(n)])
+        if ret != 0:
+            print '%20s failed' % mode
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -109,6 +109,10 @@ class GenericTypePtr(AbstractConverter):
 
 
 class String(AbstractConverter):
+    def __init__(self, ffi, ctype, sharedmem=sharedmem):
+        AbstractConverter.__init__(self, ffi, ctype)
+        self.sharedmem = sharedmem
+
     def to_python_impl(self, cdata):
         if cdata == self.ffi.NULL:
             return None
@@ -118,7 +122,7 @@ class String(AbstractConverter):
         if s is None:
             return self.ffi.NULL
         if ensure_shm:
-            return sharedmem.new_string(s)
+            return self.sharedmem.new_string(s)
         else:
             return s
 
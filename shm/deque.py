@@ -3,7 +3,6 @@ Implement a shm deque on top of a shm list.
 So far, only .append() and .popleft() are implemented.
 """
 
-from shm.sharedmem import sharedmem
 from shm.list import ListType, ResizableList
 
 class DequeType(ListType):
@@ -29,28 +28,42 @@ class Deque(ResizableList):
         oldsize = lst.size
         if newsize <= lst.size:
             return
-        newitems = sharedmem.new_array(t.ffi, t.itemtype, newsize)
-        i = lst.offset
-        for j in xrange(lst.length):
-            newitems[j] = self.typeditems[i]
-            i += 1
-            if i == oldsize:
-                i = 0
+        # the items keep their index in the new array: then, we only need to
+        # move the shorter of the two parts around the wrap point. The new
+        # array is complete before it replaces the old one
+        newitems = self._new_items(newsize)
+        offset = lst.offset
+        wrapped = offset + lst.length - oldsize
+        if wrapped > 0:
+            tail = oldsize - offset
+            if wrapped <= tail and oldsize + wrapped <= newsize:
+                src, dst, n = 0, oldsize, wrapped
+            else:
+                src, dst, n = offset, newsize - tail, tail
+                offset = dst
+            itemsize = t.ffi.sizeof(t.itemtype)
+            items = t.ffi.cast(t.itemtype_ptr, newitems)
+            t.ffi.memmove(items + dst, items + src, n * itemsize)
+            # clear the slots which are not used anymore, so that they do not
+            # keep objects alive
+            nbytes = (min(src + n, dst) - src) * itemsize
+            t.ffi.buffer(items + src, nbytes)[:] = '\0' * nbytes
         lst.items = newitems
         lst.size = newsize
-        lst.offset = 0
+        lst.offset = offset
 
     def popleft(self):
         if len(self) == 0:
             raise IndexError
         i = self._itemindex(0)
         res = self._getitem(i)
-        if self.listtype.itemtype_is_pointer:
-            self.typeditems[i] = self.listtype.ffi.NULL
-        #
-        offset = self.lst.offset + 1
-        if offset >= self.lst.size:
-            offset -= self.lst.size
-        self.lst.offset = offset
-        self.lst.length -= 1
+        with self.seqlock:
+            if self.listtype.itemtype_is_pointer:
+                self.typeditems[i] = self.listtype.ffi.NULL
+            #
+            offset = self.lst.offset + 1
+            if offset >= self.lst.size:
+                offset -= self.lst.size
+            self.lst.offset = offset
+            self.lst.length -= 1
         return res
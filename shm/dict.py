@@ -1,13 +1,73 @@
 import py
 import cffi
-from shm.sharedmem import sharedmem
+from array import array
 from shm.pyffi import AbstractGenericType
-from shm.libcfu import cfuffi, cfuhash
-from shm.util import cffi_is_string, cffi_is_struct_ptr, cffi_is_struct
-
+from shm.libcfu import cfuffi, cfuhash, openhash
+from shm.seqlock import ShmSeqLock
+from shm.converter import Primitive, Double
+from shm.util import (cffi_is_string, cffi_is_struct_ptr, cffi_is_struct,
+                      cffi_typeof, ctype_array_of)
+
+
+# the hash table implementations: 'chain' is cfuhash, which uses separate
+# chaining, 'open' is openhash, which uses open addressing and stores all the
+# entries in a single array
+ENGINES = {
+    'chain': (cfuhash, 'cfuhash_table_t*'),
+    'open': (openhash, 'openhash_table_t*'),
+    }
+
+# the typecodes of the array.array returned by get_many()
+ARRAY_TYPECODES = {
+    'signed char': 'b', 'unsigned char': 'B',
+    'short': 'h', 'unsigned short': 'H',
+    'int': 'i', 'unsigned int': 'I',
+    'long': 'l', 'unsigned long': 'L',
+    'double': 'd',
+    }
+
+def word_array_type(ffi, t, conv):
+    """
+    Return the array type whose items have the same bits as the void* which
+    conv.to_voidp() makes out of them (e.g. 'long[]' and 'double[]'), or
+    None. The batched methods use it to convert the keys and the values at
+    once.
+    """
+    if type(conv) not in (Primitive, Double):
+        return None
+    if ffi.sizeof(t) != ffi.sizeof('void*'):
+        return None
+    return ctype_array_of(ffi, t)
+
+def array_typecode(ffi, t, conv):
+    """
+    Return the array.array typecode for the values of type t, or None
+    """
+    if type(conv) not in (Primitive, Double):
+        return None
+    return ARRAY_TYPECODES.get(cffi_typeof(ffi, t).cname)
+
+def words_to_array(words, count, typecode, same_bits):
+    """
+    Convert the first ``count`` void* of ``words``, made by to_voidp(), to an
+    array.array of ``typecode``. If not ``same_bits``, they are smaller
+    integers which to_voidp() extended to a long.
+    """
+    raw = cfuffi.buffer(words, count * cfuffi.sizeof('void*'))[:]
+    if not same_bits:
+        raw = array('l', raw)
+    return array(typecode, raw)
 
 class DictType(AbstractGenericType):
-    def __init__(self, pyffi, keytype, valuetype, default_factory=None):
+    def __init__(self, pyffi, keytype, valuetype, default_factory=None,
+                 engine='chain', expected_size=None, load_factor=None):
+        if engine not in ENGINES:
+            raise ValueError('Unknown dict engine: %r' % (engine,))
+        self.engine = engine
+        self.htlib, self.httype = ENGINES[engine]
+        # the defaults for __call__()
+        self.expected_size = expected_size
+        self.load_factor = self._check_load_factor(load_factor)
         self.pyffi = pyffi
         self.ffi = pyffi.ffi
         self.nocopy = False # by default, keys are copied
@@ -15,7 +75,8 @@ class DictType(AbstractGenericType):
         self.keytype = keytype
         self.valuetype = valuetype
         self.default_factory = default_factory
-        if cffi_is_string(self.ffi, keytype):
+        self.string_keys = cffi_is_string(self.ffi, keytype)
+        if self.string_keys:
             self.keysize = self.ffi.cast('size_t', -1)
         elif cffi_is_struct_ptr(self.ffi, keytype):
             self.nocopy = True
@@ -36,22 +97,68 @@ class DictType(AbstractGenericType):
         #
         self.keyconverter = pyffi.get_converter(keytype, allow_structs_byval=True)
         self.valueconverter = pyffi.get_converter(valuetype)
+        self.key_arraytype = word_array_type(self.ffi, keytype,
+                                             self.keyconverter)
+        self.value_arraytype = word_array_type(self.ffi, valuetype,
+                                               self.valueconverter)
+        self.key_typecode = array_typecode(self.ffi, keytype,
+                                           self.keyconverter)
+        self.value_typecode = array_typecode(self.ffi, valuetype,
+                                             self.valueconverter)
 
     def __repr__(self):
         return '<shm type dict [%s: %s]>' % (self.keytype, self.valuetype)
 
-    def __call__(self, init=None, root=True):
+    def _check_load_factor(self, load_factor):
+        if load_factor is None:
+            return None
+        # the open addressing engine needs at least one empty slot
+        if load_factor <= 0 or (self.engine == 'open' and load_factor >= 1):
+            raise ValueError('Invalid load factor for the %r engine: %r' %
+                             (self.engine, load_factor))
+        return float(load_factor)
+
+    def __call__(self, init=None, root=True, expected_size=None,
+                 load_factor=None):
+        """
+        Create a new dict, optionally filled with the items of ``init``.
+
+        ``expected_size`` presizes the hash table for that many entries, so
+        that filling it does not rehash; by default, it is ``len(init)``.
+        ``load_factor`` is the number of entries per bucket (or slot, for the
+        'open' engine) above which the table grows; it shrinks below a third
+        of it.
+        """
+        sharedmem = self.pyffi.sharedmem
+        htlib = self.htlib
+        if expected_size is None:
+            expected_size = self.expected_size
+        if expected_size is None and hasattr(init, '__len__'):
+            expected_size = len(init)
+        if load_factor is None:
+            load_factor = self.load_factor
+        else:
+            load_factor = self._check_load_factor(load_factor)
         with sharedmem.gc_disabled:
-            ptr = cfuhash.new_with_malloc_fn(sharedmem.get_GC_malloc(),
-                                             sharedmem.get_GC_free())
-        cfuhash.set_flag(ptr, cfuhash.NO_LOCKING)
+            ptr = htlib.new_with_malloc_fn(sharedmem.get_GC_malloc(),
+                                           sharedmem.get_GC_free())
+        htlib.set_flag(ptr, cfuhash.NO_LOCKING)
+        # the removed entries are reclaimed by the GC, not freed while
+        # optimistic readers may still use them
+        htlib.set_flag(ptr, cfuhash.LOCKFREE_READERS)
         if self.nocopy:
-            cfuhash.set_flag(ptr, cfuhash.NOCOPY_KEYS)
+            htlib.set_flag(ptr, cfuhash.NOCOPY_KEYS)
         if self.key_fieldspec:
-            cfuhash.set_key_fieldspec(ptr, self.key_fieldspec.getptr())
+            htlib.set_key_fieldspec(ptr, self.key_fieldspec.getptr(sharedmem))
+            htlib.set_key_type(ptr, self.key_fieldspec.type_id)
+        if load_factor is not None:
+            htlib.set_thresholds(ptr, load_factor / 3, load_factor)
+        if expected_size:
+            with sharedmem.gc_disabled:
+                htlib.reserve(ptr, expected_size)
         #
         if root:
-            ptr = sharedmem.roots.add(cfuffi, ptr)
+            ptr = sharedmem.add_root(cfuffi, ptr)
         # NOTE: it is very important that we call _from_ht and not
         # from_pointer, because the latter does a cast, which means that the
         # original cdata to which we attached the root is destroied, and thus
@@ -62,7 +169,7 @@ class DictType(AbstractGenericType):
         return d
 
     def from_pointer(self, ptr):
-        ht = cfuffi.cast('cfuhash_table_t*', ptr)
+        ht = cfuffi.cast(self.httype, ptr)
         return self._from_ht(ht)
 
     def _from_ht(self, ht):
@@ -91,20 +198,59 @@ class DictInstance(object):
     def as_cdata(self):
         return self.ht
 
+    @property
+    def version(self):
+        """
+        A counter which is incremented by every modification: readers can
+        compare it with a previous value to know whether the dict changed.
+        """
+        return self.dictype.htlib.version(self.ht)
+
+    @property
+    def seqlock(self):
+        """
+        The ShmSeqLock which the hash table holds while modifying the dict.
+        """
+        try:
+            return self._seqlock
+        except AttributeError:
+            self._seqlock = ShmSeqLock.from_pointer(
+                self.dictype.htlib.seqlock(self.ht))
+            return self._seqlock
+
+    def optimistic_read(self, fn, *args):
+        """
+        Call fn(*args) without taking any lock, retrying until it did not
+        run concurrently with a modification of the dict. The memory which
+        the dict removes is reclaimed by the GC instead of being freed at
+        once, so fn can safely follow the pointers it reads meanwhile. E.g.:
+
+            value = d.optimistic_read(d.get, 'key')
+        """
+        return self.seqlock.read(fn, *args)
+
     def _key(self, key):
         key = self.dictype.keyconverter.from_python(key, ensure_shm=False)
         return self.dictype.keyconverter.to_voidp(key)
 
     def __len__(self):
-        return cfuhash.num_entries(self.ht)
+        return self.dictype.htlib.num_entries(self.ht)
+
+    def reserve(self, n):
+        """
+        Grow the hash table so that it can hold ``n`` entries in total
+        without rehashing. It never shrinks the table.
+        """
+        self.dictype.htlib.reserve(self.ht, n)
 
     def _getitem(self, ckey, honor___missing__=False):
         # the different between __getitem__ and _getitem is that the first
         # calls __missing__ when the key is not found, which triggers a
         # different behaviour in defaultdicts
         t = self.dictype
-        key = self._key(ckey)
-        ret = cfuhash.get_data(self.ht, key, t.keysize,
+        with t.pyffi.sharedmem.scratch():
+            key = self._key(ckey)
+            ret = t.htlib.get_data(self.ht, key, t.keysize,
                                    self.retbuffer, cfuffi.NULL)
         if ret == 0:
             if honor___missing__:
@@ -126,17 +272,20 @@ class DictInstance(object):
         key = self._key(key)
         value = t.valueconverter.from_python(value)
         value = t.valueconverter.to_voidp(value)
-        cfuhash.put_data(self.ht, key, t.keysize, value, 0, cfuffi.NULL)
+        ret = t.htlib.put_data(self.ht, key, t.keysize, value, 0, cfuffi.NULL)
+        if ret < 0:
+            raise MemoryError
 
     def __contains__(self, key):
         t = self.dictype
-        key = self._key(key)
-        return bool(cfuhash.exists_data(self.ht, key, t.keysize))
+        with t.pyffi.sharedmem.scratch():
+            key = self._key(key)
+            return bool(t.htlib.exists_data(self.ht, key, t.keysize))
 
     def __delitem__(self, key):
         t = self.dictype
         key = self._key(key)
-        ret = cfuhash.delete_data(self.ht, key, t.keysize)
+        ret = t.htlib.delete_data(self.ht, key, t.keysize)
         if ret == t.ffi.NULL:
             raise KeyError(key)
 
@@ -157,6 +306,110 @@ class DictInstance(object):
             del self[key]
         return ret
 
+    def _key_array(self, keys):
+        """
+        Return a 'void*[]' with the C keys, and the objects which must be
+        kept alive while it is used
+        """
+        t = self.dictype
+        if t.key_arraytype is not None:
+            keyarray = t.ffi.new(t.key_arraytype, keys)
+            return cfuffi.cast('void**', keyarray), keyarray
+        arr = cfuffi.new('void*[]', len(keys))
+        if t.string_keys and all(type(key) is str and '\0' not in key
+                                 for key in keys):
+            # copy all the strings at once, and split them in C
+            buf = cfuffi.new('char[]', '\0'.join(keys))
+            cfuhash._lib.split_strings(buf, cfuffi.cast('char**', arr),
+                                       len(keys))
+            return arr, buf
+        keepalive = []
+        for i, key in enumerate(keys):
+            key = self._key(key)
+            if isinstance(key, str):
+                key = cfuffi.new('char[]', key)
+                keepalive.append(key)
+            arr[i] = key
+        return arr, keepalive
+
+    def get_many(self, keys, default=None):
+        """
+        Look up all the ``keys`` with a single call to C, and return their
+        values in the same order; the missing ones are ``default``.
+
+        If the values are C numbers, the result is an array.array (which
+        supports the buffer protocol, e.g. for numpy.frombuffer), else a
+        list. Since an array cannot contain None, a missing key raises
+        KeyError unless a ``default`` is given.
+        """
+        t = self.dictype
+        keys = list(keys)
+        n = len(keys)
+        values = cfuffi.new('void*[]', n)
+        found = cfuffi.new('char[]', n)
+        with t.pyffi.sharedmem.scratch():
+            karr, keepalive = self._key_array(keys)
+            count = t.htlib.get_many(self.ht, karr, t.keysize, n, values, found)
+        found = bytearray(cfuffi.buffer(found))
+        if t.value_typecode is not None:
+            res = words_to_array(values, n, t.value_typecode,
+                                 t.value_arraytype is not None)
+        else:
+            conv = t.valueconverter
+            res = [conv.to_python(conv.from_voidp(values[i])) if found[i]
+                   else None for i in range(n)]
+        if count < n:
+            for i, flag in enumerate(found):
+                if not flag:
+                    if default is None and t.value_typecode is not None:
+                        raise KeyError(keys[i])
+                    res[i] = default
+        return res
+
+    def contains_many(self, keys):
+        """
+        Return a list of bools, telling whether each of ``keys`` is in the
+        dict. Like get_many(), it does a single call to C.
+        """
+        t = self.dictype
+        keys = list(keys)
+        n = len(keys)
+        found = cfuffi.new('char[]', n)
+        with t.pyffi.sharedmem.scratch():
+            karr, keepalive = self._key_array(keys)
+            t.htlib.get_many(self.ht, karr, t.keysize, n, cfuffi.NULL, found)
+        return map(bool, bytearray(cfuffi.buffer(found)))
+
+    def put_many(self, pairs):
+        """
+        Like update(), but convert all the keys and values first and insert
+        them with a single call to C.
+        """
+        t = self.dictype
+        if hasattr(pairs, 'keys'):
+            pairs = pairs.items()
+        pairs = list(pairs)
+        n = len(pairs)
+        if not n:
+            return
+        keys = [key for key, value in pairs]
+        values = [value for key, value in pairs]
+        karr, keepalive = self._key_array(keys)
+        if t.value_arraytype is not None:
+            values = t.ffi.new(t.value_arraytype, values)
+            varr = cfuffi.cast('void**', values)
+        else:
+            # keep alive the converted values (e.g. the strings in shared
+            # memory) until they are referenced by the dict
+            conv = t.valueconverter
+            values = [conv.from_python(value) for value in values]
+            varr = cfuffi.new('void*[]', n)
+            for i, value in enumerate(values):
+                varr[i] = conv.to_voidp(value)
+        count = t.htlib.put_many(self.ht, karr, t.keysize, varr, n)
+        if count > n: # (size_t)-1, the allocation failed
+            raise MemoryError
+
     def update(self, d):
         if hasattr(d, 'keys'):
             items = d.items()
@@ -165,41 +418,91 @@ class DictInstance(object):
         for key, value in items:
             self[key] = value
 
+    # the number of entries which the iterators fetch with each call to C
+    ITER_CHUNK = 256
+
+    def _iterchunks(self, with_values):
+        """
+        Walk the hash table in chunks of ITER_CHUNK entries, and yield the
+        lists of their keys and values (None if not with_values). The entries
+        are not looked up again and the memory used does not depend on the
+        size of the dict.
+
+        Each chunk is read again if it runs concurrently with a write. As
+        for Python dicts, the values can be changed during the iteration,
+        but RuntimeError is raised if entries are added or removed, or if
+        the table is resized.
+        """
+        t = self.dictype
+        n = self.ITER_CHUNK
+        cursor = cfuffi.new('size_t[2]')
+        keys = cfuffi.new('void*[]', n)
+        values = cfuffi.new('void*[]', n) if with_values else cfuffi.NULL
+        kconv = t.keyconverter
+        vconv = t.valueconverter
+        htlib = t.htlib
+        ht = self.ht
+
+        def read_chunk(position):
+            cursor[0], cursor[1] = position
+            shape = htlib.num_entries(ht), htlib.num_rehashes(ht)
+            count = htlib.next_entries(ht, cursor, keys, values, n)
+            if t.key_typecode is not None:
+                pykeys = words_to_array(keys, count, t.key_typecode,
+                                        t.key_arraytype is not None).tolist()
+            else:
+                pykeys = [kconv.to_python(keys[i], force_cast=True)
+                          for i in range(count)]
+            if not with_values:
+                pyvalues = None
+            elif t.value_typecode is not None:
+                pyvalues = words_to_array(values, count, t.value_typecode,
+                                          t.value_arraytype is not None)
+                pyvalues = pyvalues.tolist()
+            else:
+                pyvalues = [vconv.to_python(vconv.from_voidp(values[i]))
+                            for i in range(count)]
+            return shape, pykeys, pyvalues
+
+        position = (0, 0)
+        first_shape = None
+        while True:
+            shape, pykeys, pyvalues = self.seqlock.read(read_chunk, position)
+            if first_shape is None:
+                first_shape = shape
+            elif shape != first_shape:
+                raise RuntimeError('dict changed size during iteration')
+            if not pykeys:
+                return
+            position = cursor[0], cursor[1]
+            yield pykeys, pyvalues
+
+    def iterkeys(self):
+        for keys, _ in self._iterchunks(False):
+            for key in keys:
+                yield key
+
+    def itervalues(self):
+        for _, values in self._iterchunks(True):
+            for value in values:
+                yield value
+
+    def iteritems(self):
+        for keys, values in self._iterchunks(True):
+            for item in zip(keys, values):
+                yield item
+
     def __iter__(self):
-        return iter(self.keys())
+        return self.iterkeys()
 
     def keys(self):
-        t = self.dictype
-        sizeptr = cfuffi.new('size_t[1]')
-        keys_array = cfuhash.keys(self.ht, sizeptr, True)
-        if keys_array == cfuffi.NULL:
-            raise MemoryError
-        try:
-            size = sizeptr[0]
-            keys = []
-            for i in range(size):
-                key = keys_array[i]
-                key = t.keyconverter.to_python(key, force_cast=True)
-                keys.append(key)
-            return keys
-        finally:
-            cfuhash._lib.free(keys_array)
+        return self.optimistic_read(lambda: list(self.iterkeys()))
 
     def values(self):
-        vals = []
-        for k in self.keys():
-            vals.append(self[k])
-        return vals
+        return self.optimistic_read(lambda: list(self.itervalues()))
 
     def items(self):
-        res = []
-        for k in self.keys():
-            res.append((k, self[k]))
-        return res
-
-    iterkeys = keys
-    itervalues = values
-    iteritems = items
+        return self.optimistic_read(lambda: list(self.iteritems()))
 
 class DefaultDictInstance(DictInstance):
 
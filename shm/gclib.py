@@ -1,4 +1,8 @@
+import sys
 import os.path
+import time
+import threading
+import functools
 import py
 import cffi
 from shm.util import cffi_typeof
@@ -16,21 +20,62 @@ GCDIR = ROOTDIR.join('GC')
 #
 # To be more robust, we ensure that the cwd is ROOTDIR.
 
-old_cwd = ROOTDIR.chdir()
-
-gcffi = cffi.FFI()
-gcffi.cdef("""
+GC_CDEF = """
     bool GC_init(const char* path);    /* GC fully initialized */
     bool GC_open(const char* parth);   /* GC memory mmaped, but cannot allocate */
     bool GC_isptr(void* ptr);
     void* GC_get_memory(void);
     size_t GC_get_memsize(void);
     void* GC_malloc(size_t size);
+    void* GC_malloc_atomic(size_t size);
+    uint16_t GC_register_layout(size_t size, const size_t *offsets, size_t n);
+    void* GC_malloc_layout(size_t size, uint16_t layout);
     void* GC_realloc(void* ptr, size_t size);
+    size_t GC_size(void* ptr);
     void GC_free(void *ptr);
     void GC_collect(void);
+    void GC_collect_minor(void);
     long GC_total_collections(void);
+    bool GC_set_mark_threads(size_t n);
+    size_t GC_get_mark_threads(void);
+    void GC_set_lazy_sweep(bool enabled);
+    size_t GC_sweep_pending(size_t max);
+    bool GC_set_generational(bool enabled);
+    #define GC_HUGEPAGES_NONE ...
+    #define GC_HUGEPAGES_THP ...
+    #define GC_HUGEPAGES_HUGETLB ...
+    bool GC_set_hugepages(int mode);
+    int GC_get_hugepages(void);
+    bool GC_enable_threads(void);
+    bool GC_register_thread(void);
+    void GC_gen_invalidate(void);
+    size_t GC_get_extents(struct gc_extent_s *extents, size_t n);
+    size_t GC_prefetch(void **roots, size_t nroots,
+                       const struct gc_extent_s *extents, size_t nextents);
+
+    #define GC_STATS_PAUSES ...
+    struct gc_stats_s {
+        long collections;
+        long minor_collections;
+        double last_mark_init_time;
+        double last_mark_time;
+        double last_sweep_time;
+        double last_pause_time;
+        double total_mark_init_time;
+        double total_mark_time;
+        double total_sweep_time;
+        double total_pause_time;
+        size_t used_size;
+        size_t total_size;
+        size_t alloc_size;
+        size_t trigger_size;
+        size_t madvise_pages;
+        double pauses[...];
+    };
+    void GC_get_stats(struct gc_stats_s *stats);
     bool GC_root(void* ptr, size_t size);
+    bool GC_dynamic_root(void** ptrptr, size_t* sizeptr, size_t elemsize);
+    bool GC_remove_dynamic_root(void** ptrptr);
     void GC_enable(void);
     void GC_disable(void);
 
@@ -45,26 +90,63 @@ gcffi.cdef("""
     free_fn get_GC_free(void);
 
     char *strncpy(char *dest, const char *src, size_t n);
+    void *memset(void *s, int c, size_t n);
 
     const int PROT_NONE;
     const int PROT_READ;
     const int PROT_WRITE;
     const int PROT_EXEC;
     int mprotect(void *addr, size_t len, int prot);
+    const int MADV_WILLNEED;
+    int madvise(void *addr, size_t length, int advice);
+    int mlock(const void *addr, size_t len);
 
+    struct gc_extent_s {
+        void* start;
+        size_t size;
+    };
+    typedef struct {
+        size_t count;
+        size_t size;
+        struct gc_extent_s* items;
+    } gclib_extents_t;
     typedef struct {
         long magic;
         const char* path;
         void* rwmem;
-        size_t rwmem_size;
+        gclib_extents_t* extents;
     } gclib_info_t;
+    typedef struct rwchunk_s {
+        struct rwchunk_s* next;
+        size_t size;
+    } rwchunk_t;
 
+    typedef struct {
+        unsigned int count;
+        unsigned int tag;
+    } gcroots_info_t;
     typedef struct {
         void** mem;
         size_t mem_size;
-        size_t i;
+        gcroots_info_t* info;
+        size_t used;
+        long lock;
+        void** old_mem;
+        size_t old_size;
     } gcroots_t;
-""")
+
+    int gcroots_add(gcroots_t* roots, void* ptr, unsigned int tag);
+    void gcroots_release(gcroots_t* roots, void* ptr);
+    bool gcroots_resize(gcroots_t* roots, void** mem, gcroots_info_t* info,
+                        size_t size);
+    void gcroots_count_tags(gcroots_t* roots, size_t* counts, size_t ntags);
+
+    typedef struct {
+        void** mem;
+        size_t size;
+        size_t used;
+    } gcscope_t;
+"""
 
 ## import distutils.log
 ## distutils.log.set_verbosity(1)
@@ -76,8 +158,7 @@ gcffi.cdef("""
 GC_path = 'GC'
 #GC_path = os.path.abspath(GC_path)
 
-lib = gcffi.verify(
-    """
+GC_SOURCE = """
     #include <string.h>
     #include <sys/mman.h>
     #include "gc.h"
@@ -86,281 +167,1099 @@ lib = gcffi.verify(
     typedef void (*free_fn)(void*);
     malloc_fn get_GC_malloc(void) { return GC_malloc_noinline; }
     free_fn   get_GC_free(void)   { return GC_free_noinline; }
+    typedef struct {
+        size_t count;
+        size_t size;
+        struct gc_extent_s* items;
+    } gclib_extents_t;
     typedef struct {
         long magic;
         const char* path;
         void* rwmem;
-        size_t rwmem_size;
+        gclib_extents_t* extents;
     } gclib_info_t;
+    typedef struct rwchunk_s {
+        struct rwchunk_s* next;
+        size_t size;
+    } rwchunk_t;
+    typedef struct {
+        unsigned int count;
+        unsigned int tag;
+    } gcroots_info_t;
     typedef struct {
         void** mem;
         size_t mem_size;
-        size_t i;
+        gcroots_info_t* info;
+        size_t used;
+        long lock;
+        void** old_mem;
+        size_t old_size;
     } gcroots_t;
 
-    """,
-    include_dirs = ['GC'],
-    #extra_compile_args = ['-g', '-O0'],
-    extra_link_args = ['-Wl,-rpath,%s' % GC_path, '-LGC', '-lshmgc', '-lrt'],
-)
-old_cwd.chdir()
+    /* A root table is a hash set of pointers with linear probing: mem[i] is
+       a rooted pointer (or NULL), and info[i] tells how many times it has
+       been rooted and the tag of its first root. mem_size is a power of 2,
+       and the table is never more than half full. The lock is a spinlock, so
+       that it works also for tables in the shared memory.
+    */
+    static void gcroots_lock(gcroots_t* roots)
+    {
+        while (__atomic_exchange_n(&roots->lock, 1, __ATOMIC_ACQUIRE))
+            ;
+    }
+
+    static void gcroots_unlock(gcroots_t* roots)
+    {
+        __atomic_store_n(&roots->lock, 0, __ATOMIC_RELEASE);
+    }
+
+    static size_t gcroots_hash(void* ptr, size_t size)
+    {
+        uint64_t h = ((uintptr_t)ptr >> 4) * 0x9E3779B97F4A7C15ull;
+        return (size_t)(h >> 32) & (size-1);
+    }
+
+    static size_t gcroots_find(void** mem, size_t size, void* ptr)
+    {
+        size_t i = gcroots_hash(ptr, size);
+        while (mem[i] != NULL && mem[i] != ptr)
+            i = (i+1) & (size-1);
+        return i;
+    }
+
+    /* Return -1 if the table must grow first */
+    int gcroots_add(gcroots_t* roots, void* ptr, unsigned int tag)
+    {
+        size_t i;
+        gcroots_lock(roots);
+        i = gcroots_find(roots->mem, roots->mem_size, ptr);
+        if (roots->mem[i] == NULL) {
+            if ((roots->used+1)*2 > roots->mem_size) {
+                gcroots_unlock(roots);
+                return -1;
+            }
+            roots->info[i].count = 0;
+            roots->info[i].tag = tag;
+            roots->mem[i] = ptr;
+            roots->used++;
+        }
+        roots->info[i].count++;
+        gcroots_unlock(roots);
+        return 0;
+    }
+
+    /* The destructor of all the cdata returned by GcRootCollection.add() */
+    void gcroots_release(gcroots_t* roots, void* ptr)
+    {
+        size_t size, i, j, k;
+        gcroots_lock(roots);
+        size = roots->mem_size;
+        i = gcroots_find(roots->mem, size, ptr);
+        if (roots->mem[i] == NULL || --roots->info[i].count > 0) {
+            gcroots_unlock(roots);
+            return;
+        }
+        /* backward shift deletion: move back the entries of the same probe
+           sequence. An entry is copied before its old slot is reused, so
+           the GC always sees it */
+        for (j = (i+1) & (size-1); roots->mem[j] != NULL; j = (j+1) & (size-1)) {
+            k = gcroots_hash(roots->mem[j], size);
+            if (i <= j ? (i < k && k <= j) : (i < k || k <= j))
+                continue;
+            roots->info[i] = roots->info[j];
+            roots->mem[i] = roots->mem[j];
+            i = j;
+        }
+        roots->mem[i] = NULL;
+        roots->used--;
+        gcroots_unlock(roots);
+    }
+
+    /* Rehash the roots into 'mem' and 'info' of 'size' slots */
+    bool gcroots_resize(gcroots_t* roots, void** mem, gcroots_info_t* info,
+                        size_t size)
+    {
+        size_t k, i;
+        gcroots_lock(roots);
+        if (roots->used*2 > size) {
+            gcroots_unlock(roots);
+            return false;
+        }
+        memset(mem, 0, size*sizeof(void*));
+        for (k = 0; k < roots->mem_size; k++) {
+            if (roots->mem[k] == NULL)
+                continue;
+            i = gcroots_find(mem, size, roots->mem[k]);
+            mem[i] = roots->mem[k];
+            info[i] = roots->info[k];
+        }
+        /* a collection can happen at any point: the old table stays a root
+           until the new one is published, and the GC must never see a size
+           bigger than the memory */
+        __atomic_store_n(&roots->old_mem, roots->mem, __ATOMIC_RELEASE);
+        __atomic_store_n(&roots->old_size, roots->mem_size, __ATOMIC_RELEASE);
+        if (size > roots->mem_size) {
+            __atomic_store_n(&roots->mem, mem, __ATOMIC_RELEASE);
+            __atomic_store_n(&roots->mem_size, size, __ATOMIC_RELEASE);
+        }
+        else {
+            __atomic_store_n(&roots->mem_size, size, __ATOMIC_RELEASE);
+            __atomic_store_n(&roots->mem, mem, __ATOMIC_RELEASE);
+        }
+        roots->info = info;
+        __atomic_store_n(&roots->old_size, 0, __ATOMIC_RELEASE);
+        __atomic_store_n(&roots->old_mem, NULL, __ATOMIC_RELEASE);
+        gcroots_unlock(roots);
+        return true;
+    }
+
+    void gcroots_count_tags(gcroots_t* roots, size_t* counts, size_t ntags)
+    {
+        size_t k;
+        gcroots_lock(roots);
+        for (k = 0; k < roots->mem_size; k++) {
+            if (roots->mem[k] != NULL && roots->info[k].tag < ntags)
+                counts[roots->info[k].tag] += roots->info[k].count;
+        }
+        gcroots_unlock(roots);
+    }
+
+    /* The roots of the RootScopes of a thread: the GC scans the first
+       'used' items of mem */
+    typedef struct {
+        void** mem;
+        size_t size;
+        size_t used;
+    } gcscope_t;
+
+    """
+
+# Several independent heaps can be used at the same time: heap N is a copy of
+# libshmgc built with GC_HEAP=N (see gc.h and the Makefile), so it has its own
+# memory, placed HEAP_STRIDE bytes after the one of heap N-1
+HEAP_STRIDE = 0x40000000000
+MAX_HEAPS = 4
+
+def _build_lib(index):
+    ffi = cffi.FFI()
+    ffi.cdef(GC_CDEF)
+    if index == 0:
+        libname = 'shmgc'
+        define_macros = []
+    else:
+        libname = 'shmgc-%d' % index
+        define_macros = [('GC_HEAP', str(index))]
+    old_cwd = ROOTDIR.chdir()
+    try:
+        lib = ffi.verify(
+            GC_SOURCE,
+            include_dirs = ['GC'],
+            define_macros = define_macros,
+            #extra_compile_args = ['-g', '-O0'],
+            extra_link_args = ['-Wl,-rpath,%s' % GC_path, '-LGC', '-l' + libname,
+                               '-lrt'],
+        )
+    finally:
+        old_cwd.chdir()
+    return ffi, lib
 
-def sanity_check():
+def sanity_check(ffi, lib):
     # check that GC_malloc()&co. are placed immediately after the GC data
-    gc_area_start = int(gcffi.cast('long', lib.GC_get_memory()))
+    gc_area_start = int(ffi.cast('long', lib.GC_get_memory()))
     gc_area_end = gc_area_start + lib.GC_get_memsize()
-    GC_malloc_addr = int(gcffi.cast('long', lib.get_GC_malloc()))
+    GC_malloc_addr = int(ffi.cast('long', lib.get_GC_malloc()))
     offset = GC_malloc_addr - gc_area_end
     # if the offset is >1MB, it probably means that the lib was placed
     # somewhere else
     assert 0 < offset < 1024**2, 'The GC library does not seem to be at the proper location in memory. Check the linker script.'
 
-sanity_check()
 
-def init(path):
-    if path.count('/') != 1:
-        raise OSError('%r should contain exactly one slash' % path)
-    ret = lib.GC_init(path)
-    if not ret:
-        raise OSError('Failed to initialized the shm GC')
-    #
-    if init.gc_info is None:
-        init.gc_info = allocate_gc_info(path) # to keep it alive
-init.gc_info = None
-
-
-GC_INFO_ADDRESS = 0x1100000000
+GC_INFO_ADDRESS = 0x1100000000 # of the default heap
 GC_INFO_MAGIC = 0x1234ABCDEF
 RW_MEM_SIZE = 1024*1024 # 1 MB
-#
-def allocate_gc_info(path):
-    gc_info = new(gcffi, 'gclib_info_t*')
-    gc_info_addr = gcffi.cast('long', gc_info)
-    if int(gc_info_addr) != GC_INFO_ADDRESS:
-        # if this happens, it probably means that the size of gc_struct has
-        # changed and the GC allocates it in a new bucket. Simply change the
-        # value of GC_INFO_ADDRESS accordingly
-        raise ValueError("The gc_info struct was supposed to be allocated "
-                         "at the addres 0x%x, got 0x%x" %
-                         (GC_INFO_ADDRESS, gc_info_addr))
-    gc_info.magic = GC_INFO_MAGIC
-    gc_info.path = new_string(path, root=False)
-    #
-    # allocate a RW area
-    gc_info.rwmem = lib.GC_malloc(RW_MEM_SIZE)
-    gc_info.rwmem_size = RW_MEM_SIZE
-    rw_allocator.init(gc_info.rwmem, gc_info.rwmem_size)
-    return gc_info
-
-def get_gc_info():
-    return gcffi.cast('gclib_info_t*', GC_INFO_ADDRESS)
-
-
-def open_readonly(path):
-    if path.count('/') != 1:
-        raise OSError('%r should contain exactly one slash' % path)
-    ret = lib.GC_open(path)
-    if not ret:
-        raise OSError('Failed to open the shm GC')
-    #
-    # sanity check
-    gc_info = get_gc_info()
-    if gc_info.magic != GC_INFO_MAGIC:
-        raise ValueError("The gc_info global does not seem to be at the address 0x%x, "
-                         "or it has been corrupted" % GC_INFO_ADDRESS)
-    #
-    # now, we need to enable writing to the RW part of the memory
-    protect_GC_memory(lib.PROT_READ)
-
-
-def protect_GC_memory(prot):
+
+def _pointer_offsets(ffi, ctype, base=0):
     """
-    Protect the GC memory with the desired level of permission. This is useful
-    to temporarily protect the memory against writing or reading, in case you
-    need a lock to get access to it.
+    Return the offsets of the pointer fields of ``ctype``, or None if we
+    cannot know them (e.g. for unions).
+    """
+    if ctype.kind == 'pointer':
+        return [base]
+    elif ctype.kind in ('primitive', 'enum', 'function'):
+        # function pointers point to code, not to GC memory
+        return []
+    elif ctype.kind == 'array' and ctype.length is not None:
+        itemsize = ffi.sizeof(ctype.item)
+        offsets = _pointer_offsets(ffi, ctype.item)
+        if offsets is None:
+            return None
+        return [base + i*itemsize + offset
+                for i in range(ctype.length) for offset in offsets]
+    elif ctype.kind == 'struct':
+        result = []
+        for name, field in ctype.fields:
+            if field.bitsize != -1:
+                continue # bitfields cannot hold a pointer
+            offsets = _pointer_offsets(ffi, field.type, base + field.offset)
+            if offsets is None:
+                return None
+            result += offsets
+        return result
+    return None
 
-    Note that the RW area is not affected by this: it needs to always remain
-    both readable and writable, because this is were mutexes reside.
+class Heap(object):
     """
-    gc_info = get_gc_info()
-    if prot == lib.PROT_NONE:
-        # if we are going to set PROT_NONE, we need to read the rwmem pointer
-        # BEFORE, else we segfault
-        rwmem = gc_info.rwmem
-        rwmem_size = gc_info.rwmem_size
-    #
-    # protect the whole GC memory
-    mem = lib.GC_get_memory()
-    size = lib.GC_get_memsize()
-    _mprotect(mem, size, prot)
-    #
-    if prot != lib.PROT_NONE:
-        # if we set at least PROT_READ, we can now safely read the rwmem pointer
-        rwmem = gc_info.rwmem
-        rwmem_size = gc_info.rwmem_size
-    # protect the RW memory
-    _mprotect(rwmem, rwmem_size, lib.PROT_READ | lib.PROT_WRITE)
-
-
-def _mprotect(mem, size, prot):
-    ret = lib.mprotect(mem, size, prot)
-    if ret != 0:
-        raise OSError("mprotect failed: error code: %d" % ret)
-    return ret
-
-def _malloc(size, rw):
-    if rw:
-        return rw_allocator.malloc(size)
-    else:
-        return lib.GC_malloc(size)
-
-def new(ffi, t, root=True, rw=False):
-    ctype = cffi_typeof(ffi, t)
-    if ctype.kind != 'pointer':
-        raise TypeError("Expected a pointer, got '%s'" % t)
-    ptr = _malloc(ffi.sizeof(ctype.item), rw)
-    if ptr == ffi.NULL:
-        raise MemoryError
-    res = ffi.cast(ctype, ptr)
-    if root:
-        res = roots.add(ffi, res, ctype)
-    return res
-
-def new_array(ffi, t, n, root=True, rw=False):
-    ptr = _malloc(ffi.sizeof(t) * n, rw)
-    res = ffi.cast("%s[%d]" % (t, n) , ptr)
-    if root:
-        res = roots.add(ffi, res, '%s[]' % t)
-    return res
-
-def new_string(s, root=True):
-    size = len(s)+1
-    ptr = lib.GC_malloc(size)
-    # XXX: this does one extra copy, because s is copied to a temp buffer to
-    # pass to strncpy. I don't know how to avoid it, though
-    lib.strncpy(ptr, s, size)
-    ptr = gcffi.cast('char*', ptr)
-    if root:
-        ptr = roots.add(gcffi, ptr, '<string>')
-    return ptr
-
-def realloc_array(ffi, t, ptr, n):
-    ptr = lib.GC_realloc(ptr, ffi.sizeof(t) * n)
-    return ffi.cast("%s[%d]" % (t, n) , ptr)
-
-
-collect = lib.GC_collect
-total_collections = lib.GC_total_collections
-enable = lib.GC_enable
-disable = lib.GC_disable
-isptr = lib.GC_isptr
+    A GC heap, with its own memory, roots and RW area. Use get_heap() to get
+    the heap number ``index``; the functions of this module operate on the
+    default heap, i.e. heap 0.
+
+    The collections of a heap scan only its own roots and memory, so an
+    object must not be referenced only by objects of another heap.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.ffi, self.lib = _build_lib(index)
+        sanity_check(self.ffi, self.lib)
+        self.gc_info_address = GC_INFO_ADDRESS + index*HEAP_STRIDE
+        self.gc_info = None
+        self._attach_stats = dict(attach_time=0.0, attach_willneed_size=0,
+                                  attach_prefetch_size=0, attach_mlock_size=0)
+        self._layouts = {}
+        self._rw_chunks_count = 0
+        # the GC keeps scanning the registered root collections: keep them
+        # alive
+        self._registered_roots = []
+        self._scopes = threading.local()
+        self.rw_allocator = RWAllocator(self)
+        self.roots = GcRootCollection(heap=self)
+        self.disabled = Disabled(self)
+        #
+        lib = self.lib
+        self.collect = lib.GC_collect
+        self.total_collections = lib.GC_total_collections
+        self.enable = lib.GC_enable
+        self.disable = lib.GC_disable
+        self.isptr = lib.GC_isptr
+        self.get_mark_threads = lib.GC_get_mark_threads
+        # with lazy sweeping, collect() only marks: each region is swept when
+        # we allocate from it for the first time, and sweep_pending() sweeps
+        # the remaining ones and returns their free pages to the OS (e.g. when
+        # idle)
+        self.set_lazy_sweep = lib.GC_set_lazy_sweep
+        self.collect_minor = lib.GC_collect_minor
+
+    def __repr__(self):
+        return '<shm heap %d>' % self.index
+
+    def init(self, path, hugepages=None):
+        """
+        Create the GC memory. ``hugepages`` is None, 'thp' (or True) to ask
+        for transparent huge pages, or 'hugetlb' to back the memory with
+        explicit huge pages: in this case ``path`` is the absolute path of a
+        file in a mounted hugetlbfs. See GC_set_hugepages() in gc.h.
+        """
+        self._set_hugepages(path, hugepages)
+        ret = self.lib.GC_init(path)
+        if not ret:
+            raise OSError('Failed to initialized the shm GC')
+        #
+        if self.gc_info is None:
+            self.gc_info = self.allocate_gc_info(path) # to keep it alive
+
+    def allocate_gc_info(self, path):
+        ffi = self.ffi
+        gc_info = self.new(ffi, 'gclib_info_t*')
+        gc_info_addr = ffi.cast('long', gc_info)
+        if int(gc_info_addr) != self.gc_info_address:
+            # if this happens, it probably means that the size of gc_struct has
+            # changed and the GC allocates it in a new bucket. Simply change the
+            # value of GC_INFO_ADDRESS accordingly
+            raise ValueError("The gc_info struct was supposed to be allocated "
+                             "at the addres 0x%x, got 0x%x" %
+                             (self.gc_info_address, gc_info_addr))
+        gc_info.magic = GC_INFO_MAGIC
+        gc_info.path = self.new_string(path, root=False)
+        #
+        # allocate a RW area: more chunks are chained to it when it is full
+        gc_info.rwmem = self.lib.GC_malloc(RW_MEM_SIZE)
+        self.rw_allocator.init(gc_info.rwmem, RW_MEM_SIZE)
+        #
+        # the extents are published by publish_extents()
+        gc_info.extents = self.new(ffi, 'gclib_extents_t*', root=False)
+        return gc_info
+
+    def publish_extents(self):
+        """
+        Publish the extents of the used memory, for the processes which open
+        it in read-only mode: see open_readonly(). Call it after allocating
+        the data they are going to read. Return the number of extents.
+
+        The extents are only a hint: a reader which runs concurrently might
+        see a partially updated table.
+        """
+        ffi, lib = self.ffi, self.lib
+        extents = self.get_gc_info().extents
+        n = lib.GC_get_extents(extents.items, extents.size)
+        if n > extents.size:
+            size = n*2
+            items = self.new_array(ffi, 'struct gc_extent_s', size, root=False,
+                                   atomic=True)
+            n = min(lib.GC_get_extents(items, size), size)
+            extents.count = 0
+            extents.items = items
+            extents.size = size
+        extents.count = n
+        return n
+
+    def _published_extents(self):
+        extents = self.get_gc_info().extents
+        n = min(extents.count, extents.size)
+        return extents.items, n
+
+    def get_gc_info(self):
+        return self.ffi.cast('gclib_info_t*', self.gc_info_address)
+
+    def open_readonly(self, path, willneed=False, prefetch=(), mlock=False,
+                      hugepages=None):
+        """
+        Open the GC memory in read-only mode. The options control how the
+        memory is brought in, using the extents of the used memory published
+        by the writer (see publish_extents()):
+
+          - hugepages: None, 'thp' or 'hugetlb', as for init(); 'hugetlb'
+            is needed if and only if the writer used it
+
+          - willneed: start reading all the used memory (MADV_WILLNEED)
+
+          - prefetch: a list of objects, cdata or addresses: read all the
+            memory which is reachable from them, e.g. from the containers
+            we are going to use
+
+          - mlock: lock all the used memory in RAM
+
+        The time spent is reported in stats()['attach_time'].
+        """
+        start = time.time()
+        self._set_hugepages(path, hugepages)
+        ret = self.lib.GC_open(path)
+        if not ret:
+            raise OSError('Failed to open the shm GC')
+        #
+        # sanity check
+        gc_info = self.get_gc_info()
+        if gc_info.magic != GC_INFO_MAGIC:
+            raise ValueError("The gc_info global does not seem to be at the "
+                             "address 0x%x, or it has been corrupted" %
+                             self.gc_info_address)
+        #
+        # now, we need to enable writing to the RW part of the memory
+        self.protect_GC_memory(self.lib.PROT_READ)
+        #
+        lib = self.lib
+        items, n = self._published_extents()
+        stats = self._attach_stats
+        for i in range(n):
+            ext = items[i]
+            if willneed:
+                lib.madvise(ext.start, ext.size, lib.MADV_WILLNEED)
+                stats['attach_willneed_size'] += ext.size
+        if prefetch:
+            self.prefetch(*prefetch)
+        if mlock:
+            for i in range(n):
+                ext = items[i]
+                if lib.mlock(ext.start, ext.size) != 0:
+                    raise OSError("mlock failed: error code: %d" %
+                                  self.ffi.errno)
+                stats['attach_mlock_size'] += ext.size
+        stats['attach_time'] = time.time() - start
+
+    def prefetch(self, *objs):
+        """
+        Read all the memory which is reachable from ``objs``, so that it is
+        faulted in. Each obj can be a wrapper with an ``as_cdata()`` method
+        (e.g. a shm dict, list or struct), a cdata pointer or an address.
+        Return the total size of the objects read.
+        """
+        ffi = self.ffi
+        roots = ffi.new('void*[]', len(objs))
+        for i, obj in enumerate(objs):
+            if hasattr(obj, 'as_cdata'):
+                obj = obj.as_cdata()
+            roots[i] = ffi.cast('void*', obj)
+        items, n = self._published_extents()
+        size = self.lib.GC_prefetch(roots, len(objs), items, n)
+        self._attach_stats['attach_prefetch_size'] += size
+        return size
+
+    def protect_GC_memory(self, prot):
+        """
+        Protect the GC memory with the desired level of permission. This is
+        useful to temporarily protect the memory against writing or reading,
+        in case you need a lock to get access to it.
+
+        Note that the RW area is not affected by this: it needs to always
+        remain both readable and writable, because this is were mutexes
+        reside.
+        """
+        lib = self.lib
+        lib.GC_gen_invalidate()
+        gc_info = self.get_gc_info()
+        if prot == lib.PROT_NONE:
+            # if we are going to set PROT_NONE, we need to read the rwmem
+            # pointer BEFORE, else we segfault
+            rwchunks = self._rw_chunks(gc_info)
+        #
+        # protect the whole GC memory
+        mem = lib.GC_get_memory()
+        size = lib.GC_get_memsize()
+        self._mprotect(mem, size, prot)
+        #
+        if prot != lib.PROT_NONE:
+            # if we set at least PROT_READ, we can now safely read the rwmem
+            # pointer
+            rwchunks = self._rw_chunks(gc_info)
+        # protect the RW memory
+        for rwmem, rwmem_size in rwchunks:
+            self._mprotect(rwmem, rwmem_size, lib.PROT_READ | lib.PROT_WRITE)
+        self._rw_chunks_count = len(rwchunks)
+
+    def _rw_chunks(self, gc_info):
+        chunks = []
+        chunk = self.ffi.cast('rwchunk_t*', gc_info.rwmem)
+        while chunk != self.ffi.NULL:
+            chunks.append((chunk, chunk.size))
+            chunk = chunk.next
+        return chunks
+
+    def refresh_rw_area(self):
+        """
+        Make writable the chunks which were added to the RW area after the
+        last call to protect_GC_memory(), e.g. by the RW process after we
+        opened the memory in read-only mode. The GC memory must be at least
+        readable.
+        """
+        lib = self.lib
+        rwchunks = self._rw_chunks(self.get_gc_info())
+        for rwmem, rwmem_size in rwchunks[self._rw_chunks_count:]:
+            self._mprotect(rwmem, rwmem_size, lib.PROT_READ | lib.PROT_WRITE)
+        self._rw_chunks_count = len(rwchunks)
+
+    def _mprotect(self, mem, size, prot):
+        ret = self.lib.mprotect(mem, size, prot)
+        if ret != 0:
+            raise OSError("mprotect failed: error code: %d" % ret)
+        return ret
+
+    def _malloc(self, size, rw, atomic=False, layout=0):
+        if rw:
+            return self.rw_allocator.malloc(size)
+        elif atomic:
+            return self.lib.GC_malloc_atomic(size)
+        elif layout:
+            return self.lib.GC_malloc_layout(size, layout)
+        else:
+            return self.lib.GC_malloc(size)
+
+    def _get_layout(self, ffi, ctype):
+        """
+        Return ``(atomic, layout)`` for allocating arrays of ``ctype``: if the
+        type contains no pointers, the memory can be atomic; else ``layout``
+        is the id of the GC layout which tells where the pointer fields are,
+        or 0 if the GC must scan the whole memory.
+        """
+        try:
+            return self._layouts[ctype]
+        except KeyError:
+            pass
+        atomic, layout = False, 0
+        if ctype.kind == 'struct':
+            offsets = _pointer_offsets(ffi, ctype)
+            size = ffi.sizeof(ctype)
+            if offsets == []:
+                atomic = True
+            elif offsets is not None and len(offsets) < size // ffi.sizeof('void*'):
+                layout = self.lib.GC_register_layout(size, offsets, len(offsets))
+        self._layouts[ctype] = atomic, layout
+        return atomic, layout
+
+    def new(self, ffi, t, root=True, rw=False):
+        """
+        Allocate an object of type ``t``, which must be a pointer type.
+        Structs are scanned precisely by the GC, i.e. only their pointer
+        fields.
+        """
+        ctype = cffi_typeof(ffi, t)
+        if ctype.kind != 'pointer':
+            raise TypeError("Expected a pointer, got '%s'" % t)
+        atomic, layout = self._get_layout(ffi, ctype.item)
+        ptr = self._malloc(ffi.sizeof(ctype.item), rw, atomic, layout)
+        if ptr == ffi.NULL:
+            raise MemoryError
+        res = ffi.cast(ctype, ptr)
+        if root:
+            res = self.add_root(ffi, res, ctype)
+        return res
+
+    def new_array(self, ffi, t, n, root=True, rw=False, atomic=False):
+        """
+        Allocate an array of ``n`` items of type ``t``. If ``atomic`` is True,
+        the GC does not scan the array for pointers: use it only for items
+        which cannot contain GC pointers, such as numbers. Arrays of structs
+        are scanned precisely, as in new().
+        """
+        layout = 0
+        if not atomic:
+            atomic, layout = self._get_layout(ffi, cffi_typeof(ffi, t))
+        ptr = self._malloc(ffi.sizeof(t) * n, rw, atomic, layout)
+        res = ffi.cast("%s[%d]" % (t, n) , ptr)
+        if root:
+            res = self.add_root(ffi, res, '%s[]' % t)
+        return res
+
+    def new_string(self, s, root=True):
+        size = len(s)+1
+        ptr = self.lib.GC_malloc_atomic(size)
+        # XXX: this does one extra copy, because s is copied to a temp buffer
+        # to pass to strncpy. I don't know how to avoid it, though
+        self.lib.strncpy(ptr, s, size)
+        ptr = self.ffi.cast('char*', ptr)
+        if root:
+            ptr = self.add_root(self.ffi, ptr, '<string>')
+        return ptr
+
+    def realloc_array(self, ffi, t, ptr, n):
+        ptr = self.lib.GC_realloc(ptr, ffi.sizeof(t) * n)
+        return ffi.cast("%s[%d]" % (t, n) , ptr)
+
+    def set_mark_threads(self, n):
+        """
+        Set the number of threads used to mark the heap during a collection.
+        With n == 1, marking is done by the collecting thread only.
+        """
+        if not self.lib.GC_set_mark_threads(n):
+            raise OSError('Cannot use %d threads for marking' % n)
+
+    def sweep_pending(self, max_regions=sys.maxsize):
+        """
+        Sweep at most ``max_regions`` of the regions which have not been
+        swept since the last collection. Return the number of swept regions.
+        """
+        return self.lib.GC_sweep_pending(max_regions)
+
+    def set_generational(self, enabled):
+        """
+        Enable or disable generational collection. When enabled, automatic
+        collections only trace the objects allocated since the previous one
+        (minor collections), with a full collection every few minor ones;
+        writes to the older objects are detected by write-protecting their
+        pages. collect() always does a full collection.
+        """
+        if not self.lib.GC_set_generational(enabled):
+            raise OSError('Cannot enable generational collection')
+
+    _HUGEPAGES_MODES = {None: 'GC_HUGEPAGES_NONE',
+                        False: 'GC_HUGEPAGES_NONE',
+                        True: 'GC_HUGEPAGES_THP',
+                        'thp': 'GC_HUGEPAGES_THP',
+                        'hugetlb': 'GC_HUGEPAGES_HUGETLB'}
+
+    def _set_hugepages(self, path, hugepages):
+        try:
+            mode = getattr(self.lib, self._HUGEPAGES_MODES[hugepages])
+        except KeyError:
+            raise ValueError('Invalid hugepages mode: %r' % (hugepages,))
+        if mode == self.lib.GC_HUGEPAGES_HUGETLB:
+            if not path.startswith('/'):
+                raise OSError('%r should be an absolute path in a hugetlbfs'
+                              % path)
+        elif path.count('/') != 1:
+            raise OSError('%r should contain exactly one slash' % path)
+        if not self.lib.GC_set_hugepages(mode):
+            raise OSError('Cannot set the huge pages mode: %r' % (hugepages,))
+
+    def get_hugepages(self):
+        """
+        Return the huge pages mode in use: None, 'thp' or 'hugetlb'. It is
+        None if transparent huge pages were asked but the kernel refused them.
+        """
+        mode = self.lib.GC_get_hugepages()
+        if mode == self.lib.GC_HUGEPAGES_THP:
+            return 'thp'
+        elif mode == self.lib.GC_HUGEPAGES_HUGETLB:
+            return 'hugetlb'
+        return None
+
+    def enable_threads(self):
+        """
+        Allow GC_malloc and GC_free to be called concurrently from several
+        threads, e.g. from cffi calls which release the GIL. There is no way
+        to go back to single-threaded mode.
+        """
+        if not self.lib.GC_enable_threads():
+            raise OSError('Cannot enable multi-threaded allocation')
+
+    def stats(self):
+        """
+        Return a dictionary with the GC statistics: see ``struct gc_stats_s``
+        in gc.h for the meaning of the fields. Times are in seconds, sizes in
+        bytes. ``pauses`` contains the durations of the most recent
+        collections, oldest first. The ``attach_*`` fields describe what
+        open_readonly() did, ``hugepages`` is the mode from get_hugepages().
+        """
+        ffi, lib = self.ffi, self.lib
+        s = ffi.new('struct gc_stats_s*')
+        lib.GC_get_stats(s)
+        res = {}
+        for name, field in ffi.typeof(s[0]).fields:
+            if name != 'pauses':
+                res[name] = getattr(s, name)
+        n = s.collections
+        first = max(0, n - lib.GC_STATS_PAUSES)
+        res['pauses'] = [s.pauses[i % lib.GC_STATS_PAUSES]
+                         for i in range(first, n)]
+        res.update(self._attach_stats)
+        res['hugepages'] = self.get_hugepages()
+        return res
+
+    def root_scope(self):
+        return RootScope(self)
+
+    def add_root(self, ffi, ptr, einfo='<unknown>'):
+        """
+        Root ``ptr``: if we are inside a RootScope, until its end; else, for
+        as long as the returned cdata is alive.
+        """
+        scope = getattr(self._scopes, 'current', None)
+        if scope is None:
+            return self.roots.add(ffi, ptr, einfo)
+        scope.block.add(ptr)
+        return ptr
+
+    def free_rw(self, ptr):
+        """
+        Free a block allocated with ``rw=True``.
+        """
+        self.rw_allocator.free(ptr)
+
+    def rw_stats(self):
+        """
+        Return a dict with the usage of the RW memory: the number of chunks
+        and their total size, the size of the allocated and of the freed
+        blocks (rounded up to their size class) and the number of allocated
+        blocks.
+        """
+        return self.rw_allocator.stats()
 
 class GcRootCollection(object):
     """
-    For now we allow only a fixed number of roots. In the future, we can make
-    it smarter to grow/shrink automatically.
+    A table of roots, registered as a dynamic root of the GC. Each rooted
+    pointer is stored once, together with a reference count and a small
+    integer tag describing it (see print_extrainfo()): adding and releasing a
+    root are O(1), and no Python object is created per root.
+
+    The table doubles its size when it is half full, and halves it when it
+    is less than 1/8 full when adding a root (but it is never smaller than
+    ``size``).
     """
-    def __init__(self, maxroots, use_shm=False):
+    def __init__(self, size=4096, use_shm=False, heap=None):
+        self.heap = heap = heap or default_heap
+        gcffi = heap.ffi
+        self.use_shm = use_shm
         if use_shm:
-            self.mem = new_array(gcffi, 'void*', maxroots, rw=True)
-            self.gcroots = new(gcffi, 'gcroots_t*', rw=True)
+            self.gcroots = heap.new(gcffi, 'gcroots_t*', root=False, rw=True)
         else:
-            self.mem = gcffi.new('void*[]', maxroots)
             self.gcroots = gcffi.new('gcroots_t*')
-        self.gcroots.i = 0
-        self.gcroots.mem_size = maxroots
-        self.gcroots.mem = self.mem
-        self.extrainfo = [None] * maxroots
-        size = maxroots * gcffi.sizeof('void*')
-        lib.GC_root(self.mem, size)
+        self.gcroots.mem_size = 0
+        self.gcroots.mem = gcffi.NULL
+        self.gcroots.info = gcffi.NULL
+        self.gcroots.used = 0
+        self.gcroots.lock = 0
+        self.gcroots.old_mem = gcffi.NULL
+        self.gcroots.old_size = 0
+        self.mem = self.info = None
+        self._init(size)
+        self._resize(size)
+        # the GC reads the pointers and sizes at each collection
+        for ptrname, sizename in [('mem', 'mem_size'), ('old_mem', 'old_size')]:
+            heap.lib.GC_dynamic_root(gcffi.cast('void**',
+                                           gcffi.addressof(self.gcroots, ptrname)),
+                                gcffi.addressof(self.gcroots, sizename),
+                                gcffi.sizeof('void*'))
+        heap._registered_roots.append(self)
 
     @classmethod
-    def from_pointer(cls, ptr):
+    def from_pointer(cls, ptr, heap=None):
         self = cls.__new__(cls)
-        self.gcroots = gcffi.cast('gcroots_t*', ptr)
+        self.heap = heap or default_heap
+        self.use_shm = True
+        self.gcroots = self.heap.ffi.cast('gcroots_t*', ptr)
         self.mem = self.gcroots.mem
-        self.extrainfo = [None] * self.gcroots.mem_size
+        self.info = self.gcroots.info
+        self._init(self.gcroots.mem_size)
+        self._shrink_at = self.minsize // 8
         return self
 
+    def _init(self, size):
+        self.minsize = size
+        self.lock = threading.Lock()
+        self.tags = ['<unknown>']
+        self.tagids = {'<unknown>': 0}
+        # the destructor of all the cdata returned by add()
+        self.release = functools.partial(self.heap.lib.gcroots_release,
+                                         self.gcroots)
+
     def as_cdata(self):
         return self.gcroots
 
-    def _add(self, ptr, einfo):
-        i = self.gcroots.i
-        while True:
-            if self.mem[i] == gcffi.NULL:
-                break
-            i = (i+1) % self.gcroots.mem_size
-            if i == self.gcroots.i:
-                raise ValueError, 'No more space for GC roots'
+    def __len__(self):
+        return self.gcroots.used
+
+    def _resize(self, size):
+        heap = self.heap
+        gcffi = heap.ffi
+        if self.use_shm:
+            mem = heap.new_array(gcffi, 'void*', size, root=False, rw=True)
+            info = heap.new_array(gcffi, 'gcroots_info_t', size, root=False,
+                                  rw=True)
+            if mem == gcffi.NULL or info == gcffi.NULL:
+                raise MemoryError('No more space for GC roots')
+        else:
+            mem = gcffi.new('void*[]', size)
+            info = gcffi.new('gcroots_info_t[]', size)
+        if not heap.lib.gcroots_resize(self.gcroots, mem, info, size):
+            if self.use_shm:
+                heap.free_rw(mem)
+                heap.free_rw(info)
+            return False
+        if self.use_shm and self.mem is not None:
+            heap.free_rw(self.mem)
+            heap.free_rw(self.info)
+        self.mem = mem
+        self.info = info
+        self._shrink_at = size // 8
+        return True
 
-        self.gcroots.i = i
-        return GcRoot(self, i, ptr, einfo)
+    def _shrink(self):
+        used = self.gcroots.used
+        size = self.gcroots.mem_size
+        while size // 2 >= self.minsize and used < size // 8:
+            size //= 2
+        if size < self.gcroots.mem_size:
+            self._resize(size)
+        else:
+            self._shrink_at = 0
+
+    def _tag(self, einfo):
+        try:
+            return self.tagids[einfo]
+        except KeyError:
+            with self.lock:
+                if einfo not in self.tagids:
+                    self.tagids[einfo] = len(self.tags)
+                    self.tags.append(einfo)
+            return self.tagids[einfo]
+
+    def _add(self, ptr, einfo):
+        lib = self.heap.lib
+        tag = self._tag(einfo)
+        if self.gcroots.used < self._shrink_at or lib.gcroots_add(self.gcroots,
+                                                                 ptr, tag) < 0:
+            # resize the table, then retry
+            with self.lock:
+                if self.gcroots.used < self._shrink_at:
+                    self._shrink()
+                while lib.gcroots_add(self.gcroots, ptr, tag) < 0:
+                    self._resize(self.gcroots.mem_size * 2)
 
     def add(self, ffi, ptr, einfo='<unknown>'):
-        root = self._add(ptr, einfo)
-        return ffi.gc(ptr, root.clear)
+        if ptr == ffi.NULL:
+            return ptr
+        self._add(ptr, einfo)
+        return ffi.gc(ptr, self.release)
 
     def print_extrainfo(self):
-        from collections import Counter
-        mem_size = self.gcroots.mem_size
-        total_roots = len([x for x in self.mem[0:mem_size] if x != gcffi.NULL])
-        d = Counter()
-        for info in self.extrainfo:
-            d[info] += 1
+        ntags = len(self.tags)
+        counts = self.heap.ffi.new('size_t[]', ntags)
+        self.heap.lib.gcroots_count_tags(self.gcroots, counts, ntags)
+        total_roots = sum(counts)
         print 'Total number of roots: %d' % total_roots
-        for info, n in d.most_common():
+        infos = [(counts[i], info) for i, info in enumerate(self.tags)
+                 if counts[i]]
+        infos.sort(key=lambda x: x[0], reverse=True)
+        for n, info in infos:
             print '%40s: %d' % (info, n)
 
-class GcRoot(object):
-    def __init__(self, collection, i, ptr, einfo):
-        self.collection = collection
-        self.i = i
-        self.collection.mem[i] = ptr
-        self.collection.extrainfo[i] = einfo
+class ScopeBlock(object):
+    """
+    A contiguous block of roots, used as a stack by the RootScopes of a
+    thread.
+
+    The block is stored in a thread-local: when the thread exits, it is
+    destroyed and unregisters its root, before its memory is released.
+    """
+    def __init__(self, size=4096, heap=None):
+        self.heap = heap = heap or default_heap
+        gcffi = heap.ffi
+        self.minsize = size
+        self.gcscope = gcffi.new('gcscope_t*')
+        self.mem = gcffi.new('void*[]', size)
+        self.gcscope.mem = self.mem
+        self.gcscope.size = size
+        self.gcscope.used = 0
+        self._ptrptr = gcffi.cast('void**',
+                                  gcffi.addressof(self.gcscope, 'mem'))
+        heap.lib.GC_dynamic_root(self._ptrptr,
+                                 gcffi.addressof(self.gcscope, 'used'),
+                                 gcffi.sizeof('void*'))
+
+    def __del__(self):
+        self.heap.lib.GC_remove_dynamic_root(self._ptrptr)
 
-    def clear(self, ptr):
-        self.collection.mem[self.i] = gcffi.NULL
-        self.collection.extrainfo[self.i] = None
+    def add(self, ptr):
+        used = self.gcscope.used
+        if used == self.gcscope.size:
+            self._resize(used * 2)
+        self.mem[used] = ptr
+        self.gcscope.used = used + 1
 
-roots = GcRootCollection(2**21)
+    def release(self, used):
+        self.gcscope.used = used
+        if used == 0 and self.gcscope.size > self.minsize:
+            self._resize(self.minsize)
+
+    def _resize(self, size):
+        # the GC reads mem and used: it must never see items which have not
+        # been copied yet
+        gcffi = self.heap.ffi
+        mem = gcffi.new('void*[]', size)
+        gcffi.memmove(mem, self.mem, self.gcscope.used * gcffi.sizeof('void*'))
+        self.gcscope.mem = mem
+        self.gcscope.size = size
+        self.mem = mem
+
+class RootScope(object):
+    """
+    Context manager to root many objects at once, e.g. while building a big
+    data structure: inside it, the objects allocated with ``root=True`` are
+    pinned by a single block of roots, instead of getting one root each, and
+    they are all unpinned at the end of the scope. Use promote() to root the
+    objects which must survive the scope.
+    """
+    def __init__(self, heap=None):
+        self.heap = heap = heap or default_heap
+        block = getattr(heap._scopes, 'block', None)
+        if block is None:
+            block = heap._scopes.block = ScopeBlock(heap=heap)
+        self.block = block
+        self.parent = None
+        self.start = None
+
+    def __enter__(self):
+        scopes = self.heap._scopes
+        self.parent = getattr(scopes, 'current', None)
+        self.start = self.block.gcscope.used
+        scopes.current = self
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.heap._scopes.current = self.parent
+        self.block.release(self.start)
+
+    def __len__(self):
+        return self.block.gcscope.used - self.start
+
+    def promote(self, obj, einfo='<unknown>'):
+        """
+        Root ``obj`` beyond the end of the scope. If ``obj`` is a cdata,
+        return a new cdata which keeps it alive, as roots.add() does;
+        otherwise, ``obj`` must be a wrapper with an ``as_cdata()`` method
+        (e.g. a shm dict, list or struct), which is then kept alive for as
+        long as the wrapper is.
+        """
+        gcffi = self.heap.ffi
+        roots = self.heap.roots
+        if isinstance(obj, gcffi.CData):
+            return roots.add(gcffi, obj, einfo)
+        ptr = gcffi.cast('void*', obj.as_cdata())
+        obj._root = roots.add(gcffi, ptr, einfo)
+        return obj
 
 
 class Disabled(object):
+    def __init__(self, heap=None):
+        self.heap = heap or default_heap
+
     def __enter__(self):
-        disable()
+        self.heap.disable()
 
     def __exit__(self, exctype, excvalue, tb):
-        enable()
+        self.heap.enable()
 
-disabled = Disabled()
+class RWAllocator(object):
+    """
+    Allocator for the Read-Write memory, i.e. a chain of chunks starting at
+    gclib_info_t.rwmem. Each chunk begins with a rwchunk_t header.
 
-class DummyAllocator(object):
+    The size of the blocks is rounded up to a power of 2, and each size class
+    has its own free list. When the chunks are full, a new one is allocated
+    from the GC heap and appended to the chain; blocks bigger than 1/4 of
+    RW_MEM_SIZE get a chunk of their own. The chunks are never given back to
+    the GC, but the freed blocks are reused.
     """
-    Very dummy allocator to manage the Read-Write memory.
 
-    It simply bumps a pointer until we finish the space. The allocated memory
-    is never freed. It is not a problem because RW memory should be used very
-    carefully, ideally only for pthread_mutexes, and you should not need many
-    of them.
+    MIN_SIZE = 16
 
-    If you need more space, you can simply augment RW_MEM_SIZE.
-    """
-    
-    def __init__(self):
-        self.start_mem = None
+    def __init__(self, heap=None):
+        self.heap = heap or default_heap
+        self.first_chunk = None
+        self.lock = threading.Lock()
 
     def init(self, mem, size):
-        self.start_mem = mem
-        self.end_mem = mem+size
-        self.last_mem = mem
+        gcffi = self.heap.ffi
+        chunk = gcffi.cast('rwchunk_t*', mem)
+        chunk.next = gcffi.NULL
+        chunk.size = size
+        self.first_chunk = self.last_chunk = chunk
+        self.chunks_size = size
+        self.chunks_count = 1
+        self._set_current(chunk, size)
+        self.free_lists = {} # size class -> list of addresses
+        self.allocated = {}  # address -> size class
 
-    def malloc(self, size):
-        assert self.start_mem is not None
-        mem = self.last_mem
-        if mem+size > self.end_mem:
+    def _set_current(self, chunk, size):
+        gcffi = self.heap.ffi
+        start = int(gcffi.cast('long', chunk))
+        self.cur_mem = start + gcffi.sizeof('rwchunk_t')
+        self.end_mem = start + size
+
+    def _new_chunk(self, size):
+        gcffi = self.heap.ffi
+        mem = self.heap.lib.GC_malloc(size)
+        if mem == gcffi.NULL:
             return gcffi.NULL
-        self.last_mem += size
-        return mem
-        
-rw_allocator = DummyAllocator()
+        chunk = gcffi.cast('rwchunk_t*', mem)
+        chunk.next = gcffi.NULL
+        chunk.size = size
+        self.last_chunk.next = chunk
+        self.last_chunk = chunk
+        self.chunks_size += size
+        self.chunks_count += 1
+        return chunk
+
+    def _size_class(self, size):
+        n = self.MIN_SIZE
+        while n < size:
+            n *= 2
+        return n
+
+    def _bump(self, n):
+        gcffi = self.heap.ffi
+        if n > RW_MEM_SIZE // 4:
+            chunk = self._new_chunk(gcffi.sizeof('rwchunk_t') + n)
+            if chunk == gcffi.NULL:
+                return None
+            return int(gcffi.cast('long', chunk)) + gcffi.sizeof('rwchunk_t')
+        if self.cur_mem + n > self.end_mem:
+            chunk = self._new_chunk(RW_MEM_SIZE)
+            if chunk == gcffi.NULL:
+                return None
+            self._set_current(chunk, RW_MEM_SIZE)
+        addr = self.cur_mem
+        self.cur_mem += n
+        return addr
+
+    def malloc(self, size):
+        assert self.first_chunk is not None
+        gcffi = self.heap.ffi
+        n = self._size_class(size)
+        with self.lock:
+            free_list = self.free_lists.get(n)
+            if free_list:
+                addr = free_list.pop()
+            else:
+                addr = self._bump(n)
+                if addr is None:
+                    return gcffi.NULL
+            self.allocated[addr] = n
+        return gcffi.cast('void*', addr)
+
+    def free(self, ptr):
+        gcffi = self.heap.ffi
+        addr = int(gcffi.cast('long', ptr))
+        with self.lock:
+            n = self.allocated.pop(addr, None)
+            if n is None:
+                raise ValueError('0x%x was not allocated in the RW memory'
+                                 % addr)
+            # the chunks are scanned by the GC: clear the stale pointers
+            self.heap.lib.memset(gcffi.cast('void*', addr), 0, n)
+            self.free_lists.setdefault(n, []).append(addr)
+
+    def stats(self):
+        with self.lock:
+            used_size = sum(self.allocated.itervalues())
+            free_size = sum(n*len(lst) for n, lst in self.free_lists.iteritems())
+            return dict(chunks=self.chunks_count,
+                        total_size=self.chunks_size,
+                        used_size=used_size,
+                        free_size=free_size,
+                        allocations=len(self.allocated))
+
+
+_heaps = {}
+
+def get_heap(index):
+    """
+    Return the heap number ``index``, building its library the first time.
+    """
+    if not 0 <= index < MAX_HEAPS:
+        raise ValueError('Invalid heap index: %r' % (index,))
+    try:
+        return _heaps[index]
+    except KeyError:
+        heap = _heaps[index] = Heap(index)
+        return heap
+
+default_heap = None
+default_heap = get_heap(0)
+
+# the default heap
+gcffi = default_heap.ffi
+lib = default_heap.lib
+roots = default_heap.roots
+rw_allocator = default_heap.rw_allocator
+disabled = default_heap.disabled
+collect = default_heap.collect
+total_collections = default_heap.total_collections
+enable = default_heap.enable
+disable = default_heap.disable
+isptr = default_heap.isptr
+get_mark_threads = default_heap.get_mark_threads
+set_lazy_sweep = default_heap.set_lazy_sweep
+collect_minor = default_heap.collect_minor
+init = default_heap.init
+allocate_gc_info = default_heap.allocate_gc_info
+get_gc_info = default_heap.get_gc_info
+open_readonly = default_heap.open_readonly
+publish_extents = default_heap.publish_extents
+prefetch = default_heap.prefetch
+protect_GC_memory = default_heap.protect_GC_memory
+refresh_rw_area = default_heap.refresh_rw_area
+_rw_chunks = default_heap._rw_chunks
+_get_layout = default_heap._get_layout
+new = default_heap.new
+new_array = default_heap.new_array
+new_string = default_heap.new_string
+realloc_array = default_heap.realloc_array
+set_mark_threads = default_heap.set_mark_threads
+sweep_pending = default_heap.sweep_pending
+set_generational = default_heap.set_generational
+enable_threads = default_heap.enable_threads
+get_hugepages = default_heap.get_hugepages
+stats = default_heap.stats
+add_root = default_heap.add_root
+root_scope = default_heap.root_scope
+free_rw = default_heap.free_rw
+rw_stats = default_heap.rw_stats
@@ -1,16 +1,19 @@
 import py
 import cffi
+import hashlib
 from shm.util import cffi_typeof, cffi_is_struct_ptr, cffi_is_primitive, cffi_is_string
 from shm.util import CNamespace
 from shm.sharedmem import sharedmem
 
 ROOTDIR = py.path.local(__file__).dirpath('..')
+LIBCFU_DIR = ROOTDIR.join('shm', 'libcfu')
 old_cwd = ROOTDIR.chdir()
 
 cfuffi = cffi.FFI()
 cfuffi.cdef("""
     static const int CFUHASH_NOCOPY_KEYS;
     static const int CFUHASH_NO_LOCKING;
+    static const int CFUHASH_LOCKFREE_READERS;
 
     typedef ... cfuhash_table_t;
     typedef unsigned int (*cfuhash_function_t)(const void *key, size_t length);
@@ -31,8 +34,21 @@ cfuffi.cdef("""
 	                 size_t data_size, void **r);
     int cfuhash_exists_data(cfuhash_table_t *ht, const void *key, size_t key_size);
     void * cfuhash_delete_data(cfuhash_table_t *ht, const void *key, size_t key_size);
+    size_t cfuhash_get_many(cfuhash_table_t *ht, void **keys, size_t key_size,
+                            size_t n, void **values, char *found);
+    size_t cfuhash_put_many(cfuhash_table_t *ht, void **keys, size_t key_size,
+                            void **values, size_t n);
     size_t cfuhash_num_entries(cfuhash_table_t *ht);
+    size_t cfuhash_num_buckets(cfuhash_table_t *ht);
+    int cfuhash_is_rehashing(cfuhash_table_t *ht);
+    int cfuhash_reserve(cfuhash_table_t *ht, size_t n);
+    size_t cfuhash_num_rehashes(cfuhash_table_t *ht);
+    int cfuhash_set_thresholds(cfuhash_table_t *ht, float low, float high);
+    unsigned long cfuhash_version(cfuhash_table_t *ht);
+    unsigned long *cfuhash_seqlock(cfuhash_table_t *ht);
     void **cfuhash_keys(cfuhash_table_t *ht, size_t *num_keys, int fast);
+    size_t cfuhash_next_entries(cfuhash_table_t *ht, size_t cursor[2],
+                                void **keys, void **values, size_t max);
 
     int cfuhash_set_hash_function(cfuhash_table_t *ht, cfuhash_function_t hf);
     int cfuhash_set_cmp_function(cfuhash_table_t *ht, cfuhash_cmp_t cmpf);
@@ -66,22 +82,79 @@ cfuffi.cdef("""
     int cfuhash_set_key_fieldspec(cfuhash_table_t *ht, cfuhash_fieldspec_t fs[]);
     int cfuhash_generic_cmp(cfuhash_fieldspec_t fields[], void* key1, void* key2);
     unsigned int cfuhash_generic_hash(cfuhash_fieldspec_t fields[], void* key);
+    unsigned int cfuhash_generic_hash_seeded(cfuhash_fieldspec_t fields[],
+                                             void* key, unsigned int seed);
+
+    typedef unsigned int (*cfuhash_key_hash_t)(const void *key, unsigned int seed);
+    typedef int (*cfuhash_key_cmp_t)(const void *key1, const void *key2);
+    int cfuhash_set_key_type(cfuhash_table_t *ht, unsigned int type_id);
+    int cfuhash_register_key_type(unsigned int type_id, cfuhash_key_hash_t hash,
+                                  cfuhash_key_cmp_t cmp);
+
+    unsigned int cfuhash_hash(const void *key, size_t length, unsigned int seed);
+    unsigned int cfuhash_hash_pointer(const void *key, unsigned int seed);
+
+    /* the open addressing engine, see openhash.h */
+    static const int OPENHASH_NOCOPY_KEYS;
+    typedef ... openhash_table_t;
+
+    openhash_table_t * openhash_new_with_malloc_fn(cfuhash_malloc_fn_t malloc_fn,
+                                                   cfuhash_free_fn_t free_fn);
+    int openhash_destroy(openhash_table_t *ht);
+    unsigned int openhash_set_flag(openhash_table_t *ht, unsigned int new_flag);
+    int openhash_set_key_fieldspec(openhash_table_t *ht, cfuhash_fieldspec_t fs[]);
+    int openhash_set_key_type(openhash_table_t *ht, unsigned int type_id);
+    int openhash_set_thresholds(openhash_table_t *ht, float low, float high);
+    int openhash_get_data(openhash_table_t *ht, const void *key, size_t key_size,
+                          void **r, size_t *data_size);
+    int openhash_exists_data(openhash_table_t *ht, const void *key, size_t key_size);
+    int openhash_put_data(openhash_table_t *ht, const void *key, size_t key_size,
+                          void *data, size_t data_size, void **r);
+    void * openhash_delete_data(openhash_table_t *ht, const void *key, size_t key_size);
+    size_t openhash_get_many(openhash_table_t *ht, void **keys, size_t key_size,
+                             size_t n, void **values, char *found);
+    size_t openhash_put_many(openhash_table_t *ht, void **keys, size_t key_size,
+                             void **values, size_t n);
+    void **openhash_keys(openhash_table_t *ht, size_t *num_keys, int fast);
+    size_t openhash_next_entries(openhash_table_t *ht, size_t cursor[2],
+                                 void **keys, void **values, size_t max);
+    size_t openhash_num_entries(openhash_table_t *ht);
+    size_t openhash_capacity(openhash_table_t *ht);
+    int openhash_reserve(openhash_table_t *ht, size_t n);
+    size_t openhash_num_rehashes(openhash_table_t *ht);
+    unsigned long openhash_version(openhash_table_t *ht);
+    unsigned long *openhash_seqlock(openhash_table_t *ht);
 
     void free(void* ptr); /* stdlib's free */
+    void split_strings(char *buf, char **strings, size_t n);
 """)
 
 lib = cfuffi.verify(
     """
     #include <stdlib.h>
+    #include <string.h>
     #include "cfuhash.h"
+    #include "openhash.h"
+
+    /* store in strings the pointers to the n consecutive null-terminated
+       strings in buf */
+    void split_strings(char *buf, char **strings, size_t n)
+    {
+        size_t i;
+        for (i = 0; i < n; i++) {
+            strings[i] = buf;
+            buf += strlen(buf) + 1;
+        }
+    }
     """,
-    sources = ['shm/libcfu/cfuhash.c'],
+    sources = ['shm/libcfu/cfuhash.c', 'shm/libcfu/openhash.c'],
     include_dirs = ['shm/libcfu'],
     #extra_compile_args = ['-g', '-O0'],
 )
 old_cwd.chdir()
 
 cfuhash = CNamespace(lib, 'cfuhash_')
+openhash = CNamespace(lib, 'openhash_')
 
 class Field(object):
 
@@ -97,14 +170,15 @@ class Field(object):
         self.length = length
         self.length_offset = length_offset
 
-    def get_init_dict(self):
+    def get_init_dict(self, sharedmem=sharedmem):
+        # the name is kept alive by the fieldspec array, see getptr()
         d = {}
-        d['name'] = sharedmem.new_string(self.name)
+        d['name'] = sharedmem.new_string(self.name, root=False)
         d['kind'] = self.kind
         d['offset'] = self.offset
         d['size'] = self.size
         if self.fieldspec is not None:
-            d['fieldspec'] = self.fieldspec.getptr()
+            d['fieldspec'] = self.fieldspec.getptr(sharedmem)
         if self.length is not None:
             d['length'] = self.length
         if self.length_offset is not None:
@@ -119,7 +193,12 @@ class FieldSpec(object):
         self.t = cffi_typeof(ffi, t)
         self.typename = self.t.cname
         self.fields = []
-        self.ptr = None
+        self._ptrs = {} # sharedmem -> array of cfuhash_fieldspec_t
+        self.type_id = 0 # see compile()
+
+    @property
+    def ptr(self):
+        return self._ptrs.get(sharedmem)
 
     _pointer_spec_cache = {}
     @classmethod
@@ -167,17 +246,207 @@ class FieldSpec(object):
         self._add(name, kind, size, **kwargs)
 
     def _add(self, name, kind, size, offset, **kwargs):
-        assert self.ptr is None, 'Cannot add new fields after .getptr()'
+        assert not self._ptrs, 'Cannot add new fields after .getptr()'
         f = Field(name, kind, size, offset, **kwargs)
         self.fields.append(f)
 
 
-    def getptr(self):
-        if self.ptr is not None:
-            return self.ptr
-        self._add('<stop>', cfuhash.fieldspec_stop, 0, 0)
+    def getptr(self, sharedmem=sharedmem):
+        """
+        Return the fieldspec as an array allocated in the heap of
+        ``sharedmem``. It is allocated only once per heap, and it is rooted
+        for as long as the FieldSpec is alive, even if it is first needed
+        inside a RootScope.
+        """
+        ptr = self._ptrs.get(sharedmem)
+        if ptr is not None:
+            return ptr
+        if not self._ptrs:
+            self._add('<stop>', cfuhash.fieldspec_stop, 0, 0)
+        for field in self.fields:
+            if field.fieldspec is not None:
+                field.fieldspec.getptr(sharedmem)
         n = len(self.fields)
-        self.ptr = sharedmem.new_array(cfuffi, 'cfuhash_fieldspec_t', n)
-        for i, field in enumerate(self.fields):
-            self.ptr[i] = field.get_init_dict()
-        return self.ptr
+        with sharedmem.gc_disabled:
+            ptr = sharedmem.new_array(cfuffi, 'cfuhash_fieldspec_t', n,
+                                      root=False)
+            ptr = sharedmem.roots.add(cfuffi, ptr, 'cfuhash_fieldspec_t[]')
+            for i, field in enumerate(self.fields):
+                ptr[i] = field.get_init_dict(sharedmem)
+        self._ptrs[sharedmem] = ptr
+        return ptr
+
+    def compile(self):
+        """
+        Generate and compile C functions which hash and compare the keys
+        described by this fieldspec, instead of interpreting it field by
+        field at every lookup, and register them for the current process.
+        Return the type id to store in the hash tables.
+
+        The id is derived from the C source, so every process which
+        compiles the same type gets the same id: the processes which do
+        not compile it still interpret the fieldspec, with the same results.
+        """
+        if self.type_id:
+            return self.type_id
+        source = KeyFuncsWriter(self).source()
+        type_id = int(hashlib.md5(source).hexdigest()[:8], 16) or 1
+        ffi = cffi.FFI()
+        ffi.cdef("""
+            extern unsigned int (*key_hash_ptr)(const void *key,
+                                                unsigned int seed);
+            extern int (*key_cmp_ptr)(const void *key1, const void *key2);
+        """)
+        klib = ffi.verify(source, include_dirs=[str(LIBCFU_DIR)],
+                          extra_compile_args=['-O2'])
+        hash = cfuffi.cast('cfuhash_key_hash_t',
+                           ffi.cast('intptr_t', klib.key_hash_ptr))
+        cmp = cfuffi.cast('cfuhash_key_cmp_t',
+                          ffi.cast('intptr_t', klib.key_cmp_ptr))
+        if cfuhash.register_key_type(type_id, hash, cmp) != 0:
+            # too many types or an id clash: keep interpreting the fieldspec
+            return 0
+        self._keyfuncs_lib = klib
+        self.type_id = type_id
+        return type_id
+
+
+class KeyFuncsWriter(object):
+    """
+    Write the C source of the key functions for a FieldSpec. Every nested
+    fieldspec gets its own hash_part_N() and cmp_N(), which do the same as
+    generic_hash_part() and cfuhash_generic_cmp() in cfuhash.c with the
+    offsets, sizes and lengths as constants.
+    """
+
+    PROLOGUE = """
+        #include <string.h>
+        #include "cfuhash.h"
+        #include "hashfunc.h"
+
+        static CFU_INLINE uint64_t hash_string(uint64_t hv, const char *s)
+        {
+            return hash_func_part(hv, s, s ? strlen(s) : 0);
+        }
+
+        static CFU_INLINE int strcmp_robust(const char *a, const char *b)
+        {
+            if (a && b)
+                return strcmp(a, b);
+            return CMP(a, b);
+        }
+    """
+
+    EPILOGUE = """
+        static unsigned int key_hash(const void *key, unsigned int seed)
+        {
+            return hash_func_finalize(hash_part_0(hash_func_init(seed), key));
+        }
+
+        static int key_cmp(const void *key1, const void *key2)
+        {
+            return cmp_0(key1, key2);
+        }
+
+        unsigned int (*key_hash_ptr)(const void *, unsigned int) = key_hash;
+        int (*key_cmp_ptr)(const void *, const void *) = key_cmp;
+    """
+
+    def __init__(self, fieldspec):
+        self.root = fieldspec
+        self.specs = [] # the index of each spec is the N of its functions
+
+    def index(self, spec):
+        for i, s in enumerate(self.specs):
+            if s is spec:
+                return i
+        self.specs.append(spec)
+        return len(self.specs) - 1
+
+    def source(self):
+        self.index(self.root)
+        funcs = []
+        i = 0
+        while i < len(self.specs): # write_funcs() appends the nested specs
+            funcs.append(self.write_funcs(i, self.specs[i]))
+            i += 1
+        decls = []
+        for i in range(len(self.specs)):
+            decls.append('static uint64_t hash_part_%d(uint64_t hv, '
+                         'const char *a);' % i)
+            decls.append('static int cmp_%d(const char *a, const char *b);' % i)
+        parts = [str(py.code.Source(self.PROLOGUE)), '\n'.join(decls)]
+        parts += funcs
+        parts.append(str(py.code.Source(self.EPILOGUE)))
+        return '\n\n'.join(parts) + '\n'
+
+    def write_funcs(self, i, spec):
+        hashlines = ['static uint64_t hash_part_%d(uint64_t hv, const char *a)' % i,
+                     '{',
+                     '    if (!a)',
+                     '        return hv;']
+        cmplines = ['static int cmp_%d(const char *a, const char *b)' % i,
+                    '{',
+                    '    if (!(a && b))',
+                    '        return CMP(a, b);']
+        for f in spec.fields:
+            if f.kind == cfuhash.fieldspec_stop:
+                continue
+            hashlines.append('    /* %s */' % f.name)
+            cmplines.append('    /* %s */' % f.name)
+            if f.kind == cfuhash.primitive:
+                hashlines.append('    hv = hash_func_part(hv, a + %d, %d);' %
+                                 (f.offset, f.size))
+                cmplines += ['    if (memcmp(a + %d, b + %d, %d))' %
+                             (f.offset, f.offset, f.size),
+                             '        return 1;']
+            elif f.kind == cfuhash.string:
+                hashlines.append('    hv = hash_string(hv, FIELD(const char *, '
+                                 'a, %d));' % f.offset)
+                cmplines += ['    if (strcmp_robust(FIELD(const char *, a, %d),'
+                             % f.offset,
+                             '                      FIELD(const char *, b, %d)))'
+                             % f.offset,
+                             '        return 1;']
+            elif f.kind in (cfuhash.pointer, cfuhash.array):
+                hashlines += self.hash_items(f)
+                cmplines += self.cmp_items(f)
+            else:
+                assert False, 'unknown field kind: %s' % f.kind
+        hashlines += ['    return hv;', '}']
+        cmplines += ['    return 0;', '}']
+        return '\n'.join(hashlines + [''] + cmplines)
+
+    def length(self, f, obj):
+        if f.kind == cfuhash.pointer:
+            return '%d' % f.length
+        return 'FIELD(size_t, %s, %d)' % (obj, f.length_offset)
+
+    def hash_items(self, f):
+        n = self.index(f.fieldspec)
+        return ['    {',
+                '        const char *items = FIELD(const char *, a, %d);'
+                % f.offset,
+                '        size_t j, n = %s;' % self.length(f, 'a'),
+                '        for (j = 0; j < n; j++)',
+                '            hv = hash_part_%d(hv, items + j * %d);'
+                % (n, f.size),
+                '    }']
+
+    def cmp_items(self, f):
+        n = self.index(f.fieldspec)
+        lines = ['    {',
+                 '        const char *items_a = FIELD(const char *, a, %d);'
+                 % f.offset,
+                 '        const char *items_b = FIELD(const char *, b, %d);'
+                 % f.offset,
+                 '        size_t j, n = %s;' % self.length(f, 'a')]
+        if f.kind == cfuhash.array:
+            lines += ['        if (n != %s)' % self.length(f, 'b'),
+                      '            return 1;']
+        lines += ['        for (j = 0; j < n; j++)',
+                  '            if (cmp_%d(items_a + j * %d, items_b + j * %d))'
+                  % (n, f.size, f.size),
+                  '                return 1;',
+                  '    }']
+        return lines
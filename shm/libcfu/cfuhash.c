@@ -40,12 +40,15 @@
 
 #include "cfu.h"
 #include "cfuhash.h"
+#include "hashfunc.h"
 
+#include <stdint.h>
 #include <string.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <ctype.h>
 #include <assert.h>
+#include <limits.h>
 
 #ifdef HAVE_PTHREAD_H
 # include <pthread.h>
@@ -58,14 +61,31 @@ typedef struct cfuhash_event_flags {
 	int pad:31;
 } cfuhash_event_flags;
 
+/* key_size is stored in 32 bits, next to the 32-bit hash of the key, so
+   that caching the hash does not grow the entry: it is still 5 words (40
+   bytes on 64-bit platforms).  Keys are never larger than 4GB.
+*/
 typedef struct cfuhash_entry {
 	void *key;
-	size_t key_size;
+	unsigned int key_size;
+	unsigned int hash;
 	void *data;
 	size_t data_size;
 	struct cfuhash_entry *next;
 } cfuhash_entry;
 
+/* The size is stored together with the buckets, so that lock-free readers
+   always see a consistent pair, even while the table is rehashed.
+*/
+typedef struct cfuhash_buckets {
+	size_t size; /* always a power of 2 */
+	cfuhash_entry *heads[];
+} cfuhash_buckets;
+
+/* the number of old buckets which are moved to the new array by every
+   insertion or deletion, while a rehash is in progress */
+#define REHASH_STEP 64
+
 /* Note that there are two kinds of "free functions":
  
    - malloc_fn/free_fn are mandatory and are used to allocate the hasttable
@@ -73,14 +93,22 @@ typedef struct cfuhash_entry {
 
    - values_free_fn is optional: if it's specified, the hash table takes the
      ownership of the values put inside and frees them when they are removed
+
+   With CFUHASH_LOCKFREE_READERS, free_fn is not called on the memory which
+   is unlinked while the hash is in use, see free_unlinked().
 */
 
 
 struct cfuhash_table {
 	libcfu_type type;
-	size_t num_buckets;
 	size_t entries; /* Total number of entries in the table. */
-	cfuhash_entry **buckets;
+	cfuhash_buckets *buckets; /* the new entries are added here */
+	/* The rehashing is incremental: the buckets of old_buckets are moved to
+	   buckets a few at a time by each insertion or deletion, starting from
+	   rehash_index.  Meanwhile, the lookups check both arrays.  It is NULL
+	   when no rehash is in progress. */
+	cfuhash_buckets *old_buckets;
+	size_t rehash_index;
 #ifdef HAVE_PTHREAD_H
 	pthread_mutex_t mutex;
 #endif
@@ -92,42 +120,23 @@ struct cfuhash_table {
 	float high;
 	float low;
     cfuhash_fieldspec_t *key_fieldspec;
+	unsigned int key_type; /* see cfuhash_register_key_type(), or 0 */
 	cfuhash_malloc_fn_t malloc_fn;
 	cfuhash_free_fn_t free_fn;
 	cfuhash_free_fn_t values_free_fn; /* this is optional */
 	unsigned int resized_count;
 	cfuhash_event_flags event_flags;
+	unsigned long seq; /* seqlock sequence, odd while a write is in progress */
+	unsigned int seed; /* the seed of the hash function */
 };
 
-/* Perl's hash function */
 static unsigned int
-hash_func_part(unsigned int hv, const void *key, size_t length) {
-	register size_t i = length;
-	register const unsigned char *s = (const unsigned char *)key;
-    if (!key)
-        return hv;
-	while (i--) {
-		hv += *s++;
-		hv += (hv << 10);
-		hv ^= (hv >> 6);
-	}
-    return hv;
+hash_func(const void *key, size_t length, unsigned int seed) {
+	return hash_func_finalize(hash_func_part(hash_func_init(seed), key, length));
 }
 
-static unsigned int
-hash_func_finalize(unsigned int hv) {
-	hv += (hv << 3);
-	hv ^= (hv >> 11);
-	hv += (hv << 15);
-	return hv;
-}
-
-static unsigned int
-hash_func(const void *key, size_t length) {
-	register unsigned int hv = 0; /* could put a seed here instead of zero */
-    hv = hash_func_part(hv, key, length);
-    return hash_func_finalize(hv);
-}
+static uint64_t generic_hash_part(uint64_t hv, cfuhash_fieldspec_t fields[],
+								  const void* a);
 
 /* Call the hash function associated to the ht. In case it's NULL, it calls
    the default hash_func.  We cannot simply store hash_func as the default
@@ -135,15 +144,39 @@ hash_func(const void *key, size_t length) {
    different address spaces.
 */
 static unsigned int call_hash_func(cfuhash_table_t *ht, const void *key, size_t length) {
-    if (ht->key_fieldspec != NULL)
-        return cfuhash_generic_hash(ht->key_fieldspec, key);
+    if (ht->key_fieldspec != NULL) {
+        const cfuhash_key_type_t *kt = cfuhash_find_key_type(ht->key_type);
+        if (kt)
+            return kt->hash(key, ht->seed);
+        return cfuhash_generic_hash_seeded(ht->key_fieldspec, key, ht->seed);
+    }
 	else if (ht->hash_func == NULL)
-		return hash_func(key, length);
+		return hash_func(key, length, ht->seed);
 	else
 		return ht->hash_func(key, length);
 }
 
 
+/* The modifications are enclosed between write_begin() and write_end(),
+   which make ht->seq odd and then even again: lock-free readers (possibly
+   in other processes) read it before and after a lookup, and retry if it
+   was odd or changed.  This is the same protocol as shm/seqlock.py.
+*/
+static void
+write_begin(cfuhash_table_t *ht) {
+	__atomic_store_n(&ht->seq, ht->seq + 1, __ATOMIC_RELAXED);
+	__atomic_thread_fence(__ATOMIC_RELEASE);
+}
+
+static void
+write_end(cfuhash_table_t *ht) {
+	__atomic_store_n(&ht->seq, ht->seq + 1, __ATOMIC_RELEASE);
+}
+
+static int hash_rehash(cfuhash_table_t *ht);
+static int hash_rehash_to(cfuhash_table_t *ht, size_t new_size);
+static void rehash_step(cfuhash_table_t *ht, size_t max_buckets);
+
 /* like stdlib's calloc, but using our own malloc function */
 static void * cfuhash_calloc(cfuhash_table_t *ht, size_t nmemb, size_t size) {
 	size_t total_size = nmemb*size;
@@ -154,10 +187,48 @@ static void * cfuhash_calloc(cfuhash_table_t *ht, size_t nmemb, size_t size) {
 	return mem;
 }
 
+/* Free memory which was unlinked from the hash: the writer calls it after
+   making it unreachable from the hash, but a lock-free reader may still
+   hold a pointer to it.  Freeing it would overwrite its first word (e.g.
+   the key of an entry or the size of a bucket array) and the reader would
+   then follow a bogus pointer, so with CFUHASH_LOCKFREE_READERS it is left
+   to the garbage collector.
+*/
+static CFU_INLINE void
+free_unlinked(cfuhash_table_t *ht, void *ptr) {
+	if (!(ht->flags & CFUHASH_LOCKFREE_READERS))
+		ht->free_fn(ptr);
+}
+
+static cfuhash_buckets *
+hash_new_buckets(cfuhash_table_t *ht, size_t size) {
+	cfuhash_buckets *buckets = cfuhash_calloc(ht, 1, sizeof(cfuhash_buckets) +
+											  size * sizeof(cfuhash_entry *));
+	if (buckets)
+		buckets->size = size;
+	return buckets;
+}
+
+/* The arrays are published with release stores, and the readers which do
+   not hold the lock load them with acquire loads.
+*/
+static CFU_INLINE cfuhash_buckets *
+load_buckets(cfuhash_buckets **ptr) {
+	return __atomic_load_n(ptr, __ATOMIC_ACQUIRE);
+}
+
+/* Store in arrays the buckets to look into: buckets, and old_buckets (or
+   NULL) while a rehash is in progress */
+static CFU_INLINE void
+load_arrays(cfuhash_table_t *ht, cfuhash_buckets *arrays[2]) {
+	arrays[0] = load_buckets(&ht->buckets);
+	arrays[1] = load_buckets(&ht->old_buckets);
+}
+
 /* makes sure the real size of the buckets array is a power of 2 */
-static unsigned int
-hash_size(unsigned int s) {
-	unsigned int i = 1;
+static size_t
+hash_size(size_t s) {
+	size_t i = 1;
 	while (i < s) i <<= 1;
 	return i;
 }
@@ -179,14 +250,15 @@ hash_key_dup_lower_case(cfuhash_table_t *ht, const void *key, size_t key_size) {
 	return (void *)new_key;
 }
 
-/* returns the index into the buckets array */
+/* returns the full hash of the key: its bucket is given by bucket_head()
+*/
 static CFU_INLINE unsigned int
-hash_value(cfuhash_table_t *ht, const void *key, size_t key_size, size_t num_buckets) {
+hash_value(cfuhash_table_t *ht, const void *key, size_t key_size) {
 	unsigned int hv = 0;
 
 	if (key_size == 0) {
 		/* hashing the pointer itself, not the content */
-		hv = (unsigned int)key;
+		hv = cfuhash_hash_pointer(key, ht->seed);
 	}
 	else if (key) {
 		if (ht->flags & CFUHASH_IGNORE_CASE) {
@@ -197,13 +269,17 @@ hash_value(cfuhash_table_t *ht, const void *key, size_t key_size, size_t num_buc
 			hv = call_hash_func(ht, key, key_size);
 		}
 	}
+	return hv;
+}
 
-	/* The idea is the following: if, e.g., num_buckets is 32
-	   (000001), num_buckets - 1 will be 31 (111110). The & will make
+static CFU_INLINE cfuhash_entry **
+bucket_head(cfuhash_buckets *buckets, unsigned int hv) {
+	/* The idea is the following: if, e.g., the size is 32
+	   (000001), size - 1 will be 31 (111110). The & will make
 	   sure we only get the first 5 bits which will guarantee the
 	   index is less than 32.
 	*/
-	return hv & (num_buckets - 1);
+	return buckets->heads + (hv & (buckets->size - 1));
 }
 
 static cfuhash_table_t *
@@ -224,16 +300,18 @@ _cfuhash_new(size_t size, unsigned int flags, cfuhash_malloc_fn_t malloc_fn,
 	ht->free_fn = free_fn;
 
 	ht->type = libcfu_t_hash_table;
-	ht->num_buckets = size;
 	ht->entries = 0;
 	ht->flags = flags;
-	ht->buckets = cfuhash_calloc(ht, size, sizeof(cfuhash_entry *));
+	ht->buckets = hash_new_buckets(ht, size);
 
 #ifdef HAVE_PTHREAD_H
 	pthread_mutex_init(&ht->mutex, NULL);
 #endif
 
 	ht->hash_func = NULL;
+	/* the address is different for every table, and the same for all the
+	   processes which share it */
+	ht->seed = cfuhash_hash_pointer(ht, 0);
 	ht->high = 0.75;
 	ht->low = 0.25;
 
@@ -344,6 +422,13 @@ int cfuhash_set_key_fieldspec(cfuhash_table_t *ht, cfuhash_fieldspec_t fs[]) {
     return 0;
 }
 
+int cfuhash_set_key_type(cfuhash_table_t *ht, unsigned int type_id) {
+    /* like the hash function, it cannot change once there are entries */
+    if (ht->entries) return -1;
+    ht->key_type = type_id;
+    return 0;
+}
+
 /* Sets the hash function for the hash table ht.  Pass NULL for hf to reset to the default */
 int
 cfuhash_set_hash_function(cfuhash_table_t *ht, cfuhash_function_t hf) {
@@ -413,6 +498,9 @@ hash_cmp(cfuhash_table_t *ht, const void *key, size_t key_size,
 	if (key == he->key) return 0;
 	if (key_size == 0) return 1; /* compare by pointer, not by value */
     if (ht->key_fieldspec) {
+        const cfuhash_key_type_t *kt = cfuhash_find_key_type(ht->key_type);
+        if (kt)
+            return kt->cmp(key, he->key);
         return cfuhash_generic_cmp(ht->key_fieldspec, key, he->key);
     }
 	if (ht->cmp_func) {
@@ -428,23 +516,47 @@ static CFU_INLINE cfuhash_entry *
 hash_add_entry(cfuhash_table_t *ht, unsigned int hv, const void *key, size_t key_size,
 	void *data, size_t data_size) {
 	cfuhash_entry *he = cfuhash_calloc(ht, 1, sizeof(cfuhash_entry));
-
-	assert(hv < ht->num_buckets);
+	cfuhash_entry **head = bucket_head(ht->buckets, hv);
 
 	if (ht->flags & CFUHASH_NOCOPY_KEYS)
 		he->key = (void *)key;
 	else
 		he->key = hash_key_dup(ht, key, key_size);
+	assert(key_size <= UINT_MAX);
 	he->key_size = key_size;
 	he->data = data;
 	he->data_size = data_size;
-	he->next = ht->buckets[hv];
-	ht->buckets[hv] = he;
+	he->hash = hv;
+	he->next = *head;
+	*head = he;
 	ht->entries++;
 
 	return he;
 }
 
+/* Return the link which points to the entry of the key (i.e. the head of
+   its bucket, or the next field of the previous entry), or NULL.  While a
+   rehash is in progress, the key can be in either array.
+*/
+static cfuhash_entry **
+hash_find_entry(cfuhash_table_t *ht, const void *key, size_t key_size,
+				unsigned int hv) {
+	cfuhash_buckets *arrays[2];
+	cfuhash_entry **link;
+	int i;
+
+	load_arrays(ht, arrays);
+	for (i = 0; i < 2 && arrays[i]; i++) {
+		for (link = bucket_head(arrays[i], hv); *link; link = &(*link)->next) {
+			cfuhash_entry *he = *link;
+			if (he->hash == hv &&
+				!hash_cmp(ht, key, key_size, he, ht->flags & CFUHASH_IGNORE_CASE))
+				return link;
+		}
+	}
+	return NULL;
+}
+
 static size_t strlen_robust(const char *s) {
     if (s)
         return strlen(s);
@@ -473,6 +585,7 @@ int
 cfuhash_get_data(cfuhash_table_t *ht, const void *key, size_t key_size, void **r,
 	size_t *data_size) {
 	unsigned int hv = 0;
+	cfuhash_entry **link;
 	cfuhash_entry *hr = NULL;
 
 	if (!ht) return 0;
@@ -484,13 +597,9 @@ cfuhash_get_data(cfuhash_table_t *ht, const void *key, size_t key_size, void **r
 	}
 
 	lock_hash(ht);
-	hv = hash_value(ht, key, key_size, ht->num_buckets);
-
-	assert(hv < ht->num_buckets);
-
-	for (hr = ht->buckets[hv]; hr; hr = hr->next) {
-		if (!hash_cmp(ht, key, key_size, hr, ht->flags & CFUHASH_IGNORE_CASE)) break;
-	}
+	hv = hash_value(ht, key, key_size);
+	link = hash_find_entry(ht, key, key_size, hv);
+	if (link) hr = *link;
 
 	if (hr && r) {
 		*r = hr->data;
@@ -540,6 +649,7 @@ int
 cfuhash_put_data(cfuhash_table_t *ht, const void *key, size_t key_size, void *data,
 	size_t data_size, void **r) {
 	unsigned int hv = 0;
+	cfuhash_entry **link;
 	cfuhash_entry *he = NULL;
 	int added_an_entry = 0;
 
@@ -554,12 +664,11 @@ cfuhash_put_data(cfuhash_table_t *ht, const void *key, size_t key_size, void *da
 	}
 
 	lock_hash(ht);
-	hv = hash_value(ht, key, key_size, ht->num_buckets);
-	assert(hv < ht->num_buckets);
-	for (he = ht->buckets[hv]; he; he = he->next) {
-		if (!hash_cmp(ht, key, key_size, he, ht->flags & CFUHASH_IGNORE_CASE)) break;
-	}
+	hv = hash_value(ht, key, key_size);
+	link = hash_find_entry(ht, key, key_size, hv);
+	if (link) he = *link;
 
+	write_begin(ht);
 	if (he) {
 		if (r) *r = he->data;
 		if (ht->values_free_fn) {
@@ -571,13 +680,17 @@ cfuhash_put_data(cfuhash_table_t *ht, const void *key, size_t key_size, void *da
 	} else {
 		hash_add_entry(ht, hv, key, key_size, data, data_size);
 		added_an_entry = 1;
+		/* replacing a value never moves the entries, so that it does not
+		   disturb the iterations in progress (see cfuhash_next_entries) */
+		rehash_step(ht, REHASH_STEP);
 	}
 
 	unlock_hash(ht);
 
 	if (added_an_entry && !(ht->flags & CFUHASH_FROZEN)) {
-		if ( (float)ht->entries/(float)ht->num_buckets > ht->high ) cfuhash_rehash(ht);
+		if ( (float)ht->entries/(float)ht->buckets->size > ht->high ) hash_rehash(ht);
 	}
+	write_end(ht);
 
 	return added_an_entry;
 }
@@ -596,6 +709,27 @@ cfuhash_put(cfuhash_table_t *ht, const char *key, void *data) {
 	return NULL;
 }
 
+size_t
+cfuhash_get_many(cfuhash_table_t *ht, void **keys, size_t key_size, size_t n,
+				 void **values, char *found) {
+	size_t i, count = 0;
+	for (i = 0; i < n; i++) {
+		found[i] = cfuhash_get_data(ht, keys[i], key_size,
+									values ? values + i : NULL, NULL);
+		count += found[i];
+	}
+	return count;
+}
+
+size_t
+cfuhash_put_many(cfuhash_table_t *ht, void **keys, size_t key_size,
+				 void **values, size_t n) {
+	size_t i, count = 0;
+	for (i = 0; i < n; i++)
+		count += cfuhash_put_data(ht, keys[i], key_size, values[i], 0, NULL);
+	return count;
+}
+
 void
 cfuhash_clear(cfuhash_table_t *ht) {
 	cfuhash_entry *he = NULL;
@@ -603,16 +737,18 @@ cfuhash_clear(cfuhash_table_t *ht) {
 	size_t i = 0;
 
 	lock_hash(ht);
-	for (i = 0; i < ht->num_buckets; i++) {
-		if ( (he = ht->buckets[i]) ) {
+	write_begin(ht);
+	rehash_step(ht, (size_t)-1);
+	for (i = 0; i < ht->buckets->size; i++) {
+		if ( (he = ht->buckets->heads[i]) ) {
 			while (he) {
 				hep = he;
 				he = he->next;
-				if (! (ht->flags & CFUHASH_NOCOPY_KEYS) ) ht->free_fn(hep->key);
+				if (! (ht->flags & CFUHASH_NOCOPY_KEYS) ) free_unlinked(ht, hep->key);
 				if (ht->values_free_fn) ht->values_free_fn(hep->data);
-				ht->free_fn(hep);
+				free_unlinked(ht, hep);
 			}
-			ht->buckets[i] = NULL;
+			ht->buckets->heads[i] = NULL;
 		}
 	}
 	ht->entries = 0;
@@ -621,47 +757,47 @@ cfuhash_clear(cfuhash_table_t *ht) {
 
 	if ( !(ht->flags & CFUHASH_FROZEN) &&
 		!( (ht->flags & CFUHASH_FROZEN_UNTIL_GROWS) && !ht->resized_count) ) {
-		if ( (float)ht->entries/(float)ht->num_buckets < ht->low ) cfuhash_rehash(ht);
+		if ( (float)ht->entries/(float)ht->buckets->size < ht->low ) hash_rehash(ht);
 	}
+	write_end(ht);
 
 }
 
 void *
 cfuhash_delete_data(cfuhash_table_t *ht, const void *key, size_t key_size) {
 	unsigned int hv = 0;
+	cfuhash_entry **link;
 	cfuhash_entry *he = NULL;
-	cfuhash_entry *hep = NULL;
 	void *r = NULL;
 
 	if (key_size == (size_t)(-1)) key_size = strlen(key) + 1;
 	lock_hash(ht);
-	hv = hash_value(ht, key, key_size, ht->num_buckets);
-
-	for (he = ht->buckets[hv]; he; he = he->next) {
-		if (!hash_cmp(ht, key, key_size, he, ht->flags & CFUHASH_IGNORE_CASE)) break;
-		hep = he;
-	}
+	hv = hash_value(ht, key, key_size);
+	link = hash_find_entry(ht, key, key_size, hv);
 
-	if (he) {
+	if (link) {
+		he = *link;
+		write_begin(ht);
 		r = he->data;
-		if (hep) hep->next = he->next;
-		else ht->buckets[hv] = he->next;
+		*link = he->next;
 
 		ht->entries--;
-		if (! (ht->flags & CFUHASH_NOCOPY_KEYS) ) ht->free_fn(he->key);
+		if (! (ht->flags & CFUHASH_NOCOPY_KEYS) ) free_unlinked(ht, he->key);
 		if (ht->values_free_fn) {
 			ht->values_free_fn(he->data);
 			r = NULL; /* don't return a pointer to a free()'d location */
 		}
-		ht->free_fn(he);
+		free_unlinked(ht, he);
+		rehash_step(ht, REHASH_STEP);
 	}
 
 	unlock_hash(ht);
 
 	if (he && !(ht->flags & CFUHASH_FROZEN) &&
 		!( (ht->flags & CFUHASH_FROZEN_UNTIL_GROWS) && !ht->resized_count) ) {
-		if ( (float)ht->entries/(float)ht->num_buckets < ht->low ) cfuhash_rehash(ht);
+		if ( (float)ht->entries/(float)ht->buckets->size < ht->low ) hash_rehash(ht);
 	}
+	if (he) write_end(ht);
 
 
 	return r;
@@ -677,9 +813,11 @@ cfuhash_keys_data(cfuhash_table_t *ht, size_t *num_keys, size_t **key_sizes, int
 	size_t *key_lengths = NULL;
 	void **keys = NULL;
 	cfuhash_entry *he = NULL;
+	cfuhash_buckets *arrays[2];
 	size_t bucket = 0;
 	size_t entry_index = 0;
 	size_t key_count = 0;
+	int i;
 
 	if (!ht) {
 		if (key_sizes)
@@ -698,20 +836,23 @@ cfuhash_keys_data(cfuhash_table_t *ht, size_t *num_keys, size_t **key_sizes, int
 		goto exit;
 	}
 
-	for (bucket = 0; bucket < ht->num_buckets; bucket++) {
-		if ( (he = ht->buckets[bucket]) ) {
-			for (; he; he = he->next, entry_index++) {
-				if (entry_index >= ht->entries) break; /* this should never happen */
-
-				if (fast) {
-					keys[entry_index] = he->key;
-				} else {
-					keys[entry_index] = calloc(he->key_size, 1);
-					memcpy(keys[entry_index], he->key, he->key_size);
+	load_arrays(ht, arrays);
+	for (i = 0; i < 2 && arrays[i]; i++) {
+		for (bucket = 0; bucket < arrays[i]->size; bucket++) {
+			if ( (he = arrays[i]->heads[bucket]) ) {
+				for (; he; he = he->next, entry_index++) {
+					if (entry_index >= ht->entries) break; /* this should never happen */
+
+					if (fast) {
+						keys[entry_index] = he->key;
+					} else {
+						keys[entry_index] = calloc(he->key_size, 1);
+						memcpy(keys[entry_index], he->key, he->key_size);
+					}
+					key_count++;
+
+					if (key_lengths) key_lengths[entry_index] = he->key_size;
 				}
-				key_count++;
-
-				if (key_lengths) key_lengths[entry_index] = he->key_size;
 			}
 		}
 	}
@@ -734,6 +875,12 @@ int
 cfuhash_each_data(cfuhash_table_t *ht, void **key, size_t *key_size, void **data,
 	size_t *data_size) {
 
+	/* the iteration state is a single index, so finish the rehash first */
+	if (ht->old_buckets) {
+		write_begin(ht);
+		rehash_step(ht, (size_t)-1);
+		write_end(ht);
+	}
 	ht->each_bucket_index = -1;
 	ht->each_chain_entry = NULL;
 
@@ -749,9 +896,9 @@ cfuhash_next_data(cfuhash_table_t *ht, void **key, size_t *key_size, void **data
 	} else {
 		ht->each_chain_entry = NULL;
 		ht->each_bucket_index++;
-		for (; ht->each_bucket_index < ht->num_buckets; ht->each_bucket_index++) {
-			if (ht->buckets[ht->each_bucket_index]) {
-				ht->each_chain_entry = ht->buckets[ht->each_bucket_index];
+		for (; ht->each_bucket_index < ht->buckets->size; ht->each_bucket_index++) {
+			if (ht->buckets->heads[ht->each_bucket_index]) {
+				ht->each_chain_entry = ht->buckets->heads[ht->each_bucket_index];
 				break;
 			}
 		}
@@ -768,8 +915,46 @@ cfuhash_next_data(cfuhash_table_t *ht, void **key, size_t *key_size, void **data
 	return 0;
 }
 
+/* cursor[0] is the index of the bucket, counting the buckets of old_buckets
+   after the ones of buckets, and cursor[1] the number of entries of the
+   bucket which were already returned */
+size_t
+cfuhash_next_entries(cfuhash_table_t *ht, size_t cursor[2], void **keys,
+					 void **values, size_t max) {
+	cfuhash_buckets *arrays[2];
+	size_t count = 0;
+	size_t bucket = cursor[0];
+	size_t skip = cursor[1];
+
+	load_arrays(ht, arrays);
+	while (count < max) {
+		cfuhash_entry *he;
+		if (bucket < arrays[0]->size)
+			he = arrays[0]->heads[bucket];
+		else if (arrays[1] && bucket - arrays[0]->size < arrays[1]->size)
+			he = arrays[1]->heads[bucket - arrays[0]->size];
+		else
+			break;
+		for (; he && skip; he = he->next) skip--;
+		for (; he && count < max; he = he->next, cursor[1]++) {
+			keys[count] = he->key;
+			if (values) values[count] = he->data;
+			count++;
+		}
+		if (he)
+			break; /* the chunk is full: continue from this bucket */
+		bucket++;
+		cursor[1] = skip = 0;
+	}
+	cursor[0] = bucket;
+	return count;
+}
+
+/* unlinked is true if the entry was removed from a hash which is still in
+   use, false if the whole hash is being destroyed */
 static void
-_cfuhash_destroy_entry(cfuhash_table_t *ht, cfuhash_entry *he, cfuhash_free_fn_t ff) {
+_cfuhash_destroy_entry(cfuhash_table_t *ht, cfuhash_entry *he, cfuhash_free_fn_t ff,
+					   int unlinked) {
 	if (ff) {
 		ff(he->data);
 	} else {
@@ -778,6 +963,11 @@ _cfuhash_destroy_entry(cfuhash_table_t *ht, cfuhash_entry *he, cfuhash_free_fn_t
 			if (ht->flags & CFUHASH_FREE_DATA) ht->free_fn(he->data);
 		}
 	}
+	if (unlinked) {
+		if ( !(ht->flags & CFUHASH_NOCOPY_KEYS) ) free_unlinked(ht, he->key);
+		free_unlinked(ht, he);
+		return;
+	}
 	if ( !(ht->flags & CFUHASH_NOCOPY_KEYS) ) ht->free_fn(he->key);
 	ht->free_fn(he);
 }
@@ -796,8 +986,13 @@ cfuhash_foreach_remove(cfuhash_table_t *ht, cfuhash_remove_fn_t r_fn, cfuhash_fr
 
 	lock_hash(ht);
 
-	buckets = ht->buckets;
-	num_buckets = ht->num_buckets;
+	if (ht->old_buckets) {
+		write_begin(ht);
+		rehash_step(ht, (size_t)-1);
+		write_end(ht);
+	}
+	buckets = ht->buckets->heads;
+	num_buckets = ht->buckets->size;
 	for (hv = 0; hv < num_buckets; hv++) {
 		entry = buckets[hv];
 		if (!entry) continue;
@@ -805,14 +1000,15 @@ cfuhash_foreach_remove(cfuhash_table_t *ht, cfuhash_remove_fn_t r_fn, cfuhash_fr
 
 		while (entry) {
 			if (r_fn(entry->key, entry->key_size, entry->data, entry->data_size, arg)) {
+				if (!num_removed) write_begin(ht);
 				num_removed++;
 				if (prev) {
 					prev->next = entry->next;
-					_cfuhash_destroy_entry(ht, entry, ff);
+					_cfuhash_destroy_entry(ht, entry, ff, 1);
 					entry = prev->next;
 				} else {
 					buckets[hv] = entry->next;
-					_cfuhash_destroy_entry(ht, entry, NULL);
+					_cfuhash_destroy_entry(ht, entry, NULL, 1);
 					entry = buckets[hv];
 				}
 			} else {
@@ -821,35 +1017,43 @@ cfuhash_foreach_remove(cfuhash_table_t *ht, cfuhash_remove_fn_t r_fn, cfuhash_fr
 			}
 		}
 	}
+	if (num_removed) write_end(ht);
 
 	unlock_hash(ht);
 
 	return num_removed;
 }
 
-size_t
-cfuhash_foreach(cfuhash_table_t *ht, cfuhash_foreach_fn_t fe_fn, void *arg) {
+static int
+_cfuhash_foreach_array(cfuhash_buckets *buckets, cfuhash_foreach_fn_t fe_fn, void *arg,
+					   size_t *num_accessed) {
 	cfuhash_entry *entry = NULL;
 	size_t hv = 0;
-	size_t num_accessed = 0;
-	cfuhash_entry **buckets = NULL;
-	size_t num_buckets = 0;
 	int rv = 0;
 
-	if (!ht) return 0;
-
-	lock_hash(ht);
-
-	buckets = ht->buckets;
-	num_buckets = ht->num_buckets;
-	for (hv = 0; hv < num_buckets && !rv; hv++) {
-		entry = buckets[hv];
+	for (hv = 0; hv < buckets->size && !rv; hv++) {
+		entry = buckets->heads[hv];
 
 		for (; entry && !rv; entry = entry->next) {
-			num_accessed++;
+			(*num_accessed)++;
 			rv = fe_fn(entry->key, entry->key_size, entry->data, entry->data_size, arg);
 		}
 	}
+	return rv;
+}
+
+size_t
+cfuhash_foreach(cfuhash_table_t *ht, cfuhash_foreach_fn_t fe_fn, void *arg) {
+	size_t num_accessed = 0;
+	cfuhash_buckets *arrays[2];
+
+	if (!ht) return 0;
+
+	lock_hash(ht);
+
+	load_arrays(ht, arrays);
+	if (!_cfuhash_foreach_array(arrays[0], fe_fn, arg, &num_accessed) && arrays[1])
+		_cfuhash_foreach_array(arrays[1], fe_fn, arg, &num_accessed);
 
 	unlock_hash(ht);
 
@@ -874,12 +1078,13 @@ cfuhash_destroy_with_free_fn(cfuhash_table_t *ht, cfuhash_free_fn_t ff) {
 	if (!ht) return 0;
 
 	lock_hash(ht);
-	for (i = 0; i < ht->num_buckets; i++) {
-		if (ht->buckets[i]) {
-			cfuhash_entry *he = ht->buckets[i];
+	rehash_step(ht, (size_t)-1);
+	for (i = 0; i < ht->buckets->size; i++) {
+		if (ht->buckets->heads[i]) {
+			cfuhash_entry *he = ht->buckets->heads[i];
 			while (he) {
 				cfuhash_entry *hn = he->next;
-				_cfuhash_destroy_entry(ht, he, ff);
+				_cfuhash_destroy_entry(ht, he, ff, 0);
 				he = hn;
 			}
 		}
@@ -931,37 +1136,110 @@ cfuhash_pretty_print(cfuhash_table_t *ht, FILE *fp) {
 	return rv;
 }
 
+/* Rehash the table at once, without leaving any work for the next writes */
 int
 cfuhash_rehash(cfuhash_table_t *ht) {
-	size_t new_size, i;
-	cfuhash_entry **new_buckets = NULL;
+	int ret;
+	write_begin(ht);
+	ret = hash_rehash(ht);
+	rehash_step(ht, (size_t)-1);
+	write_end(ht);
+	return ret;
+}
+
+int
+cfuhash_is_rehashing(cfuhash_table_t *ht) {
+	if (!ht) return 0;
+	return load_buckets(&ht->old_buckets) != NULL;
+}
+
+int
+cfuhash_reserve(cfuhash_table_t *ht, size_t n) {
+	int ret;
+	/* the smallest size which keeps the load factor below high */
+	size_t new_size = hash_size((size_t)((double)n / ht->high) + 1);
+
+	if (new_size <= ht->buckets->size)
+		return 0;
+	write_begin(ht);
+	ret = hash_rehash_to(ht, new_size);
+	write_end(ht);
+	return ret;
+}
+
+size_t
+cfuhash_num_rehashes(cfuhash_table_t *ht) {
+	if (!ht) return 0;
+	return ht->resized_count;
+}
+
+/* Start a rehash: the entries are moved by rehash_step().  If a rehash is
+   already in progress, it is finished first.
+*/
+static int
+hash_rehash(cfuhash_table_t *ht) {
+	return hash_rehash_to(ht, hash_size(ht->entries * 2 / (ht->high + ht->low)));
+}
+
+static int
+hash_rehash_to(cfuhash_table_t *ht, size_t new_size) {
+	cfuhash_buckets *new_buckets = NULL;
 
 	lock_hash(ht);
-	new_size = hash_size(ht->entries * 2 / (ht->high + ht->low));
-	if (new_size == ht->num_buckets) {
+	rehash_step(ht, (size_t)-1);
+	if (new_size == ht->buckets->size) {
 		unlock_hash(ht);
 		return 0;
 	}
-	new_buckets = cfuhash_calloc(ht, new_size, sizeof(cfuhash_entry *));
+	new_buckets = hash_new_buckets(ht, new_size);
+	if (!new_buckets) {
+		unlock_hash(ht);
+		return 0;
+	}
+
+	/* the readers must find every entry in one of the two arrays, so
+	   old_buckets is published before buckets */
+	ht->rehash_index = 0;
+	__atomic_store_n(&ht->old_buckets, ht->buckets, __ATOMIC_RELEASE);
+	__atomic_store_n(&ht->buckets, new_buckets, __ATOMIC_RELEASE);
+	ht->resized_count++;
 
-	for (i = 0; i < ht->num_buckets; i++) {
-		cfuhash_entry *he = ht->buckets[i];
+	unlock_hash(ht);
+	return 1;
+}
+
+/* Move at most max_buckets buckets from old_buckets to buckets, and free
+   old_buckets after the last one.  It must be called inside a write section.
+*/
+static void
+rehash_step(cfuhash_table_t *ht, size_t max_buckets) {
+	cfuhash_buckets *old = ht->old_buckets;
+	size_t end;
+
+	if (!old)
+		return;
+	end = old->size - ht->rehash_index;
+	if (max_buckets < end)
+		end = max_buckets;
+	end += ht->rehash_index;
+
+	for (; ht->rehash_index < end; ht->rehash_index++) {
+		cfuhash_entry *he = old->heads[ht->rehash_index];
 		while (he) {
 			cfuhash_entry *nhe = he->next;
-			unsigned int hv = hash_value(ht, he->key, he->key_size, new_size);
-			he->next = new_buckets[hv];
-			new_buckets[hv] = he;
+			/* the stored hash avoids hashing the keys again */
+			cfuhash_entry **head = bucket_head(ht->buckets, he->hash);
+			he->next = *head;
+			*head = he;
 			he = nhe;
 		}
+		old->heads[ht->rehash_index] = NULL;
 	}
 
-	ht->num_buckets = new_size;
-	ht->free_fn(ht->buckets);
-	ht->buckets = new_buckets;
-	ht->resized_count++;
-
-	unlock_hash(ht);
-	return 1;
+	if (ht->rehash_index == old->size) {
+		__atomic_store_n(&ht->old_buckets, NULL, __ATOMIC_RELEASE);
+		free_unlinked(ht, old);
+	}
 }
 
 size_t
@@ -970,10 +1248,21 @@ cfuhash_num_entries(cfuhash_table_t *ht) {
 	return ht->entries;
 }
 
+unsigned long
+cfuhash_version(cfuhash_table_t *ht) {
+	if (!ht) return 0;
+	return __atomic_load_n(&ht->seq, __ATOMIC_ACQUIRE) / 2;
+}
+
+unsigned long *
+cfuhash_seqlock(cfuhash_table_t *ht) {
+	return &ht->seq;
+}
+
 size_t
 cfuhash_num_buckets(cfuhash_table_t *ht) {
 	if (!ht) return 0;
-	return ht->num_buckets;
+	return load_buckets(&ht->buckets)->size;
 }
 
 size_t
@@ -985,8 +1274,13 @@ cfuhash_num_buckets_used(cfuhash_table_t *ht) {
 
 	lock_hash(ht);
 
-	for (i = 0; i < ht->num_buckets; i++) {
-		if (ht->buckets[i]) count++;
+	for (i = 0; i < ht->buckets->size; i++) {
+		if (ht->buckets->heads[i]) count++;
+	}
+	if (ht->old_buckets) {
+		for (i = ht->rehash_index; i < ht->old_buckets->size; i++) {
+			if (ht->old_buckets->heads[i]) count++;
+		}
 	}
 	unlock_hash(ht);
 	return count;
@@ -1057,8 +1351,8 @@ int cfuhash_generic_cmp(cfuhash_fieldspec_t fields[], const void* a, const void*
     return 0;
 }
 
-unsigned int cfuhash_generic_hash_impl(unsigned int hv, cfuhash_fieldspec_t fields[], 
-                                       const void* a)
+static uint64_t generic_hash_part(uint64_t hv, cfuhash_fieldspec_t fields[],
+                                  const void* a)
 {
     if (!a)
         return hv;
@@ -1087,7 +1381,7 @@ unsigned int cfuhash_generic_hash_impl(unsigned int hv, cfuhash_fieldspec_t fiel
             field_a = FIELD(void*, a, offset);
             for(j=0; j<array_length; j++) {
                 item_a = field_a + (j*field->size);
-                hv = cfuhash_generic_hash_impl(hv, field->fieldspec, item_a);
+                hv = generic_hash_part(hv, field->fieldspec, item_a);
             }
             break;
         case cfuhash_string:
@@ -1103,9 +1397,65 @@ unsigned int cfuhash_generic_hash_impl(unsigned int hv, cfuhash_fieldspec_t fiel
 }
 
 
-unsigned int cfuhash_generic_hash(cfuhash_fieldspec_t fields[], const void* key) {
-    unsigned int hv = 0;
-    hv = cfuhash_generic_hash_impl(hv, fields, key);
+unsigned int cfuhash_generic_hash_seeded(cfuhash_fieldspec_t fields[],
+                                         const void* key, unsigned int seed) {
+    uint64_t hv = generic_hash_part(hash_func_init(seed), fields, key);
     return hash_func_finalize(hv);
 }
 
+unsigned int cfuhash_generic_hash(cfuhash_fieldspec_t fields[], const void* key) {
+    return cfuhash_generic_hash_seeded(fields, key, 0);
+}
+
+/* The key types registered by this process, in an open addressing table
+   indexed by type_id.  The entries are never removed, and type_id is
+   written last, so that cfuhash_find_key_type() does not need any lock. */
+#define KEY_TYPES_SIZE 256
+
+static cfuhash_key_type_t key_types[KEY_TYPES_SIZE];
+
+int cfuhash_register_key_type(unsigned int type_id, cfuhash_key_hash_t hash,
+                              cfuhash_key_cmp_t cmp) {
+    size_t i, n;
+    if (type_id == 0)
+        return -1;
+    for (i = type_id % KEY_TYPES_SIZE, n = 0; n < KEY_TYPES_SIZE;
+         i = (i + 1) % KEY_TYPES_SIZE, n++) {
+        cfuhash_key_type_t *kt = key_types + i;
+        if (kt->type_id == type_id)
+            return (kt->hash == hash && kt->cmp == cmp) ? 0 : -1;
+        if (kt->type_id == 0) {
+            kt->hash = hash;
+            kt->cmp = cmp;
+            __atomic_store_n(&kt->type_id, type_id, __ATOMIC_RELEASE);
+            return 0;
+        }
+    }
+    return -1;
+}
+
+const cfuhash_key_type_t *cfuhash_find_key_type(unsigned int type_id) {
+    size_t i, n;
+    if (type_id == 0)
+        return NULL;
+    for (i = type_id % KEY_TYPES_SIZE, n = 0; n < KEY_TYPES_SIZE;
+         i = (i + 1) % KEY_TYPES_SIZE, n++) {
+        unsigned int id = __atomic_load_n(&key_types[i].type_id,
+                                          __ATOMIC_ACQUIRE);
+        if (id == type_id)
+            return key_types + i;
+        if (id == 0)
+            break;
+    }
+    return NULL;
+}
+
+unsigned int cfuhash_hash(const void *key, size_t length, unsigned int seed) {
+    return hash_func(key, length, seed);
+}
+
+unsigned int cfuhash_hash_pointer(const void *key, unsigned int seed) {
+    return hash_func_finalize(hash_func_mix(hash_func_init(seed),
+                                            (uintptr_t)key));
+}
+
@@ -131,6 +131,12 @@ cfuhash_table_t * cfuhash_merge(cfuhash_table_t *ht1, cfuhash_table_t *ht2,
  */
 int cfuhash_set_key_fieldspec(cfuhash_table_t *ht, cfuhash_fieldspec_t fs[]);
 
+/* Set the id of the key type, see cfuhash_register_key_type().  If the
+ * current process registered the functions of this id, they are used
+ * instead of interpreting the fieldspec, which must also be set.
+ */
+int cfuhash_set_key_type(cfuhash_table_t *ht, unsigned int type_id);
+
 /* Sets the hashing function to use when computing which bucket to add
  * entries to.  It should return a 32-bit unsigned integer.  By
  * default, Perl's hashing algorithm is used.
@@ -184,6 +190,17 @@ int cfuhash_exists_data(cfuhash_table_t *ht, const void *key, size_t key_size);
 int cfuhash_put_data(cfuhash_table_t *ht, const void *key, size_t key_size, void *data,
 	size_t data_size, void **r);
 
+/* Batched versions of cfuhash_get_data() and cfuhash_put_data(), for n keys
+ * of the same key_size.  get_many stores in found[i] whether keys[i] exists
+ * and, if values is not NULL, its value in values[i] (untouched if it does
+ * not exist); it returns the number of keys found.  put_many returns the
+ * number of new entries.
+ */
+size_t cfuhash_get_many(cfuhash_table_t *ht, void **keys, size_t key_size,
+	size_t n, void **values, char *found);
+size_t cfuhash_put_many(cfuhash_table_t *ht, void **keys, size_t key_size,
+	void **values, size_t n);
+
 /* Clears the hash table (deletes all entries). */
 void cfuhash_clear(cfuhash_table_t *ht);
 
@@ -217,6 +234,17 @@ int cfuhash_each_data(cfuhash_table_t *ht, void **key, size_t *key_size, void **
 int cfuhash_next_data(cfuhash_table_t *ht, void **key, size_t *key_size, void **data,
 	size_t *data_size);
 
+/* Another way to loop over the entries, which keeps its state in cursor
+ * instead of in the hash, and returns them in chunks.  It copies to keys and
+ * values (if not NULL) at most max entries, starting from cursor, and
+ * advances it.  Both items of cursor must be 0 at the beginning.  Returns the
+ * number of entries copied, 0 at the end.  It does not write to the hash, so
+ * lock-free readers can use it, but they must check that the hash did not
+ * change meanwhile, see cfuhash_seqlock().
+ */
+size_t cfuhash_next_entries(cfuhash_table_t *ht, size_t cursor[2], void **keys,
+	void **values, size_t max);
+
 /* Iterates over the key/value pairs in the hash, passing each one
  * to r_fn, and removes all entries for which r_fn returns true.
  * If ff is not NULL, it is the passed the data to be freed.  arg
@@ -247,9 +275,35 @@ int cfuhash_destroy_with_free_fn(cfuhash_table_t *ht, cfuhash_free_fn_t ff);
  */
 int cfuhash_rehash(cfuhash_table_t *ht);
 
+/* Returns 1 if a rehash is in progress.  The automatic rehashes (when the
+ * size thresholds are reached) are incremental: every following write moves
+ * a few buckets to the new array, and lookups check both arrays meanwhile.
+ */
+int cfuhash_is_rehashing(cfuhash_table_t *ht);
+
+/* Grow the hash so that it can hold n entries without rehashing again, with
+ * the current thresholds.  It never shrinks the hash.  Returns 1 if the hash
+ * was resized.
+ */
+int cfuhash_reserve(cfuhash_table_t *ht, size_t n);
+
+/* Returns the number of times that the hash was resized */
+size_t cfuhash_num_rehashes(cfuhash_table_t *ht);
+
 /* Returns the number entries in the hash. */
 size_t cfuhash_num_entries(cfuhash_table_t *ht);
 
+/* Returns the modification counter of the hash: it is incremented by
+ * every put, delete and clear, so an unchanged value means unchanged
+ * contents.  It can be read without taking the lock.
+ */
+unsigned long cfuhash_version(cfuhash_table_t *ht);
+
+/* Returns the address of the seqlock sequence of the hash, see
+ * shm/seqlock.py: it is odd while a modification is in progress.
+ */
+unsigned long *cfuhash_seqlock(cfuhash_table_t *ht);
+
 /* Returns the number of buckets allocated for the hash. */
 size_t cfuhash_num_buckets(cfuhash_table_t *ht);
 
@@ -305,11 +359,52 @@ void **cfuhash_keys(cfuhash_table_t *ht, size_t *num_keys, int fast);
 #define CFUHASH_FROZEN_UNTIL_GROWS (1 << 3) /* do not shrink the hash until it has grown */
 #define CFUHASH_FREE_DATA (1 << 4)   /* call free() on each value when the hash is destroyed */
 #define CFUHASH_IGNORE_CASE (1 << 5) /* treat keys case-insensitively */
+/* there are lock-free readers: the entries, keys and bucket arrays which are
+ * removed from the hash are not freed, since a reader may still be using
+ * them.  Use it only if the memory is garbage collected (e.g. malloc_fn is
+ * GC_malloc), so that they are reclaimed once they are unreachable
+ */
+#define CFUHASH_LOCKFREE_READERS (1 << 6)
 
 
 /* generic hash and cmp functions */
 int cfuhash_generic_cmp(cfuhash_fieldspec_t fields[], const void* key1, const void* key2);
 unsigned int cfuhash_generic_hash(cfuhash_fieldspec_t fields[], const void* key);
+unsigned int cfuhash_generic_hash_seeded(cfuhash_fieldspec_t fields[],
+                                         const void* key, unsigned int seed);
+
+/* The functions compiled for a key type: they must give the same results
+ * as cfuhash_generic_hash_seeded() and cfuhash_generic_cmp() with the
+ * fieldspec of the type (but cmp only needs to return 0 for equal keys and
+ * nonzero otherwise).
+ */
+typedef unsigned int (*cfuhash_key_hash_t)(const void *key, unsigned int seed);
+typedef int (*cfuhash_key_cmp_t)(const void *key1, const void *key2);
+
+typedef struct cfuhash_key_type {
+    unsigned int type_id;
+    cfuhash_key_hash_t hash;
+    cfuhash_key_cmp_t cmp;
+} cfuhash_key_type_t;
+
+/* Register the functions for the keys of type_id.  The function pointers
+ * are valid only in the current process, so the tables store only the id:
+ * each process registers its own functions, and the ones which did not fall
+ * back to the fieldspec.  Returns 0 on success and -1 if type_id is 0, is
+ * already registered with other functions, or if there are too many types.
+ * Registering is not thread-safe, looking up is.
+ */
+int cfuhash_register_key_type(unsigned int type_id, cfuhash_key_hash_t hash,
+                              cfuhash_key_cmp_t cmp);
+/* Returns the functions registered for type_id, or NULL */
+const cfuhash_key_type_t *cfuhash_find_key_type(unsigned int type_id);
+
+/* the default hash functions, for keys without a fieldspec and for
+ * pointers.  Every table stores its own seed, which is the same for all the
+ * processes sharing it
+ */
+unsigned int cfuhash_hash(const void *key, size_t length, unsigned int seed);
+unsigned int cfuhash_hash_pointer(const void *key, unsigned int seed);
 
 #define CMP(a, b) ((a < b) ? -1 : (a > b))
 
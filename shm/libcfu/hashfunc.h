@@ -0,0 +1,66 @@
+/*
+ * hashfunc.h - the hash function of cfuhash and openhash
+ *
+ * The building blocks are inline functions, so that the key functions
+ * compiled for each key type (see FieldSpec.compile() in shm/libcfu.py)
+ * compute exactly the same hashes as cfuhash_generic_hash_seeded(), which
+ * interprets the fieldspec.
+ */
+
+#ifndef HASHFUNC_H_
+#define HASHFUNC_H_
+
+#include "cfu.h"
+
+#include <stdint.h>
+#include <string.h>
+
+/* A word-at-a-time hash, in the style of murmur and wyhash: the key is read
+   8 bytes at a time, and each word is mixed into a 64-bit state with a
+   multiplication and a xor-shift.  The seed is stored in the table, so that
+   all the processes compute the same hashes.
+
+   A key is hashed by calling hash_func_part() on each of its parts, between
+   hash_func_init() and hash_func_finalize().
+*/
+#define HASH_K1 0x9E3779B97F4A7C15ULL
+#define HASH_K2 0xBF58476D1CE4E5B9ULL
+
+static CFU_INLINE uint64_t
+hash_func_init(unsigned int seed) {
+	return seed ^ HASH_K1;
+}
+
+static CFU_INLINE uint64_t
+hash_func_mix(uint64_t hv, uint64_t word) {
+	hv = (hv ^ word) * HASH_K2;
+	return hv ^ (hv >> 31);
+}
+
+static CFU_INLINE uint64_t
+hash_func_part(uint64_t hv, const void *key, size_t length) {
+	const unsigned char *s = (const unsigned char *)key;
+	uint64_t word;
+	if (!key)
+		return hv;
+	for (; length >= 8; s += 8, length -= 8) {
+		memcpy(&word, s, 8);
+		hv = hash_func_mix(hv, word);
+	}
+	if (length) {
+		word = 0;
+		memcpy(&word, s, length);
+		hv = hash_func_mix(hv, word ^ ((uint64_t)length << 56));
+	}
+	return hv;
+}
+
+static CFU_INLINE unsigned int
+hash_func_finalize(uint64_t hv) {
+	hv ^= hv >> 33;
+	hv *= HASH_K1;
+	hv ^= hv >> 29;
+	return (unsigned int)(hv ^ (hv >> 32));
+}
+
+#endif
@@ -0,0 +1,507 @@
+/*
+ * openhash.c - open addressing hash table for the shm dicts
+ *
+ * See openhash.h.  The slots are kept in "Robin Hood" order: every slot
+ * stores the distance from the slot where its hash would place it, and an
+ * insertion takes the slot of any entry which is closer to its own
+ * position.  So, a lookup can stop as soon as it finds an entry with a
+ * shorter distance than the one probed so far, and deletions shift the
+ * following entries back instead of leaving tombstones.
+ */
+
+#include "openhash.h"
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+typedef struct openhash_slot {
+	uint32_t hash;
+	uint32_t dist;		/* probe distance + 1, or 0 for an empty slot */
+	void *key;
+	void *data;
+} openhash_slot;
+
+/* The capacity is stored together with the slots, so that lock-free
+   readers always see a consistent pair, even while the table is resized.
+   This holds only as long as the old array is not freed, see
+   free_unlinked().
+*/
+typedef struct openhash_array {
+	size_t capacity;	/* always a power of 2 */
+	openhash_slot slots[];
+} openhash_array;
+
+struct openhash_table {
+	size_t entries;
+	openhash_array *array;
+	unsigned int flags;
+	cfuhash_fieldspec_t *key_fieldspec;
+	unsigned int key_type;	/* see cfuhash_register_key_type(), or 0 */
+	cfuhash_malloc_fn_t malloc_fn;
+	cfuhash_free_fn_t free_fn;
+	unsigned long seq;	/* seqlock sequence, odd while a write is in progress */
+	unsigned int seed;	/* the seed of the hash functions */
+	float max_load;		/* the thresholds of the load factor */
+	float min_load;
+	size_t resized_count;
+};
+
+#define MIN_CAPACITY 8
+
+/* Free an array or a key which is no longer reachable from the table.  With
+   OPENHASH_LOCKFREE_READERS, a reader may still be using it, and freeing it
+   would overwrite its first word (e.g. the capacity of an array), so it is
+   left to the garbage collector, as in cfuhash.
+*/
+static CFU_INLINE void
+free_unlinked(openhash_table_t *ht, void *ptr) {
+	if (!(ht->flags & OPENHASH_LOCKFREE_READERS))
+		ht->free_fn(ptr);
+}
+
+/* see write_begin() in cfuhash.c */
+static void
+write_begin(openhash_table_t *ht) {
+	__atomic_store_n(&ht->seq, ht->seq + 1, __ATOMIC_RELAXED);
+	__atomic_thread_fence(__ATOMIC_RELEASE);
+}
+
+static void
+write_end(openhash_table_t *ht) {
+	__atomic_store_n(&ht->seq, ht->seq + 1, __ATOMIC_RELEASE);
+}
+
+static openhash_array *
+load_array(openhash_table_t *ht) {
+	return __atomic_load_n(&ht->array, __ATOMIC_ACQUIRE);
+}
+
+/* the capacity which gives a load factor of at most load */
+static size_t
+capacity_for(size_t entries, float load) {
+	size_t capacity = MIN_CAPACITY;
+	while (capacity * load < entries) capacity <<= 1;
+	return capacity;
+}
+
+static openhash_array *
+new_array(openhash_table_t *ht, size_t capacity) {
+	size_t size = sizeof(openhash_array) + capacity * sizeof(openhash_slot);
+	openhash_array *array = ht->malloc_fn(size);
+	if (!array)
+		return NULL;
+	memset(array, 0, size);
+	array->capacity = capacity;
+	return array;
+}
+
+/* The string keys are passed with key_size == -1, like for cfuhash: their
+   size includes the terminator, and NULL is compared by pointer.
+*/
+static CFU_INLINE size_t
+key_size_of(const void *key, size_t key_size) {
+	if (key_size == (size_t)(-1))
+		return key ? strlen(key) + 1 : 0;
+	return key_size;
+}
+
+static CFU_INLINE uint32_t
+key_hash(openhash_table_t *ht, const void *key, size_t key_size) {
+	if (key_size == 0)
+		return cfuhash_hash_pointer(key, ht->seed);
+	if (ht->key_fieldspec) {
+		const cfuhash_key_type_t *kt = cfuhash_find_key_type(ht->key_type);
+		if (kt)
+			return kt->hash(key, ht->seed);
+		return cfuhash_generic_hash_seeded(ht->key_fieldspec, key, ht->seed);
+	}
+	return cfuhash_hash(key, key_size, ht->seed);
+}
+
+static CFU_INLINE int
+key_equal(openhash_table_t *ht, const void *key, size_t key_size, int string,
+		  const void *other) {
+	if (key == other) return 1;
+	if (key_size == 0 || !other) return 0;
+	if (ht->key_fieldspec) {
+		const cfuhash_key_type_t *kt = cfuhash_find_key_type(ht->key_type);
+		if (kt)
+			return !kt->cmp(key, other);
+		return !cfuhash_generic_cmp(ht->key_fieldspec, key, other);
+	}
+	if (string)
+		return !strcmp(key, other);
+	return !memcmp(key, other, key_size);
+}
+
+/* Return the slot containing the key, or NULL.  The number of probes is
+   bounded, so that it terminates even if it reads a table which is being
+   modified.
+*/
+static openhash_slot *
+find_slot(openhash_table_t *ht, openhash_array *array, const void *key,
+		  size_t key_size, int string, uint32_t hash) {
+	size_t mask = array->capacity - 1;
+	size_t i = hash & mask;
+	uint32_t dist;
+
+	for (dist = 1; dist <= array->capacity; dist++) {
+		openhash_slot *slot = array->slots + i;
+		if (slot->dist < dist)
+			return NULL;
+		if (slot->hash == hash &&
+			key_equal(ht, key, key_size, string, slot->key))
+			return slot;
+		i = (i + 1) & mask;
+	}
+	return NULL;
+}
+
+/* Insert an entry which is not in the table yet.  There must be at least
+   one empty slot.
+*/
+static void
+place_entry(openhash_array *array, uint32_t hash, void *key, void *data) {
+	size_t mask = array->capacity - 1;
+	size_t i = hash & mask;
+	openhash_slot entry;
+
+	entry.hash = hash;
+	entry.dist = 1;
+	entry.key = key;
+	entry.data = data;
+	for (;;) {
+		openhash_slot *slot = array->slots + i;
+		if (!slot->dist) {
+			*slot = entry;
+			return;
+		}
+		if (slot->dist < entry.dist) {
+			openhash_slot tmp = *slot;
+			*slot = entry;
+			entry = tmp;
+		}
+		i = (i + 1) & mask;
+		entry.dist++;
+	}
+}
+
+/* Move the entries to a new array.  The stored hashes are reused, so the
+   keys are not even read.  Returns 1 if the table was resized, 0 if it
+   already had that capacity and -1 if the allocation failed.
+*/
+static int
+resize(openhash_table_t *ht, size_t capacity) {
+	openhash_array *old = ht->array;
+	openhash_array *array;
+	size_t i;
+
+	if (capacity == old->capacity)
+		return 0;
+	array = new_array(ht, capacity);
+	if (!array)
+		return -1;
+	for (i = 0; i < old->capacity; i++) {
+		openhash_slot *slot = old->slots + i;
+		if (slot->dist)
+			place_entry(array, slot->hash, slot->key, slot->data);
+	}
+	__atomic_store_n(&ht->array, array, __ATOMIC_RELEASE);
+	free_unlinked(ht, old);
+	ht->resized_count++;
+	return 1;
+}
+
+openhash_table_t *
+openhash_new_with_malloc_fn(cfuhash_malloc_fn_t malloc_fn,
+							cfuhash_free_fn_t free_fn) {
+	openhash_table_t *ht;
+
+	if (malloc_fn == NULL)
+		malloc_fn = malloc;
+	if (free_fn == NULL)
+		free_fn = free;
+
+	ht = malloc_fn(sizeof(openhash_table_t));
+	if (!ht)
+		return NULL;
+	memset(ht, 0, sizeof(openhash_table_t));
+	ht->malloc_fn = malloc_fn;
+	ht->free_fn = free_fn;
+	ht->seed = cfuhash_hash_pointer(ht, 0);	/* see cfuhash_new() */
+	ht->max_load = OPENHASH_MAX_LOAD;
+	ht->min_load = OPENHASH_MIN_LOAD;
+	ht->array = new_array(ht, MIN_CAPACITY);
+	if (!ht->array) {
+		free_fn(ht);
+		return NULL;
+	}
+	return ht;
+}
+
+int
+openhash_destroy(openhash_table_t *ht) {
+	size_t i;
+
+	if (!ht) return 0;
+	if (!(ht->flags & OPENHASH_NOCOPY_KEYS)) {
+		for (i = 0; i < ht->array->capacity; i++) {
+			openhash_slot *slot = ht->array->slots + i;
+			if (slot->dist && slot->key)
+				ht->free_fn(slot->key);
+		}
+	}
+	ht->free_fn(ht->array);
+	ht->free_fn(ht);
+	return 1;
+}
+
+unsigned int
+openhash_set_flag(openhash_table_t *ht, unsigned int new_flag) {
+	unsigned int flags = ht->flags;
+	ht->flags = flags | new_flag;
+	return flags;
+}
+
+int
+openhash_set_key_fieldspec(openhash_table_t *ht, cfuhash_fieldspec_t fs[]) {
+	ht->key_fieldspec = fs;
+	return 0;
+}
+
+int
+openhash_set_key_type(openhash_table_t *ht, unsigned int type_id) {
+	if (ht->entries)
+		return -1;
+	ht->key_type = type_id;
+	return 0;
+}
+
+int
+openhash_set_thresholds(openhash_table_t *ht, float low, float high) {
+	float h = high < 0 ? ht->max_load : high;
+	float l = low < 0 ? ht->min_load : low;
+
+	if (h < l || h >= 1) return -1;
+
+	ht->max_load = h;
+	ht->min_load = l;
+	return 0;
+}
+
+int
+openhash_get_data(openhash_table_t *ht, const void *key, size_t key_size,
+				  void **r, size_t *data_size) {
+	int string = (key_size == (size_t)(-1));
+	openhash_slot *slot;
+
+	if (!ht) return 0;
+	key_size = key_size_of(key, key_size);
+	slot = find_slot(ht, load_array(ht), key, key_size, string,
+					 key_hash(ht, key, key_size));
+	if (slot && r) {
+		*r = slot->data;
+		if (data_size) *data_size = 0;
+	}
+	return (slot ? 1 : 0);
+}
+
+int
+openhash_exists_data(openhash_table_t *ht, const void *key, size_t key_size) {
+	return openhash_get_data(ht, key, key_size, NULL, NULL);
+}
+
+int
+openhash_put_data(openhash_table_t *ht, const void *key, size_t key_size,
+				  void *data, size_t data_size, void **r) {
+	int string = (key_size == (size_t)(-1));
+	uint32_t hash;
+	openhash_slot *slot;
+
+	key_size = key_size_of(key, key_size);
+	hash = key_hash(ht, key, key_size);
+	slot = find_slot(ht, ht->array, key, key_size, string, hash);
+
+	write_begin(ht);
+	if (slot) {
+		if (r) *r = slot->data;
+		slot->data = data;
+	}
+	else {
+		void *new_key = (void *)key;
+		if (!(ht->flags & OPENHASH_NOCOPY_KEYS) && key_size) {
+			new_key = ht->malloc_fn(key_size);
+			if (!new_key) {
+				write_end(ht);
+				return -1;
+			}
+			memcpy(new_key, key, key_size);
+		}
+		/* if the table cannot grow, it can still take the entry as long
+		   as an empty slot is left, which place_entry() and the lookups
+		   need */
+		if (ht->entries + 1 > ht->array->capacity * ht->max_load &&
+			resize(ht, ht->array->capacity * 2) < 0 &&
+			ht->entries + 1 >= ht->array->capacity) {
+			if (new_key != key)
+				ht->free_fn(new_key);	/* never reachable by readers */
+			write_end(ht);
+			return -1;
+		}
+		place_entry(ht->array, hash, new_key, data);
+		ht->entries++;
+	}
+	write_end(ht);
+
+	return (slot ? 0 : 1);
+}
+
+size_t
+openhash_get_many(openhash_table_t *ht, void **keys, size_t key_size, size_t n,
+				  void **values, char *found) {
+	size_t i, count = 0;
+	for (i = 0; i < n; i++) {
+		found[i] = openhash_get_data(ht, keys[i], key_size,
+									 values ? values + i : NULL, NULL);
+		count += found[i];
+	}
+	return count;
+}
+
+size_t
+openhash_put_many(openhash_table_t *ht, void **keys, size_t key_size,
+				  void **values, size_t n) {
+	size_t i, count = 0;
+	for (i = 0; i < n; i++) {
+		int ret = openhash_put_data(ht, keys[i], key_size, values[i], 0, NULL);
+		if (ret < 0)
+			return (size_t)-1;
+		count += ret;
+	}
+	return count;
+}
+
+void *
+openhash_delete_data(openhash_table_t *ht, const void *key, size_t key_size) {
+	int string = (key_size == (size_t)(-1));
+	openhash_array *array = ht->array;
+	size_t mask = array->capacity - 1;
+	openhash_slot *slot;
+	void *old_key;
+	void *r;
+	size_t i;
+
+	key_size = key_size_of(key, key_size);
+	slot = find_slot(ht, array, key, key_size, string,
+					 key_hash(ht, key, key_size));
+	if (!slot)
+		return NULL;
+
+	write_begin(ht);
+	r = slot->data;
+	old_key = slot->key;
+	/* shift back the following entries, until one which is already in its
+	   own position */
+	i = slot - array->slots;
+	for (;;) {
+		openhash_slot *next = array->slots + ((i + 1) & mask);
+		if (next->dist <= 1)
+			break;
+		array->slots[i] = *next;
+		array->slots[i].dist--;
+		i = (i + 1) & mask;
+	}
+	memset(array->slots + i, 0, sizeof(openhash_slot));
+	ht->entries--;
+	if (!(ht->flags & OPENHASH_NOCOPY_KEYS) && key_size)
+		free_unlinked(ht, old_key);
+	if (array->capacity > MIN_CAPACITY &&
+		ht->entries < array->capacity * ht->min_load)
+		resize(ht, capacity_for(ht->entries,
+								(ht->min_load + ht->max_load) / 2));
+	write_end(ht);
+
+	return r;
+}
+
+/* Return a malloc()ed array with the keys.  The keys are never copied, so
+   "fast" is ignored.
+*/
+void **
+openhash_keys(openhash_table_t *ht, size_t *num_keys, int fast) {
+	openhash_array *array = load_array(ht);
+	size_t entries = ht->entries;
+	void **keys = malloc(sizeof(void *) * (entries ? entries : 1));
+	size_t i, n = 0;
+
+	if (!keys)
+		return NULL;
+	for (i = 0; i < array->capacity && n < entries; i++) {
+		if (array->slots[i].dist)
+			keys[n++] = array->slots[i].key;
+	}
+	*num_keys = n;
+	return keys;
+}
+
+size_t
+openhash_next_entries(openhash_table_t *ht, size_t cursor[2], void **keys,
+					  void **values, size_t max) {
+	openhash_array *array = load_array(ht);
+	size_t count = 0;
+	size_t i;
+
+	for (i = cursor[0]; i < array->capacity && count < max; i++) {
+		openhash_slot *slot = array->slots + i;
+		if (slot->dist) {
+			keys[count] = slot->key;
+			if (values) values[count] = slot->data;
+			count++;
+		}
+	}
+	cursor[0] = i;
+	return count;
+}
+
+size_t
+openhash_num_entries(openhash_table_t *ht) {
+	if (!ht) return 0;
+	return ht->entries;
+}
+
+size_t
+openhash_capacity(openhash_table_t *ht) {
+	if (!ht) return 0;
+	return load_array(ht)->capacity;
+}
+
+int
+openhash_reserve(openhash_table_t *ht, size_t n) {
+	int ret;
+	size_t capacity = capacity_for(n, ht->max_load);
+
+	if (capacity <= ht->array->capacity)
+		return 0;
+	write_begin(ht);
+	ret = resize(ht, capacity);
+	write_end(ht);
+	return ret < 0 ? 0 : ret;
+}
+
+size_t
+openhash_num_rehashes(openhash_table_t *ht) {
+	if (!ht) return 0;
+	return ht->resized_count;
+}
+
+unsigned long
+openhash_version(openhash_table_t *ht) {
+	if (!ht) return 0;
+	return __atomic_load_n(&ht->seq, __ATOMIC_ACQUIRE) / 2;
+}
+
+unsigned long *
+openhash_seqlock(openhash_table_t *ht) {
+	return &ht->seq;
+}
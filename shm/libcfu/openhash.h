@@ -0,0 +1,88 @@
+/*
+ * openhash.h - open addressing hash table for the shm dicts
+ *
+ * It is an alternative to cfuhash: the entries are stored in a single
+ * contiguous array of slots, together with their hash, and collisions are
+ * resolved by linear probing with Robin Hood hashing.  There is no
+ * per-entry allocation and a lookup touches (usually) a single cache line.
+ *
+ * The API mirrors the subset of cfuhash used by shm/dict.py, and the keys
+ * are hashed and compared in the same way:
+ *
+ *   - key_size == 0: the key is compared by pointer;
+ *
+ *   - key_size == (size_t)-1: the key is a null-terminated string;
+ *
+ *   - otherwise, the key is a block of key_size bytes, compared with the
+ *     key fieldspec if any, else with memcmp.
+ *
+ * The table is not thread-safe: writers must be serialized by the caller.
+ * Readers may use the seqlock returned by openhash_seqlock() to read
+ * without locks, see shm/seqlock.py.  The data_size of cfuhash is not
+ * stored.
+ */
+
+#ifndef OPENHASH_H_
+#define OPENHASH_H_
+
+#include "cfuhash.h"
+
+CFU_BEGIN_DECLS
+
+typedef struct openhash_table openhash_table_t;
+
+/* the flags have the same meaning as for cfuhash; only
+ * CFUHASH_NOCOPY_KEYS and CFUHASH_LOCKFREE_READERS are used, the table never
+ * takes locks
+ */
+#define OPENHASH_NOCOPY_KEYS CFUHASH_NOCOPY_KEYS
+#define OPENHASH_LOCKFREE_READERS CFUHASH_LOCKFREE_READERS
+
+/* the default maximum load factor, after which the table grows, and the
+ * minimum one, before which it shrinks.  After a resize, the load factor is
+ * halfway between them, i.e. 0.5
+ */
+#define OPENHASH_MAX_LOAD 0.8
+#define OPENHASH_MIN_LOAD 0.2
+
+openhash_table_t * openhash_new_with_malloc_fn(cfuhash_malloc_fn_t malloc_fn,
+                                               cfuhash_free_fn_t free_fn);
+int openhash_destroy(openhash_table_t *ht);
+
+unsigned int openhash_set_flag(openhash_table_t *ht, unsigned int new_flag);
+int openhash_set_key_fieldspec(openhash_table_t *ht, cfuhash_fieldspec_t fs[]);
+int openhash_set_key_type(openhash_table_t *ht, unsigned int type_id);
+/* Same as cfuhash_set_thresholds(), but high must be below 1 */
+int openhash_set_thresholds(openhash_table_t *ht, float low, float high);
+
+/* Same as the cfuhash equivalents, except that openhash_put_data() returns
+ * -1 if it cannot allocate memory, and openhash_put_many() then stops and
+ * returns (size_t)-1
+ */
+int openhash_get_data(openhash_table_t *ht, const void *key, size_t key_size,
+                      void **r, size_t *data_size);
+int openhash_exists_data(openhash_table_t *ht, const void *key, size_t key_size);
+int openhash_put_data(openhash_table_t *ht, const void *key, size_t key_size,
+                      void *data, size_t data_size, void **r);
+void * openhash_delete_data(openhash_table_t *ht, const void *key, size_t key_size);
+size_t openhash_get_many(openhash_table_t *ht, void **keys, size_t key_size,
+                         size_t n, void **values, char *found);
+size_t openhash_put_many(openhash_table_t *ht, void **keys, size_t key_size,
+                         void **values, size_t n);
+void **openhash_keys(openhash_table_t *ht, size_t *num_keys, int fast);
+/* cursor[0] is the index of the slot, cursor[1] is unused */
+size_t openhash_next_entries(openhash_table_t *ht, size_t cursor[2],
+                             void **keys, void **values, size_t max);
+
+size_t openhash_num_entries(openhash_table_t *ht);
+/* the number of slots, i.e. the number of entries it can contain */
+size_t openhash_capacity(openhash_table_t *ht);
+/* Same as the cfuhash equivalents */
+int openhash_reserve(openhash_table_t *ht, size_t n);
+size_t openhash_num_rehashes(openhash_table_t *ht);
+unsigned long openhash_version(openhash_table_t *ht);
+unsigned long *openhash_seqlock(openhash_table_t *ht);
+
+CFU_END_DECLS
+
+#endif
@@ -1,9 +1,9 @@
 import cffi
 import _cffi_backend
-from shm.sharedmem import sharedmem
 from shm.converter import Dummy
 from shm.util import ctype_pointer_to, cffi_typeof, cffi_is_pointer
 from shm.pyffi import AbstractGenericType
+from shm.seqlock import ShmSeqLock
 
 listffi = cffi.FFI()
 
@@ -13,22 +13,32 @@ listffi.cdef("""
         long length; // number of actually used items
         long offset;  // this is used only by deque
         void* items;
+        unsigned long seq;   // seqlock sequence, see shm/seqlock.py
     } List;
 """)
 
 class ListType(AbstractGenericType):
 
-    def __init__(self, pyffi, itemtype, listclass=None, immutable=False):
+    def __init__(self, pyffi, itemtype, listclass=None, immutable=False,
+                 compiled_hash=False):
         self.pyffi = pyffi
         self.ffi = pyffi.ffi
         self.itemtype = itemtype
         self.itemtype_ptr = ctype_pointer_to(self.ffi, itemtype)
         self.itemtype_is_pointer = cffi_is_pointer(self.ffi, itemtype)
+        # arrays of primitives cannot contain GC pointers: the GC does not
+        # need to scan them
+        self.itemtype_is_primitive = (
+            cffi_typeof(self.ffi, itemtype).kind == 'primitive')
         self.__immutable__ = immutable
         if immutable:
             defaultclass = ImmutableList
             self.__fieldspec__ = self.make_fieldspec()
+            if compiled_hash:
+                self.__fieldspec__.compile()
         else:
+            if compiled_hash:
+                raise TypeError("compiled_hash requires an immutable list")
             defaultclass = FixedSizeList
             self.__fieldspec__ = None
         self.listclass = listclass or defaultclass
@@ -36,7 +46,7 @@ class ListType(AbstractGenericType):
         # if it's a primitive we do not need a converter, because the
         # conversion is already performed automatically by typeditems, which
         # is a typed cffi array
-        if cffi_typeof(self.ffi, itemtype).kind == 'primitive':
+        if self.itemtype_is_primitive:
             self.conv = Dummy(self.ffi, itemtype)
         else:
             self.conv = pyffi.get_converter(itemtype)
@@ -58,14 +68,17 @@ class ListType(AbstractGenericType):
         return '<shm type list [%s]>' % self.itemtype
 
     def __call__(self, items=None, root=True):
+        sharedmem = self.pyffi.sharedmem
         with sharedmem.gc_disabled:
             ptr = sharedmem.new(listffi, 'List*', root)
             # even for empty lists, we start by allocating 2 items, and then
             # growing
-            ptr.items = sharedmem.new_array(self.ffi, self.itemtype, 2)
+            ptr.items = sharedmem.new_array(self.ffi, self.itemtype, 2,
+                                            atomic=self.itemtype_is_primitive)
             ptr.size = 2
             ptr.length = 0
             ptr.offset = 0
+            ptr.seq = 0
         lst = self.listclass.from_pointer(self, ptr)
         lst._setcontent(items)
         return lst
@@ -92,17 +105,60 @@ class ImmutableList(object):
     def as_cdata(self):
         return self.lst
 
+    @property
+    def version(self):
+        """
+        A counter which is incremented by every modification: readers can
+        compare it with a previous value to know whether the list changed.
+        """
+        return self.lst.seq // 2
+
+    @property
+    def seqlock(self):
+        """
+        The ShmSeqLock which protects the list: the modifications are done
+        while holding it.
+        """
+        try:
+            return self._seqlock
+        except AttributeError:
+            self._seqlock = ShmSeqLock.from_pointer(
+                listffi.addressof(self.lst[0], 'seq'))
+            return self._seqlock
+
+    def optimistic_read(self, fn, *args):
+        """
+        Call fn(*args) without taking any lock, retrying until it did not
+        run concurrently with a modification of the list. E.g.:
+
+            item = lst.optimistic_read(lst.__getitem__, 3)
+        """
+        return self.seqlock.read(fn, *args)
+
     @property
     def typeditems(self):
         t = self.listtype
         return t.ffi.cast(t.itemtype_ptr, self.lst.items)
 
-    def _grow(self, newsize):
+    def _new_items(self, newsize):
+        """
+        Return a new array of ``newsize`` items, starting with a copy of the
+        current ones. Unlike realloc_array(), the old array is not freed:
+        lock-free readers (see optimistic_read()) may still be reading it,
+        and it is left to the GC.
+        """
         t = self.listtype
+        items = t.pyffi.sharedmem.new_array(t.ffi, t.itemtype, newsize,
+                                            atomic=t.itemtype_is_primitive)
+        t.ffi.memmove(items, self.typeditems,
+                      self.lst.size * t.ffi.sizeof(t.itemtype))
+        return items
+
+    def _grow(self, newsize):
         lst = self.lst
         if newsize <= lst.size:
             return
-        lst.items = sharedmem.realloc_array(t.ffi, t.itemtype, lst.items, newsize)
+        lst.items = self._new_items(newsize)
         lst.size = newsize
 
     def _setitem(self, n, item):
@@ -156,7 +212,8 @@ class FixedSizeList(ImmutableList):
 
     def __setitem__(self, i, item):
         i = self._getindex(i)
-        self._setitem(i, item)
+        with self.seqlock:
+            self._setitem(i, item)
 
 
 class ResizableList(FixedSizeList):
@@ -167,9 +224,10 @@ class ResizableList(FixedSizeList):
 
     def append(self, item):
         lst = self.lst
-        if lst.size <= lst.length:
-            self._grow(lst.size*2)
-        n = lst.length
-        lst.length += 1
-        n = self._itemindex(n)
-        self._setitem(n, item)
+        with self.seqlock:
+            if lst.size <= lst.length:
+                self._grow(lst.size*2)
+            n = lst.length
+            lst.length += 1
+            n = self._itemindex(n)
+            self._setitem(n, item)
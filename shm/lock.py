@@ -3,7 +3,7 @@ import errno
 from shm.pthread import pthread
 from shm.sharedmem import sharedmem
 
-def _new_mutex():
+def _new_mutex(sharedmem):
 	attr = pthread.ffi.new('pthread_mutexattr_t*')
 	pthread.checked.mutexattr_init(attr)
 	pthread.checked.mutexattr_setpshared(attr, pthread.PROCESS_SHARED)
@@ -18,13 +18,17 @@ def _new_mutex():
 
 class ShmLock(object):
 
-    def __init__(self):
-        self.mutex = _new_mutex()
+    def __init__(self, sharedmem=sharedmem):
+        self.sharedmem = sharedmem
+        self.mutex = _new_mutex(sharedmem)
         self.owning = True
     
     @classmethod
-    def from_pointer(cls, addr):
+    def from_pointer(cls, addr, sharedmem=sharedmem):
         self = cls.__new__(cls)
+        self.sharedmem = sharedmem
+        # the mutex can be in a RW chunk which we have not seen yet
+        sharedmem.refresh_rw_area()
         self.mutex = pthread.ffi.cast('pthread_mutex_t*', addr)
         self.owning = False
         return self
@@ -35,6 +39,7 @@ class ShmLock(object):
     def __del__(self):
         if self.owning:
             pthread.checked.mutex_destroy(self.mutex)
+            self.sharedmem.free_rw(self.mutex)
 
     def acquire(self):
         ret = pthread.mutex_lock(self.mutex)
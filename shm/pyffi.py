@@ -1,3 +1,4 @@
+from shm.sharedmem import sharedmem as default_sharedmem
 from shm.struct import make_struct
 from shm import converter
 from shm.util import (cffi_typeof, cffi_is_struct_ptr, cffi_is_string,
@@ -12,10 +13,15 @@ class PyFFI(object):
     """
     Wrap the types in the given ffi into nice Python objects.
     This is the main entry-point for the shm package.
+
+    The objects are allocated in the heap of ``sharedmem``, by default the
+    one of shm.sharedmem.sharedmem: use sharedmem.get_sharedmem() to get the
+    ones of the other heaps.
     """
 
-    def __init__(self, ffi):
+    def __init__(self, ffi, sharedmem=None):
         self.ffi = ffi
+        self.sharedmem = sharedmem or default_sharedmem
         self.pytypes = {} # ctype --> python class
         self._converters = {}
 
@@ -23,6 +29,11 @@ class PyFFI(object):
         """
         Create a struct type. ``t`` must be a valid typename already defined
         in the ffi.
+
+        If ``compiled_hash`` is True, the functions which hash and compare
+        the struct when used as a dict key are compiled to C, instead of
+        interpreting its fieldspec at each lookup. The same option exists
+        for immutable lists.
         """
         ctype = cffi_typeof(self.ffi, t)
         cls = make_struct(self, ctype, **kwds)
@@ -132,7 +143,7 @@ class PyFFI(object):
             cls = self.pytypeof(ctype)
             return converter.StructByVal(self.ffi, ctype, cls)
         if cffi_is_string(self.ffi, ctype):
-            return converter.String(self.ffi, ctype)
+            return converter.String(self.ffi, ctype, self.sharedmem)
         elif cffi_is_char_array(self.ffi, ctype):
             return converter.ArrayOfChar(self.ffi, ctype)
         elif cffi_is_double(self.ffi, ctype):
@@ -0,0 +1,128 @@
+import time
+from cffi import FFI
+from shm.util import CNamespace
+from shm.sharedmem import sharedmem
+
+ffi = FFI()
+ffi.cdef("""
+    unsigned long seqlock_read_begin(unsigned long *seq);
+    bool seqlock_read_retry(unsigned long *seq, unsigned long start);
+    void seqlock_write_begin(unsigned long *seq);
+    void seqlock_write_end(unsigned long *seq);
+""")
+
+lib = ffi.verify("""
+    #include <stdbool.h>
+
+    unsigned long seqlock_read_begin(unsigned long *seq)
+    {
+        return __atomic_load_n(seq, __ATOMIC_ACQUIRE);
+    }
+
+    bool seqlock_read_retry(unsigned long *seq, unsigned long start)
+    {
+        __atomic_thread_fence(__ATOMIC_ACQUIRE);
+        return (start & 1) || __atomic_load_n(seq, __ATOMIC_RELAXED) != start;
+    }
+
+    void seqlock_write_begin(unsigned long *seq)
+    {
+        __atomic_store_n(seq, *seq + 1, __ATOMIC_RELAXED);
+        __atomic_thread_fence(__ATOMIC_RELEASE);
+    }
+
+    void seqlock_write_end(unsigned long *seq)
+    {
+        __atomic_store_n(seq, *seq + 1, __ATOMIC_RELEASE);
+    }
+""")
+
+seqlock = CNamespace(lib, 'seqlock_')
+
+
+class ShmSeqLock(object):
+    """
+    Cross-process sequence lock, for read-mostly data.
+
+    The writer encloses every modification between wr_acquire() and
+    wr_release(), which make the sequence number odd and then even again.
+    Readers do not lock anything: they read the sequence number before and
+    after reading the data, and retry if it was odd or changed in the
+    meantime. So, reads cost no syscalls and do not block the writer.
+
+    The lock does not exclude writers from each other: if there is more than
+    one writer, they must be serialized, e.g. with a ShmLock.
+
+    A reader can see the data in an inconsistent state before retrying, so
+    it must not act on what it reads until read() returns. Loading from
+    freed memory is harmless, since the GC heap stays mapped, but following
+    a pointer read from it is not: freeing an object overwrites its first
+    word. So, the writer must not free explicitly what a reader might still
+    reach; the shm dicts leave the memory they remove to the collector,
+    which runs only in the writer process, when it is unreachable. A reader
+    could still see it reused only if it stalled across a whole collection.
+    """
+
+    def __init__(self, sharedmem=sharedmem):
+        self.seq = sharedmem.new(ffi, 'unsigned long*')
+        self.seq[0] = 0
+
+    @classmethod
+    def from_pointer(cls, addr):
+        self = cls.__new__(cls)
+        self.seq = ffi.cast('unsigned long*', addr)
+        return self
+
+    def as_cdata(self):
+        return self.seq
+
+    @property
+    def sequence(self):
+        return self.seq[0]
+
+    def wr_acquire(self):
+        seqlock.write_begin(self.seq)
+
+    def wr_release(self):
+        seqlock.write_end(self.seq)
+
+    def __enter__(self):
+        self.wr_acquire()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.wr_release()
+
+    def rd_begin(self):
+        """
+        Start an optimistic read: return the sequence number to pass to
+        rd_retry(). Wait while a write is in progress.
+        """
+        start = seqlock.read_begin(self.seq)
+        while start & 1:
+            time.sleep(0)
+            start = seqlock.read_begin(self.seq)
+        return start
+
+    def rd_retry(self, start):
+        """
+        Return True if the data read since rd_begin() might be inconsistent
+        and must be read again.
+        """
+        return seqlock.read_retry(self.seq, start)
+
+    def read(self, fn, *args):
+        """
+        Call fn(*args) until it runs without a concurrent write, and return
+        its result. Exceptions are propagated only if they are not caused
+        by a concurrent write.
+        """
+        while True:
+            start = self.rd_begin()
+            try:
+                res = fn(*args)
+            except Exception:
+                if self.rd_retry(start):
+                    continue
+                raise
+            if not self.rd_retry(start):
+                return res
@@ -14,8 +14,12 @@ class SetType(AbstractGenericType):
     def __repr__(self):
         return '<shm type set [%s]>' % self.itemtype
 
-    def __call__(self, init=None, root=True):
-        d = self.DT(root=root)
+    def __call__(self, init=None, root=True, expected_size=None,
+                 load_factor=None):
+        if expected_size is None and hasattr(init, '__len__'):
+            expected_size = len(init)
+        d = self.DT(root=root, expected_size=expected_size,
+                    load_factor=load_factor)
         s = SetInstance(self, d)
         if init is not None:
             for item in init:
@@ -39,6 +43,10 @@ class SetInstance(object):
     def as_cdata(self):
         return self.d.ht
 
+    @property
+    def version(self):
+        return self.d.version
+
     def add(self, item):
         self.d[item] = 1
 
@@ -55,7 +63,10 @@ class SetInstance(object):
         return item in self.d
 
     def __iter__(self):
-        return iter(self.d.keys())
+        return self.d.iterkeys()
 
     def __len__(self):
         return len(self.d)
+
+    def reserve(self, n):
+        self.d.reserve(n)
@@ -1,4 +1,5 @@
 import os
+import threading
 import cffi
 from shm import gclib
 
@@ -6,49 +7,101 @@ class Uninitialized_shm(object):
 
     gclib = gclib
     path = None
+
+    def __init__(self, heap=None):
+        # heap is a gclib.Heap: by default, we use the default heap. Store it
+        # on the instance, because init() and open_readonly() change our class
+        self.gclib = heap or self.gclib
     
-    def init(self, path):
-        self.gclib.init(path)
+    def init(self, path, **options):
+        # see gclib.Heap.init() for the options
+        self.gclib.init(path, **options)
         self.path = path
         self.__class__ = RW_shm
     
-    def open_readonly(self, path):
-        self.gclib.open_readonly(path)
+    def open_readonly(self, path, **options):
+        # see gclib.Heap.open_readonly() for the options
+        self.gclib.open_readonly(path, **options)
         self.path = path
+        self._scratch = threading.local()
         self.__class__ = RO_shm
 
 
 class RW_shm(object):
 
-    def init(self, path):
+    def init(self, path, **options):
         if path == self.path:
             return
         raise ValueError('sharedmem already initialized: %s' % self.path)
 
-    def open_readonly(self, path):
+    def open_readonly(self, path, **options):
         raise ValueError('sharedmem already initialized in RW mode: %s' % self.path)
 
-    new = staticmethod(gclib.new)
-    new_array = staticmethod(gclib.new_array)
-    new_string = staticmethod(gclib.new_string)
-    realloc_array = staticmethod(gclib.realloc_array)
-    gc_disabled = gclib.disabled
-    get_GC_malloc = gclib.lib.get_GC_malloc
-    get_GC_free = gclib.lib.get_GC_free
-    roots = gclib.roots
+    def new(self, ffi, t, root=True, rw=False):
+        return self.gclib.new(ffi, t, root, rw)
+
+    def new_array(self, ffi, t, n, root=True, rw=False, atomic=False):
+        return self.gclib.new_array(ffi, t, n, root, rw, atomic)
+
+    def new_string(self, s, root=True):
+        return self.gclib.new_string(s, root)
+
+    def realloc_array(self, ffi, t, ptr, n):
+        return self.gclib.realloc_array(ffi, t, ptr, n)
+
+    def free_rw(self, ptr):
+        self.gclib.free_rw(ptr)
+
+    def rw_stats(self):
+        return self.gclib.rw_stats()
+
+    def refresh_rw_area(self):
+        self.gclib.refresh_rw_area()
+
+    @property
+    def gc_disabled(self):
+        return self.gclib.disabled
+
+    def get_GC_malloc(self):
+        return self.gclib.lib.get_GC_malloc()
+
+    def get_GC_free(self):
+        return self.gclib.lib.get_GC_free()
+
+    @property
+    def roots(self):
+        return self.gclib.roots
+
+    def add_root(self, ffi, ptr, einfo='<unknown>'):
+        return self.gclib.add_root(ffi, ptr, einfo)
+
+    def root_scope(self):
+        return self.gclib.root_scope()
+
+    def scratch(self):
+        # the objects allocated here are collected by the GC: nothing to do
+        return no_scratch
+
+    def publish_extents(self):
+        return self.gclib.publish_extents()
+
+    def stats(self):
+        return self.gclib.stats()
 
     def protect(self):
         """
         Protect the shared memory against writing. It is still possible to
         read it.
         """
-        gclib.protect_GC_memory(gclib.lib.PROT_READ)
+        lib = self.gclib.lib
+        self.gclib.protect_GC_memory(lib.PROT_READ)
 
     def unprotect(self):
         """
         Undo the effect of protect. The GC memory is turned Read/Write again.
         """
-        gclib.protect_GC_memory(gclib.lib.PROT_READ | gclib.lib.PROT_WRITE)
+        lib = self.gclib.lib
+        self.gclib.protect_GC_memory(lib.PROT_READ | lib.PROT_WRITE)
 
 
 class DummyContextManager(object):
@@ -58,6 +111,36 @@ class DummyContextManager(object):
     def __exit__(self, exc, exctype, tb):
         pass
 
+no_scratch = DummyContextManager()
+
+
+class ScratchArena(object):
+    """
+    Keep alive the memory allocated by RO_shm while the arena is active,
+    i.e. inside its ``with`` block, and then for as long as the arena itself
+    is alive. Arenas are per thread, and can be nested.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.ptrs = []
+
+    def __enter__(self):
+        self.frames.append(self)
+        return self
+
+    def __exit__(self, exc, exctype, tb):
+        self.frames.pop()
+
+    def __len__(self):
+        return len(self.ptrs)
+
+    def adopt(self, other):
+        """
+        Keep alive also the memory of the ``other`` arena.
+        """
+        self.ptrs += other.ptrs
+
 class RO_shm(object):
 
     ffi = cffi.FFI()
@@ -66,10 +149,10 @@ class RO_shm(object):
     """)
     lib = ffi.verify("#include <stdlib.h>")
 
-    def init(self, path):
+    def init(self, path, **options):
         raise ValueError('sharedmem already opened in RO mode: %s' % self.path)
 
-    def open_readonly(self, path):
+    def open_readonly(self, path, **options):
         if path == self.path:
             return
         raise ValueError('sharedmem already opened: %s' % self.path)
@@ -81,39 +164,79 @@ class RO_shm(object):
     realloc_array = _not_implemented
     get_GC_malloc = _not_implemented
     get_GC_free = _not_implemented
+    free_rw = _not_implemented
+    rw_stats = _not_implemented
     roots = property(_not_implemented)
+    add_root = _not_implemented
+    root_scope = _not_implemented
+    publish_extents = _not_implemented
+
+    # In read-only mode we cannot allocate in the shared memory, so new*()
+    # return process-local memory. The caller owns the returned cdata; the
+    # memory is also kept alive by the innermost active scratch arena, if
+    # any: this is needed when it is referenced only from C, e.g. a string
+    # stored in a struct field.
 
-    # XXX: __keepalive is never shrinked, so we are leaking memory right now :-(
-    __keepalive = []
+    def scratch(self):
+        """
+        Return a new ScratchArena, to be used in a ``with`` statement.
+        """
+        try:
+            frames = self._scratch.frames
+        except AttributeError:
+            frames = self._scratch.frames = []
+        return ScratchArena(frames)
+
+    def _keepalive(self, ptr):
+        frames = getattr(self._scratch, 'frames', None)
+        if frames:
+            frames[-1].ptrs.append(ptr)
+        return ptr
     
     def new(self, ffi, t, root=True):
-        ptr = ffi.new(t)
-        self.__keepalive.append(ptr)
-        return ptr
+        return self._keepalive(ffi.new(t))
 
     def new_string(self, s, root=True):
-        ptr = self.ffi.new('char[]', s)
-        self.__keepalive.append(ptr)
-        return ptr
+        return self._keepalive(self.ffi.new('char[]', s))
 
-    def new_array(self, ffi, t, n, root=True):
-        ptr = ffi.new(t+'[]', n)
-        self.__keepalive.append(ptr)
-        return ptr
+    def new_array(self, ffi, t, n, root=True, atomic=False):
+        return self._keepalive(ffi.new(t+'[]', n))
 
     gc_disabled = DummyContextManager()
 
+    def refresh_rw_area(self):
+        self.gclib.refresh_rw_area()
+
+    def prefetch(self, *objs):
+        return self.gclib.prefetch(*objs)
+
+    def stats(self):
+        return self.gclib.stats()
+
     def protect(self):
         """
         Protect the shared memory against reading or writing.
         """
-        gclib.protect_GC_memory(gclib.lib.PROT_NONE)
+        self.gclib.protect_GC_memory(self.gclib.lib.PROT_NONE)
 
     def unprotect(self):
         """
         Undo the effect of protect. The GC memory is turned Read-only again.
         """
-        gclib.protect_GC_memory(gclib.lib.PROT_READ)
+        self.gclib.protect_GC_memory(self.gclib.lib.PROT_READ)
 
 
 sharedmem = Uninitialized_shm()
+_sharedmems = {0: sharedmem}
+
+def get_sharedmem(heap):
+    """
+    Return the sharedmem object of the heap number ``heap``: it must be
+    initialized or opened on its own, with a different path than the other
+    heaps.
+    """
+    try:
+        return _sharedmems[heap]
+    except KeyError:
+        shm = _sharedmems[heap] = Uninitialized_shm(gclib.get_heap(heap))
+        return shm
@@ -3,10 +3,12 @@ from shm.sharedmem import sharedmem
 from shm.util import (cffi_typeof, cffi_is_struct_ptr, cffi_is_string,
                       cffi_is_char_array, compile_def, identity, ctype_pointer_to)
 
-def make_struct(pyffi, ctype, immutable=True, converters=None):
+def make_struct(pyffi, ctype, immutable=True, converters=None,
+                compiled_hash=False):
     struct_ctype = ctype
     ptr_ctype = ctype_pointer_to(pyffi.ffi, ctype)
-    decorate = StructDecorator(pyffi, ptr_ctype, immutable, converters)
+    decorate = StructDecorator(pyffi, ptr_ctype, immutable, converters,
+                               compiled_hash)
     class MyStruct(BaseStruct):
         __slots__ = ()
         class __metaclass__(type):
@@ -20,7 +22,7 @@ def make_struct(pyffi, ctype, immutable=True, converters=None):
 
 
 class BaseStruct(object):
-    __slots__ = ('_ptr',)
+    __slots__ = ('_ptr', '_root')
 
     @classmethod
     def from_pointer(cls, ptr, force_cast=False):
@@ -43,11 +45,15 @@ class StructDecorator(object):
     expected to be a subclass of BaseStruct
     """
 
-    def __init__(self, pyffi, ctype, immutable=True, converters=None):
+    def __init__(self, pyffi, ctype, immutable=True, converters=None,
+                 compiled_hash=False):
         self.pyffi = pyffi
         self.ffi = pyffi.ffi
         self.ctype = cffi_typeof(self.ffi, ctype)
         self.immutable = immutable
+        if compiled_hash and not immutable:
+            raise TypeError("compiled_hash requires an immutable struct")
+        self.compiled_hash = compiled_hash
         if not cffi_is_struct_ptr(self.ffi, self.ctype):
             raise TypeError("ctype must be a pointer to a struct, got %s" % self.ctype)
         self.fieldnames = [name for name, field in self.ctype.item.fields]
@@ -61,6 +67,8 @@ class StructDecorator(object):
         if self.immutable:
             self.add_key(cls)
             cls.__fieldspec__ = self.make_fieldspec(cls)
+            if self.compiled_hash and cls.__fieldspec__ is not None:
+                cls.__fieldspec__.compile()
         #
         for name, field in self.ctype.item.fields:
             self.add_property(cls, name, field)
@@ -68,9 +76,14 @@ class StructDecorator(object):
 
     def add_ctor(self, cls):
         # def _init(self, x, y):
-        #     self._ptr = sharedmem.new(self.pyffi.ffi, self.ctype)
-        #     self.__set_x(x)
-        #     self.__set_y(y)
+        #     with sharedmem.scratch() as scratch:
+        #         self._ptr = sharedmem.new(self.pyffi.ffi, self.ctype)
+        #         self.__set_x(x)
+        #         self.__set_y(y)
+        #     self._root = scratch
+        #
+        # in read-only mode, the scratch arena keeps alive the memory
+        # referenced by the fields (e.g. strings) as long as the struct
         #
         # def __init__(self, x, y):
         #     self._init(x, y)
@@ -81,8 +94,10 @@ class StructDecorator(object):
             line = 'self.__set_{x}({x})'.format(x=fieldname)
             bodylines.append(line)
         body = py.code.Source(bodylines)
+        body = body.putaround('with sharedmem.scratch() as scratch:',
+                              'self._root = scratch')
         _init = body.putaround('def _init(self, %s, sharedmem=sharedmem):' % paramlist)
-        cls._init = compile_def(_init, sharedmem=sharedmem)
+        cls._init = compile_def(_init, sharedmem=self.pyffi.sharedmem)
         #
         # we add the proper __init__ only if it's not already defined
         if '__init__' in cls.__dict__:
@@ -144,9 +159,24 @@ class StructDecorator(object):
         if self.immutable:
             p = property(getter)
         else:
-            p = property(getter, setter)
+            p = property(getter, self.scratch_setter(setter))
         setattr(cls, fieldname, p)
 
+    def scratch_setter(self, setter):
+        # in read-only mode, the memory allocated when setting the field is
+        # kept alive by the struct
+        sharedmem = self.pyffi.sharedmem
+        def set(self, value):
+            with sharedmem.scratch() as scratch:
+                setter(self, value)
+            if scratch:
+                root = getattr(self, '_root', None)
+                if root is None:
+                    self._root = scratch
+                else:
+                    root.adopt(scratch)
+        return set
+
     def get_converter(self, fieldname, field):
         conv = self.converters.get(fieldname)
         if conv is not None:
@@ -1,6 +1,7 @@
 import py
 import cffi
 from shm import gclib
+from shm.testing.util import exec_child
 gclib.init('/cffi-shm-testing')
 
 ffi = cffi.FFI()
@@ -9,6 +10,12 @@ ffi.cdef("""
         int x;
         int y;
     } Point;
+
+    typedef struct {
+        long x;
+        void* p;
+        long y;
+    } Mixed;
 """)
 
 def test_gc_memory():
@@ -46,6 +53,94 @@ def test_new_array():
     assert ffi.typeof(arr) is ffi.typeof('Point[10]')
     assert ffi.sizeof(arr) == 10 * ffi.sizeof('Point')
 
+def test_new_array_atomic():
+    def addr(p):
+        return int(ffi.cast('long', p))
+    #
+    def setup(atomic, size):
+        arr = gclib.new_array(ffi, 'long', 1, atomic=atomic)
+        arr[0] = addr(gclib.lib.GC_malloc(size))
+        return arr
+    #
+    def is_collected(atomic, size):
+        # allocate in another frame, to avoid leaving the address of the
+        # object on the stack
+        arr = setup(atomic, size)
+        gclib.collect()
+        with gclib.disabled:
+            addrs = [addr(gclib.lib.GC_malloc(size)) for i in range(1000)]
+        return arr[0] in addrs
+    #
+    # the numbers inside an atomic array are not considered pointers
+    assert not is_collected(atomic=False, size=1100)
+    assert is_collected(atomic=True, size=1200)
+
+def test_new_precise_layout():
+    def addr(p):
+        return int(ffi.cast('long', p))
+    #
+    def setup(n, size_x, size_p):
+        if n is None:
+            arr = gclib.new(ffi, 'Mixed*')
+            n = 1
+        else:
+            arr = gclib.new_array(ffi, 'Mixed', n)
+        for i in range(n):
+            arr[i].x = addr(gclib.lib.GC_malloc(size_x))
+            arr[i].p = gclib.lib.GC_malloc(size_p)
+        return arr
+    #
+    def collected(arr, size_x, size_p):
+        gclib.collect()
+        with gclib.disabled:
+            addrs = set(addr(gclib.lib.GC_malloc(size)) for size in
+                        [size_x, size_p] for i in range(1000))
+        return ([arr[i].x in addrs for i in range(len(arr))],
+                [addr(arr[i].p) in addrs for i in range(len(arr))])
+    #
+    # only the pointer fields keep the objects alive
+    arr = setup(3, 1300, 1400)
+    assert collected(arr, 1300, 1400) == ([True]*3, [False]*3)
+    #
+    ptr = setup(None, 1500, 1600)
+    assert collected([ptr[0]], 1500, 1600) == ([True], [False])
+    #
+    # structs without pointers are atomic, and realloc() keeps the layout
+    assert gclib._get_layout(ffi, ffi.typeof('Point')) == (True, 0)
+    atomic, layout = gclib._get_layout(ffi, ffi.typeof('Mixed'))
+    assert not atomic and layout > 0
+    arr = setup(2, 1700, 1800)
+    arr = gclib.realloc_array(ffi, 'Mixed', arr, 200)
+    arr = gclib.roots.add(ffi, arr, 'Mixed[]')
+    assert collected(arr[0:2], 1700, 1800) == ([True]*2, [False]*2)
+
+def test_huge_exact_size():
+    MB = 1024*1024
+    p = gclib.lib.GC_malloc(MB + 1)
+    assert gclib.lib.GC_size(p) == MB + 4096
+    # bigger than the old limit of 255MB
+    big = gclib.lib.GC_malloc(300*MB)
+    assert big != ffi.NULL
+    assert gclib.lib.GC_size(big) == 300*MB
+    gclib.lib.GC_free(big)
+    gclib.lib.GC_free(p)
+
+def test_realloc_huge_in_place():
+    MB = 1024*1024
+    p = gclib.lib.GC_realloc(gclib.lib.GC_malloc(2*MB), 3*MB)
+    ffi.cast('long*', p)[0] = 42
+    # after a move, the object is at the end of the huge memory: it can grow
+    # in place
+    for size in [6*MB, 12*MB, 24*MB]:
+        q = gclib.lib.GC_realloc(p, size)
+        assert q == p
+        assert gclib.lib.GC_size(q) == size
+    assert ffi.cast('long*', p)[0] == 42
+    # shrinking is always done in place
+    assert gclib.lib.GC_realloc(p, 2*MB) == p
+    assert gclib.lib.GC_size(p) == 2*MB
+    gclib.lib.GC_free(p)
+
 def test_new_string():
     ptr = gclib.new_string('hello')
     assert ptr[0] == 'h'
@@ -76,35 +171,286 @@ def test_gc_disabled():
     assert b > a
 
 
+def test_parallel_mark():
+    gclib.set_mark_threads(4)
+    try:
+        assert gclib.get_mark_threads() == 4
+        gclib.collect()
+        p1 = gclib.new(ffi, 'Point*')
+        p1.x = 42
+        p2 = gclib.new(ffi, 'Point*', root=False)
+        gclib.collect()
+        p3 = gclib.new(ffi, 'Point*', root=False)
+        # p1 is kept alive by its root, p2 is collected
+        assert p3 == p2
+        assert p3 != p1
+        assert p1.x == 42
+        #
+        a, b = allocate_many()
+        assert b > a
+    finally:
+        gclib.set_mark_threads(1)
+    assert gclib.get_mark_threads() == 1
+
+def test_lazy_sweep():
+    gclib.set_lazy_sweep(True)
+    try:
+        gclib.collect()
+        p1 = gclib.new(ffi, 'Point*', root=False)
+        gclib.collect()
+        # the region is swept on demand, and p1's memory is reused
+        p2 = gclib.new(ffi, 'Point*', root=False)
+        assert p1 == p2
+        #
+        gclib.collect()
+        assert gclib.sweep_pending() > 0
+        assert gclib.sweep_pending() == 0
+        #
+        a, b = allocate_many()
+        assert b > a
+    finally:
+        gclib.set_lazy_sweep(False)
+    assert gclib.sweep_pending() == 0
+
+def test_generational():
+    def addr(p):
+        return int(ffi.cast('long', p))
+    #
+    gclib.set_generational(True)
+    try:
+        gclib.collect()
+        container = gclib.new_array(ffi, 'void*', 1)
+        gclib.collect()
+        # container is old now: its page is write-protected
+        young = gclib.lib.GC_malloc(1000)
+        garbage = gclib.lib.GC_malloc(1000)
+        container[0] = young
+        young = addr(young)
+        garbage = addr(garbage)
+        gclib.collect_minor()
+        # young is reachable only through the (dirty) container
+        with gclib.disabled:
+            addrs = [addr(gclib.lib.GC_malloc(1000)) for i in range(1000)]
+        assert garbage in addrs
+        assert young not in addrs
+        assert addr(container[0]) == young
+        #
+        a, b = allocate_many()
+        assert b > a
+    finally:
+        gclib.set_generational(False)
+
+def test_threads(tmpdir):
+    def child():
+        import threading
+        import cffi
+        from shm import gclib
+        gclib.init('/cffi-shm-testing-threads')
+        gclib.enable_threads()
+        ffi = cffi.FFI()
+        ffi.cdef("""
+            typedef struct Node {
+                long val;
+                struct Node *next;
+            } Node;
+        """)
+        errors = []
+        def build(n):
+            arr = gclib.new_array(ffi, 'Node*', 1)
+            for i in range(n):
+                node = ffi.cast('Node*', gclib.lib.GC_malloc(ffi.sizeof('Node')))
+                node.val = i
+                node.next = arr[0]
+                arr[0] = node
+                gclib.lib.GC_free(gclib.lib.GC_malloc(48))
+            return arr
+        def check(arr, n):
+            node = arr[0]
+            for i in reversed(range(n)):
+                if node.val != i:
+                    errors.append(i)
+                    return
+                node = node.next
+        def worker():
+            arr = build(20000)
+            gclib.collect()
+            check(arr, 20000)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        worker()
+        for t in threads:
+            t.join()
+        assert not errors
+        assert gclib.total_collections() > 0
+    #
+    assert exec_child(tmpdir, child)
+
+def test_stats():
+    s1 = gclib.stats()
+    gclib.collect()
+    s2 = gclib.stats()
+    assert s2['collections'] == s1['collections'] + 1
+    assert s2['last_pause_time'] > 0
+    assert s2['last_pause_time'] >= (s2['last_mark_init_time'] +
+                                     s2['last_mark_time'] +
+                                     s2['last_sweep_time'])
+    assert s2['total_pause_time'] > s1['total_pause_time']
+    assert s2['used_size'] > 0
+    assert s2['trigger_size'] > 0
+    assert s2['pauses'][-1] == s2['last_pause_time']
+    assert len(s2['pauses']) == min(s2['collections'], gclib.lib.GC_STATS_PAUSES)
+    #
+    with gclib.disabled:
+        p = gclib.new_array(ffi, 'Point', 1024, root=False)
+        assert gclib.stats()['alloc_size'] >= s2['alloc_size'] + ffi.sizeof(p)
+
+def fakeptr(i):
+    return gclib.gcffi.cast('void*', 0x1000 + 16*i)
+
+def roots_content(roots):
+    return dict((roots.mem[i], (roots.info[i].count, roots.tags[roots.info[i].tag]))
+                for i in range(roots.gcroots.mem_size)
+                if roots.mem[i] != gclib.gcffi.NULL)
+
 def test_register_roots():
     roots = gclib.GcRootCollection(4)
-    ptr = gclib.gcffi.cast('void*', 0x42)
-    a = roots._add(ptr, 'foo')
-    assert a.i == 0
-    assert roots.mem[0] == ptr
-    assert roots.extrainfo[0] == 'foo'
-    #
-    b = roots._add(ptr, 'bar')
-    assert b.i == 1
-    assert roots.mem[1] == ptr
-    assert roots.extrainfo[1] == 'bar'
-    #
-    a.clear(ptr)
-    assert roots.mem[0] == gclib.gcffi.NULL
-    assert roots.extrainfo[0] == None
-    assert roots.mem[1] == ptr
-    assert roots.extrainfo[1] == 'bar'
-    #
-    c = roots._add(ptr, 'c')
-    d = roots._add(ptr, 'd')
-    e = roots._add(ptr, 'e')
-    assert c.i == 2
-    assert d.i == 3
-    assert e.i == 0
-    d.clear(ptr)
-    f = roots._add(ptr, 'f')
-    assert f.i == 3
-    py.test.raises(ValueError, "roots._add(ptr, 'g')")
+    a = roots.add(gclib.gcffi, fakeptr(1), 'foo')
+    assert a == fakeptr(1)
+    assert roots_content(roots) == {fakeptr(1): (1, 'foo')}
+    #
+    b = roots.add(gclib.gcffi, fakeptr(1), 'bar')
+    assert roots_content(roots) == {fakeptr(1): (2, 'foo')}
+    assert len(roots) == 1
+    #
+    del a
+    assert roots_content(roots) == {fakeptr(1): (1, 'foo')}
+    del b
+    assert roots_content(roots) == {}
+    assert len(roots) == 0
+    assert roots.tags == ['<unknown>', 'foo', 'bar']
+    #
+    # the table is half full: it grows
+    ptrs = [roots.add(gclib.gcffi, fakeptr(i)) for i in range(3)]
+    assert roots.gcroots.mem_size == 8
+    assert len(roots) == 3
+    assert roots_content(roots) == dict((fakeptr(i), (1, '<unknown>'))
+                                        for i in range(3))
+
+def test_register_roots_release():
+    # releasing a root moves back the other ones of the same probe sequence
+    roots = gclib.GcRootCollection(256)
+    ptrs = [roots.add(gclib.gcffi, fakeptr(i)) for i in range(128)]
+    for i in range(0, 128, 3):
+        ptrs[i] = None
+    expected = dict((fakeptr(i), (1, '<unknown>'))
+                    for i in range(128) if i % 3)
+    assert roots_content(roots) == expected
+    for i in range(128):
+        if i % 3:
+            roots.release(fakeptr(i))
+            del expected[fakeptr(i)]
+            assert roots_content(roots) == expected
+    assert len(roots) == 0
+
+def test_register_roots_shrink():
+    roots = gclib.GcRootCollection(4)
+    ptrs = [roots.add(gclib.gcffi, fakeptr(i)) for i in range(16)]
+    assert roots.gcroots.mem_size == 32
+    del ptrs[3:]
+    # the table shrinks on the next add
+    assert roots.gcroots.mem_size == 32
+    ptrs.append(roots.add(gclib.gcffi, fakeptr(100)))
+    assert roots.gcroots.mem_size == 16
+    assert len(roots) == 4
+    del ptrs[:]
+    ptrs.append(roots.add(gclib.gcffi, fakeptr(100)))
+    # never smaller than the initial size
+    assert roots.gcroots.mem_size == 4
+    assert roots_content(roots) == {fakeptr(100): (1, '<unknown>')}
+
+def test_register_roots_null():
+    roots = gclib.GcRootCollection(4)
+    assert roots.add(gclib.gcffi, gclib.gcffi.NULL) == gclib.gcffi.NULL
+    assert len(roots) == 0
+
+def test_print_extrainfo(capsys):
+    roots = gclib.GcRootCollection(4)
+    ptrs = [roots.add(gclib.gcffi, fakeptr(i), 'foo') for i in range(3)]
+    ptrs += [roots.add(gclib.gcffi, fakeptr(0), 'bar')]
+    ptrs += [roots.add(gclib.gcffi, fakeptr(i), 'bar') for i in range(3, 5)]
+    roots.print_extrainfo()
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['Total number of roots: 6',
+                                '%40s: %d' % ('foo', 4),
+                                '%40s: %d' % ('bar', 2)]
+
+def test_root_grow_collect(monkeypatch):
+    gclib.collect()
+    myroots = gclib.GcRootCollection(4)
+    monkeypatch.setattr(gclib.default_heap, 'roots', myroots)
+    arrays = [gclib.new_array(ffi, 'long', 5) for i in range(100)]
+    for i, arr in enumerate(arrays):
+        arr[0] = i
+    gclib.collect()
+    with gclib.disabled:
+        others = [gclib.new_array(ffi, 'long', 5, root=False)
+                  for i in range(100)]
+    addrs = set(int(ffi.cast('long', arr)) for arr in arrays)
+    assert not addrs & set(int(ffi.cast('long', arr)) for arr in others)
+    assert [arr[0] for arr in arrays] == range(100)
+
+def test_root_scope(monkeypatch):
+    def addr(ptr):
+        return int(ffi.cast('long', ptr))
+    gclib.collect()
+    myroots = gclib.GcRootCollection(4)
+    monkeypatch.setattr(gclib.default_heap, 'roots', myroots)
+    with gclib.root_scope() as scope:
+        arrays = [gclib.new_array(ffi, 'long', 7) for i in range(5000)]
+        for i, arr in enumerate(arrays):
+            arr[0] = i
+        with gclib.root_scope() as inner:
+            s = gclib.new_string('hello')
+            assert len(inner) == 1
+        assert len(scope) == 5000
+        assert len(myroots) == 0
+        gclib.collect()
+        assert [arr[0] for arr in arrays] == range(5000)
+        kept = scope.promote(arrays[42], 'kept')
+    assert len(myroots) == 1
+    gclib.collect()
+    assert kept[0] == 42
+    with gclib.disabled:
+        others = [gclib.new_array(ffi, 'long', 7, root=False)
+                  for i in range(5000)]
+    addrs = set(addr(arr) for arr in others)
+    assert addr(kept) not in addrs
+    assert addrs & set(addr(arr) for arr in arrays)
+
+def test_root_scope_thread_exit(monkeypatch):
+    import threading
+    # the thread-locals are destroyed after join() returns
+    destroyed = threading.Event()
+    orig_del = gclib.ScopeBlock.__del__
+    def __del__(self):
+        orig_del(self)
+        destroyed.set()
+    monkeypatch.setattr(gclib.ScopeBlock, '__del__', __del__)
+    ptrptrs = []
+    def run():
+        with gclib.root_scope() as scope:
+            gclib.new_array(ffi, 'long', 7)
+            ptrptrs.append(int(gclib.gcffi.cast('long', scope.block._ptrptr)))
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+    destroyed.wait(10)
+    assert destroyed.is_set()
+    # the root has already been removed
+    ptrptr = gclib.gcffi.cast('void**', ptrptrs[0])
+    assert not gclib.lib.GC_remove_dynamic_root(ptrptr)
+    gclib.collect()
 
 def test_GcRootCollection_from_pointer():
 	roots = gclib.GcRootCollection(4)
@@ -112,7 +458,9 @@ def test_GcRootCollection_from_pointer():
 	roots2 = gclib.GcRootCollection.from_pointer(ptr)
 	assert roots2.gcroots == ptr
 	assert roots2.mem == roots.mem
-	assert len(roots.extrainfo) == 4
+	assert roots2.info == roots.info
+	p = roots2.add(gclib.gcffi, fakeptr(1))
+	assert len(roots) == 1
 	
 
 def test_root_keepalive():
@@ -140,7 +488,7 @@ def test_root_keepalive():
 def test_root_size(monkeypatch):
     gclib.collect()
     myroots = gclib.GcRootCollection(16)
-    monkeypatch.setattr(gclib, 'roots', myroots)
+    monkeypatch.setattr(gclib.default_heap, 'roots', myroots)
     p1 = gclib.new(ffi, 'Point*')
     p2 = gclib.new(ffi, 'Point*')
     p3 = gclib.new(ffi, 'Point*')
@@ -148,13 +496,123 @@ def test_root_size(monkeypatch):
     p4 = gclib.new(ffi, 'Point*')
     assert p4 not in (p1, p2, p3)
 
-def test_DummyAllocator():
-    mem = ffi.cast('void*', 1000)
-    alloc = gclib.DummyAllocator()
-    alloc.init(mem, 100)
-    assert alloc.malloc(10) == ffi.cast('void*', 1000)
-    assert alloc.malloc(20) == ffi.cast('void*', 1010)
-    assert alloc.malloc(80) == ffi.NULL
-    assert alloc.malloc(70) == ffi.cast('void*', 1030)
-    assert alloc.malloc(1) == ffi.NULL
+def test_RWAllocator():
+    size = gclib.RW_MEM_SIZE
+    mem = gclib.new_array(ffi, 'char', size)
+    start = ffi.cast('char*', mem)
+    alloc = gclib.RWAllocator()
+    alloc.init(mem, size)
+    a = alloc.malloc(10)
+    b = alloc.malloc(20)
+    assert a == start + 16 # after the chunk header
+    assert b == start + 32
+    ffi.cast('long*', a)[0] = 42
+    alloc.free(a)
+    assert ffi.cast('long*', a)[0] == 0
+    py.test.raises(ValueError, "alloc.free(a)")
+    assert alloc.malloc(16) == a
+    assert alloc.malloc(16) == start + 64
+    assert alloc.stats() == dict(chunks=1, total_size=size, used_size=64,
+                                 free_size=0, allocations=3)
+    alloc.free(b)
+    assert alloc.stats()['free_size'] == 32
+    #
+    # big blocks get their own chunk
+    big = alloc.malloc(size // 2)
+    assert big != ffi.NULL
+    assert alloc.first_chunk.next == ffi.cast('char*', big) - 16
+    assert alloc.stats()['chunks'] == 2
+    #
+    # when the chunk is full, we allocate a new one
+    blocks = [alloc.malloc(size // 8) for i in range(8)]
+    assert alloc.stats()['chunks'] == 3
+    assert ffi.cast('char*', blocks[-1]) - 16 == alloc.last_chunk
+    gclib.collect()
+    info = gclib.gcffi.new('gclib_info_t*')
+    info.rwmem = mem
+    chunks = gclib._rw_chunks(info)
+    assert [s for p, s in chunks] == [size, size // 2 + 16, size]
+
+
+def test_heaps():
+    def addr(ptr):
+        return int(ffi.cast('long', ptr))
+    py.test.raises(ValueError, "gclib.get_heap(gclib.MAX_HEAPS)")
+    assert gclib.get_heap(0) is gclib.default_heap
+    heap = gclib.get_heap(1)
+    assert gclib.get_heap(1) is heap
+    heap.init('/cffi-shm-testing-heap1')
+    start = 0x1000000000 + gclib.HEAP_STRIDE
+    assert heap.lib.GC_get_memory() == ffi.cast('void*', start)
+    info = heap.get_gc_info()
+    assert info.magic == gclib.GC_INFO_MAGIC
+    assert heap.ffi.string(info.path) == '/cffi-shm-testing-heap1'
+    #
+    # each heap has its own memory, roots and collections
+    nroots = len(gclib.roots)
+    p1 = heap.new(ffi, 'Point*')
+    p1.x = 42
+    assert heap.isptr(p1)
+    assert not gclib.isptr(p1)
+    assert len(heap.roots) == 2 # p1 and the gc_info
+    assert len(gclib.roots) == nroots
+    n = gclib.total_collections()
+    heap.collect()
+    assert gclib.total_collections() == n
+    p2 = heap.new(ffi, 'Point*', root=False)
+    assert addr(p2) != addr(p1)
+    assert p1.x == 42
+    #
+    # and its own RW area
+    mutex = heap.new(ffi, 'long*', rw=True)
+    assert addr(mutex) >= addr(heap.get_gc_info().rwmem)
+    heap.free_rw(mutex)
+    assert heap.rw_stats()['allocations'] == 0
+
+def test_publish_extents():
+    def addr(ptr):
+        return int(ffi.cast('long', ptr))
+    big = gclib.new_array(ffi, 'char', 10*1024*1024)
+    n = gclib.publish_extents()
+    items, count = gclib.default_heap._published_extents()
+    assert count == n
+    extents = [(addr(items[i].start), items[i].size) for i in range(n)]
+    assert extents == sorted(extents)
+    assert (addr(big), 10*1024*1024) in extents
+    info = addr(gclib.get_gc_info())
+    assert [start for start, size in extents
+            if start <= info < start+size] == [info]
+    #
+    # the objects reachable from a root are read once, even with cycles
+    arr = gclib.new_array(ffi, 'void*', 2)
+    arr[0] = arr
+    arr[1] = big
+    gclib.publish_extents()
+    assert gclib.prefetch(arr) == 16 + 10*1024*1024
 
+def test_hugepages(tmpdir):
+    assert gclib.get_hugepages() is None
+    assert gclib.stats()['hugepages'] is None
+    # too late: the memory is already mapped
+    set_hugepages = gclib.default_heap._set_hugepages
+    set_hugepages('/cffi-shm-testing', None)
+    py.test.raises(OSError, set_hugepages, '/cffi-shm-testing', 'thp')
+    py.test.raises(ValueError, set_hugepages, '/cffi-shm-testing', 'huge')
+    #
+    def child():
+        import cffi
+        from shm import gclib
+        gclib.init('/cffi-shm-testing-hugepages', hugepages='thp')
+        # None if THP are disabled for shared memory
+        assert gclib.get_hugepages() in ('thp', None)
+        ffi = cffi.FFI()
+        arrays = [gclib.new_array(ffi, 'long', 1000) for i in range(1000)]
+        for i, arr in enumerate(arrays):
+            arr[999] = i
+        gclib.collect()
+        assert [arr[999] for arr in arrays] == range(1000)
+        big = gclib.new_array(ffi, 'char', 5*1024*1024)
+        del big
+        gclib.collect()
+    #
+    assert exec_child(tmpdir, child)
@@ -27,6 +27,17 @@ def test_popleft(pyffi):
     py.test.raises(IndexError, "d[3]")
     py.test.raises(IndexError, "d[-4]")
 
+def test_version(pyffi):
+    DT = pyffi.deque('long')
+    d = DT([1, 2])
+    v = d.version
+    d.append(3)
+    assert d.version == v+1
+    d.popleft()
+    assert d.version == v+2
+    py.test.raises(IndexError, "d[5]")
+    assert d.version == v+2
+
 def test_popleft_empty(pyffi):
     DT = pyffi.deque('long')
     d = DT()
@@ -78,12 +89,45 @@ def test_growing(pyffi):
     d.append(4)
     assert list(d.typeditems[0:4]) == [4, 1, 2, 3]
     #
-    # now grow, and reshuffle the buffer
+    # now grow: only the item which wrapped around is moved
     d.append(5)
-    assert list(d.typeditems[0:5]) == [1, 2, 3, 4, 5]
-    assert d.lst.offset == 0
+    assert list(d.typeditems[0:6]) == [0, 1, 2, 3, 4, 5]
+    assert d.lst.offset == 1
     assert len(d) == 5
+    assert list(d) == [1, 2, 3, 4, 5]
+
+def test_growing_move_tail(pyffi):
+    DT = pyffi.deque('long')
+    #
+    # start with a buffer of 4 items and offset==3
+    d = DT([100, 101, 102])
+    d._grow(4)
+    assert [d.popleft(), d.popleft(), d.popleft()] == [100, 101, 102]
+    for i in range(1, 5):
+        d.append(i)
+    assert list(d.typeditems[0:4]) == [2, 3, 4, 1]
+    #
+    # the part before the wrap point is shorter: it is moved to the end
+    d.append(5)
+    assert d.lst.size == 8
+    assert d.lst.offset == 7
+    assert list(d.typeditems[0:4]) == [2, 3, 4, 5]
+    assert d.typeditems[7] == 1
+    assert list(d) == [1, 2, 3, 4, 5]
     
+def test_grow_does_not_free(pyffi):
+    # lock-free readers may still be reading the old array: it is left to
+    # the GC
+    DT = pyffi.deque('const char*')
+    d = DT(['hello', 'world'])
+    assert d.popleft() == 'hello'
+    d.append('!')
+    old = pyffi.ffi.cast('char**', d.lst.items)
+    d.append('?')
+    assert d.lst.size == 4
+    assert [pyffi.ffi.string(p) for p in old[0:2]] == ['!', 'world']
+    assert list(d) == ['world', '!', '?']
+
 def test___iter__(pyffi):
     DT = pyffi.deque('long')
     #
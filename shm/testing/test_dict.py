@@ -60,6 +60,30 @@ def test___delitem__(pyffi):
     assert 'hello' not in d
     py.test.raises(KeyError, "del d['foo']")
 
+def test_version(pyffi):
+    DT = DictType(pyffi, 'const char*', 'long')
+    d = DT()
+    assert d.version == 0
+    d['hello'] = 1
+    d['world'] = 2
+    assert d.version == 2
+    d['hello'] = 3
+    assert d.version == 3
+    d['hello']
+    'foo' in d
+    assert d.version == 3
+    del d['hello']
+    assert d.version == 4
+    py.test.raises(KeyError, "del d['foo']")
+    assert d.version == 4
+    #
+    ST = pyffi.set('long')
+    s = ST([1, 2])
+    v = s.version
+    s.discard(1)
+    s.discard(1)
+    assert s.version == v+1
+
 def test_keys_values_items(pyffi):
     DT = DictType(pyffi, 'const char*', 'long')
     d = DT()
@@ -84,6 +108,59 @@ def test___iter__(pyffi):
     d['baz'] = 3
     assert sorted(list(d)) == ['bar', 'baz', 'foo']
 
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_iter_chunks(pyffi, engine):
+    DT = DictType(pyffi, 'long', 'const char*', engine=engine)
+    d = DT()
+    for i in range(1000):
+        d[i] = str(i)
+    d.ITER_CHUNK = 7
+    it = d.iteritems()
+    assert iter(it) is it
+    assert sorted(it) == [(i, str(i)) for i in range(1000)]
+    assert sorted(d.iterkeys()) == range(1000)
+    assert sorted(d.itervalues()) == sorted(map(str, range(1000)))
+    assert sorted(DT()) == []
+    #
+    it = iter(d)
+    next(it)
+    d[1000] = 'x'
+    py.test.raises(RuntimeError, list, it)
+    it = d.itervalues()
+    next(it)
+    del d[1000]
+    py.test.raises(RuntimeError, list, it)
+    # the lists are built in one go
+    assert len(d.items()) == 1000
+    #
+    # as in Python, the values can be changed during the iteration
+    for key in d:
+        d[key] = d[key] + '!'
+    for key, value in d.iteritems():
+        d[key] = value.upper()
+    assert sorted(d.items()) == [(i, str(i) + '!') for i in range(1000)]
+    d.ITER_CHUNK = 256
+    for key in d:
+        d[key] = str(key)
+    assert sorted(d.items()) == [(i, str(i)) for i in range(1000)]
+
+@py.test.mark.parametrize('keytype, valuetype', [('short', 'unsigned int'),
+                                                 ('unsigned long', 'double'),
+                                                 ('double', 'signed char')])
+def test_iter_primitive(pyffi, keytype, valuetype):
+    DT = DictType(pyffi, keytype, valuetype)
+    d = DT()
+    items = [(-3, 250), (7, 0), (2**15-1, 1)]
+    if keytype == 'unsigned long':
+        items[0] = (2**64-1, 0.5)
+    elif keytype == 'double':
+        items = [(-1.5, -128), (2.25, 127), (0.0, 0)]
+    elif valuetype == 'unsigned int':
+        items[1] = (7, 2**32-1)
+    d.update(items)
+    assert sorted(d.items()) == sorted(items)
+    assert sorted(d.itervalues()) == sorted(v for k, v in items)
+
 def test_update(pyffi):
     DT = DictType(pyffi, 'const char*', 'long')
     d = DT()
@@ -228,6 +305,50 @@ def test_keys_list_of_strings(pyffi):
     assert d[b] == 42
     assert c not in d
 
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_compiled_hash(pyffi, engine):
+    ffi = pyffi.ffi
+    ffi.cdef("""
+        typedef struct {
+            long x;
+            const char* name;
+        } Item;
+    """)
+    Item = pyffi.struct('Item', compiled_hash=True)
+    assert Item.__fieldspec__.type_id != 0
+    LT = pyffi.list('Item*', immutable=True, compiled_hash=True, cname='ILT')
+    for keytype, make in [('Item*', lambda i: Item(i, str(i % 7))),
+                          ('ILT*', lambda i: LT([Item(i, 'a'), Item(1, 'b')]))]:
+        DT = DictType(pyffi, keytype, 'long', engine=engine)
+        d = DT()
+        for i in range(100):
+            d[make(i)] = i
+        assert len(d) == 100
+        for i in range(100):
+            assert d[make(i)] == i
+        assert make(100) not in d
+        del d[make(5)]
+        assert make(5) not in d
+    #
+    py.test.raises(TypeError, pyffi.struct, 'Item', immutable=False,
+                   compiled_hash=True)
+    py.test.raises(TypeError, pyffi.list, 'long', compiled_hash=True)
+
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_delete_does_not_free(pyffi, engine):
+    # lock-free readers may still be using the removed keys: they are left
+    # to the GC, since freeing them would overwrite their first word
+    from shm.libcfu import cfuffi
+    DT = DictType(pyffi, 'const char*', 'long', engine=engine)
+    with sharedmem.gc_disabled:
+        d = DT()
+        d['hello world'] = 1
+        keys = cfuffi.new('void*[1]')
+        cursor = cfuffi.new('size_t[2]')
+        assert DT.htlib.next_entries(d.ht, cursor, keys, cfuffi.NULL, 1) == 1
+        del d['hello world']
+        assert cfuffi.string(cfuffi.cast('char*', keys[0])) == 'hello world'
+
 def test_defaultdict(pyffi):
     DT = pyffi.defaultdict('const char*', 'long', lambda: 42)
     d = DT()
@@ -258,3 +379,296 @@ def test_defaultdict_pop(pyffi):
     assert d['hello'] == 42
     d.pop('hello') == 42
     py.test.raises(KeyError, "d.pop('hello')")
+
+def test_root_scope(pyffi):
+    import gc
+    from shm import gclib
+    DT = DictType(pyffi, 'const char*', 'long')
+    # release the roots of the garbage of the previous tests, which might
+    # otherwise be released in the middle of the test
+    gc.collect()
+    nroots = len(sharedmem.roots)
+    with sharedmem.root_scope() as scope:
+        d = DT()
+        for i in range(100):
+            d['key%d' % i] = i
+        assert len(sharedmem.roots) == nroots
+        scope.promote(d)
+    assert len(sharedmem.roots) == nroots + 1
+    gclib.collect()
+    assert sorted(d.values()) == range(100)
+    del d
+    assert len(sharedmem.roots) == nroots
+
+def test_root_scope_fieldspec(pyffi):
+    # the fieldspec of the key type is allocated when the first dict is
+    # created, and it must outlive the scope
+    import gc
+    from shm import gclib
+    from shm.libcfu import cfuffi
+    ffi = pyffi.ffi
+    ffi.cdef("""
+        typedef struct {
+            long x;
+            const char* name;
+        } Key;
+    """)
+    Key = pyffi.struct('Key')
+    DT = DictType(pyffi, 'Key*', 'long')
+    with sharedmem.root_scope():
+        d = DT()
+        d[Key(1, 'one')] = 1
+    del d
+    gc.collect()
+    gclib.collect()
+    with sharedmem.gc_disabled:
+        garbage = [sharedmem.new_string('x' * 20, root=False)
+                   for i in range(1000)]
+    spec = Key.__fieldspec__.ptr
+    assert cfuffi.string(spec[0].name) == 'Key.x'
+    assert cfuffi.string(spec[1].name) == 'Key.name'
+    d = DT()
+    for i in range(100):
+        d[Key(i, str(i))] = i + 1
+    gclib.collect()
+    assert [d[Key(i, str(i))] for i in range(100)] == range(1, 101)
+
+def test_other_heap():
+    from shm.sharedmem import get_sharedmem
+    from shm import gclib
+    shm1 = get_sharedmem(1)
+    assert get_sharedmem(1) is shm1
+    assert get_sharedmem(0) is sharedmem
+    shm1.init('/cffi-shm-testing-heap1')
+    pyffi = PyFFI(cffi.FFI(), shm1)
+    DT = DictType(pyffi, 'const char*', 'const char*')
+    d = DT()
+    d['hello'] = 'world'
+    heap = shm1.gclib
+    assert heap.isptr(d.as_cdata())
+    assert not gclib.isptr(d.as_cdata())
+    heap.collect()
+    assert d['hello'] == 'world'
+
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_get_many(pyffi, engine):
+    from array import array
+    DT = pyffi.dict('long', 'long', engine=engine)
+    d = DT()
+    d.put_many((i, i*2) for i in range(100))
+    assert len(d) == 100
+    assert d[42] == 84
+    res = d.get_many([3, 99, 0])
+    assert isinstance(res, array)
+    assert res.typecode == 'l'
+    assert list(res) == [6, 198, 0]
+    py.test.raises(KeyError, d.get_many, [3, 100])
+    assert list(d.get_many([3, 100, -1], default=-1)) == [6, -1, -1]
+    assert d.contains_many([1, 1000, 2]) == [True, False, True]
+    assert list(d.get_many([])) == []
+    #
+    DT = pyffi.dict('const char*', 'const char*', engine=engine)
+    d = DT()
+    d.put_many({'a': 'A', 'b': 'B'})
+    d.put_many([('c', 'C'), ('a', 'AA')])
+    assert sorted(d.items()) == [('a', 'AA'), ('b', 'B'), ('c', 'C')]
+    assert d.get_many(['c', 'x', 'a']) == ['C', None, 'AA']
+    assert d.get_many(['x'], default='y') == ['y']
+    assert d.contains_many(['x', 'b']) == [False, True]
+
+def test_get_many_primitive_values(pyffi):
+    DT = pyffi.dict('long', 'double')
+    d = DT()
+    d.put_many([(1, 1.5), (-2, -2.5)])
+    res = d.get_many([-2, 1, 3], default=0.0)
+    assert res.typecode == 'd'
+    assert list(res) == [-2.5, 1.5, 0.0]
+    #
+    DT = pyffi.dict('double', 'int')
+    d = DT()
+    d.put_many([(1.5, -1), (2.5, 2**31-1)])
+    res = d.get_many([1.5, 2.5])
+    assert res.typecode == 'i'
+    assert list(res) == [-1, 2**31-1]
+    #
+    DT = pyffi.dict('long', 'unsigned char')
+    d = DT({1: 255})
+    assert list(d.get_many([1])) == [255]
+
+def test_get_many_struct_keys(pyffi):
+    ffi = pyffi.ffi
+    ffi.cdef("""
+        typedef struct {
+            long x;
+            long y;
+        } Pair;
+    """)
+    Pair = pyffi.struct('Pair', immutable=True)
+    DT = pyffi.dict('Pair*', 'Pair*')
+    d = DT()
+    p1, p2 = Pair(1, 2), Pair(3, 4)
+    d.put_many([(p1, p2), (p2, p1)])
+    res = d.get_many([Pair(3, 4), Pair(5, 6)])
+    assert res[0].x == 1
+    assert res[1] is None
+    assert d.contains_many([Pair(1, 2), Pair(2, 1)]) == [True, False]
+
+def test_incremental_rehash(pyffi):
+    from shm.libcfu import cfuhash
+    DT = DictType(pyffi, 'long', 'long')
+    d = DT()
+    i = 0
+    while not cfuhash.is_rehashing(d.ht):
+        d[i] = i
+        i += 1
+    # the entries are split between the old and the new buckets
+    n = i
+    buckets = cfuhash.num_buckets(d.ht)
+    assert len(d) == n
+    assert sorted(d.keys()) == range(n)
+    d.ITER_CHUNK = 3
+    assert sorted(d.iteritems()) == zip(range(n), range(n))
+    for i in range(n):
+        assert d[i] == i
+    # changing the values does not move the entries
+    for key, value in d.iteritems():
+        d[key] = value + 1
+    assert cfuhash.is_rehashing(d.ht)
+    assert sorted(d.iteritems()) == zip(range(n), range(1, n + 1))
+    for key in d:
+        d[key] -= 1
+    #
+    # every write moves some buckets: the rehash finishes long before the
+    # next one is needed
+    while cfuhash.is_rehashing(d.ht):
+        d[i] = i
+        i += 1
+    assert cfuhash.num_buckets(d.ht) == buckets
+    assert i < n * 1.5
+    for j in range(i):
+        assert d[j] == j
+    #
+    # same when shrinking
+    for j in range(i-1, 0, -1):
+        del d[j]
+        assert d[0] == 0
+        assert j-1 not in d or d[j-1] == j-1
+    assert sorted(d.keys()) == [0]
+    assert cfuhash.num_buckets(d.ht) < buckets
+
+def test_engine(pyffi):
+    py.test.raises(ValueError, DictType, pyffi, 'long', 'long', engine='foo')
+    DT = pyffi.dict('long', 'long', engine='open')
+    assert DT.engine == 'open'
+    d = DT({1: 2})
+    assert repr(d).startswith('<shm dict [long: long] at 0x')
+    d2 = DT.from_pointer(pyffi.ffi.cast('void*', d.as_cdata()))
+    assert d2[1] == 2
+    ST = pyffi.set('long', engine='open')
+    s = ST([1, 2, 3])
+    assert 2 in s
+    assert sorted(s) == [1, 2, 3]
+
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_expected_size(pyffi, engine):
+    DT = pyffi.dict('long', 'long', engine=engine)
+    htlib = DT.htlib
+    d = DT()
+    for i in range(1000):
+        d[i] = i
+    assert htlib.num_rehashes(d.ht) > 5
+    #
+    d = DT(expected_size=1000)
+    assert htlib.num_rehashes(d.ht) == 1
+    for i in range(1000):
+        d[i] = i
+    assert htlib.num_rehashes(d.ht) == 1
+    #
+    # presized by default from init
+    d = DT(dict.fromkeys(range(1000), 42))
+    assert htlib.num_rehashes(d.ht) == 1
+    assert len(d) == 1000
+    #
+    # reserve() never shrinks
+    d.reserve(10)
+    d.reserve(1000)
+    assert htlib.num_rehashes(d.ht) == 1
+    d.reserve(100000)
+    assert htlib.num_rehashes(d.ht) == 2
+    assert sorted(d.keys()) == range(1000)
+    for i in range(1000, 100000):
+        d[i] = i
+    assert htlib.num_rehashes(d.ht) == 2
+    #
+    DT2 = pyffi.dict('long', 'long', engine=engine, expected_size=1000)
+    d = DT2()
+    assert htlib.num_rehashes(d.ht) == 1
+
+def test_load_factor(pyffi):
+    from shm.libcfu import cfuhash, openhash
+    DT = pyffi.dict('long', 'long')
+    d = DT(load_factor=4)
+    for i in range(1000):
+        d[i] = i
+    assert 1000.0 / cfuhash.num_buckets(d.ht) > 1
+    d2 = DT(load_factor=0.1)
+    d2.update(d)
+    assert 1000.0 / cfuhash.num_buckets(d2.ht) < 0.1
+    py.test.raises(ValueError, DT, load_factor=0)
+    #
+    DT = pyffi.dict('long', 'long', engine='open', load_factor=0.25)
+    d = DT()
+    for i in range(1000):
+        d[i] = i
+    assert 1000.0 / openhash.capacity(d.ht) <= 0.25
+    py.test.raises(ValueError, DT, load_factor=1)
+    py.test.raises(ValueError, pyffi.dict, 'long', 'long', engine='open',
+                   load_factor=1.5)
+
+@py.test.mark.parametrize('keytype', ['const char*', 'long'])
+def test_engine_open_random(pyffi, keytype):
+    import random
+    from shm.libcfu import openhash
+    random.seed(42)
+    if keytype == 'long':
+        mkkey = lambda i: i * 4096
+    else:
+        mkkey = lambda i: 'key%d' % i
+    DT = DictType(pyffi, keytype, 'long', engine='open')
+    d = DT()
+    expected = {}
+    for i in range(5000):
+        key = mkkey(random.randrange(1500))
+        if random.random() < 0.4:
+            assert d.pop(key, None) == expected.pop(key, None)
+        else:
+            d[key] = i + 1
+            expected[key] = i + 1
+        assert len(d) == len(expected)
+    assert sorted(d.items()) == sorted(expected.items())
+    for i in range(1500):
+        assert (mkkey(i) in d) == (mkkey(i) in expected)
+    #
+    capacity = openhash.capacity(d.ht)
+    assert len(d) <= capacity * 0.8
+    for key in d.keys():
+        del d[key]
+    assert len(d) == 0
+    assert openhash.capacity(d.ht) < capacity
+
+def test_engine_open_struct_keys(pyffi):
+    ffi = pyffi.ffi
+    ffi.cdef("""
+        typedef struct {
+            const char* first_name;
+            const char* last_name;
+        } FullName;
+    """)
+    FullName = pyffi.struct('FullName', immutable=True)
+    DT = DictType(pyffi, 'FullName*', 'long', engine='open')
+    d = DT()
+    d[FullName('Antonio', 'Cuni')] = 1
+    d[FullName('Antonio', 'Foobar')] = 2
+    assert d[FullName('Antonio', 'Cuni')] == 1
+    assert d[FullName('Antonio', 'Foobar')] == 2
+    assert FullName('Antonio', 'Baz') not in d
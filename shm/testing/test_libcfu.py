@@ -250,3 +250,111 @@ def test_libcfu_generic_cmp_array(ffi):
     pl2.n = 2
     assert generic_cmp(pointlist_spec, pl1, pl2) != 0
 
+
+def test_hash_seed(ffi):
+    for key in ["", "a", "hello", "hello world, this is longer than a word"]:
+        h = cfuhash.hash(key, len(key), 0)
+        assert h == cfuhash.hash(key, len(key), 0)
+        assert h != cfuhash.hash(key, len(key), 42)
+    # keys which differ only by the trailing zeros are different
+    assert cfuhash.hash("a\0", 2, 0) != cfuhash.hash("a", 1, 0)
+    #
+    # all the bits of the pointers matter, including the lowest ones
+    hashes = set(cfuhash.hash_pointer(ffi.cast('void*', i*16), 0) & 1023
+                 for i in range(1024))
+    assert len(hashes) > 512
+
+def test_compile(ffi):
+    ffi.cdef("""
+        typedef struct {
+            long x;
+            char tag;
+            const char* name;
+        } Point;
+        typedef struct {
+            long n;
+            Point* points;
+            Point* origin;
+        } PointList;
+    """)
+    point_spec = FieldSpec(ffi, 'Point')
+    point_spec.add('x', cfuhash.primitive, ffi.sizeof('long'))
+    point_spec.add('tag', cfuhash.primitive, ffi.sizeof('char'))
+    point_spec.add('name', cfuhash.string, 0)
+    pointlist_spec = FieldSpec(ffi, 'PointList')
+    pointlist_spec.add('n', cfuhash.primitive, ffi.sizeof('long'))
+    pointlist_spec.add('points', cfuhash.array, size = ffi.sizeof('Point'),
+                       fieldspec = point_spec, length_offset = 0)
+    pointlist_spec.add('origin', cfuhash.pointer, size = 0,
+                       fieldspec = point_spec, length = 1)
+    type_id = pointlist_spec.compile()
+    assert type_id != 0
+    assert pointlist_spec.compile() == type_id
+    klib = pointlist_spec._keyfuncs_lib
+    ptrspec = pointlist_spec.getptr()
+    #
+    names = [ffi.new('char[]', s) for s in ('a', 'hello world!')]
+    def make(n, name, origin):
+        pl = ffi.new('PointList*')
+        pl.n = n
+        pl.points = points = ffi.new('Point[]', 3)
+        for i in range(3):
+            points[i] = (i, 'x', names[name])
+        pl.origin = origin
+        return pl, points
+    origin = ffi.new('Point*', (42, 'o', ffi.NULL))
+    keys = [make(3, 0, origin), make(3, 0, origin), make(2, 0, origin),
+            make(3, 1, origin), make(3, 0, ffi.NULL)]
+    keys = [pl for pl, points in keys] + [ffi.NULL]
+    # the compiled functions give the same results as the generic ones
+    for a in keys:
+        for seed in (0, 1, 12345):
+            assert (klib.key_hash_ptr(a, seed) ==
+                    cfuhash.generic_hash_seeded(ptrspec, a, seed))
+        for b in keys:
+            generic = cfuhash.generic_cmp(ptrspec, a, b)
+            assert (klib.key_cmp_ptr(a, b) == 0) == (generic == 0)
+    assert klib.key_cmp_ptr(keys[0], keys[1]) == 0
+
+def test_openhash_out_of_memory(ffi):
+    from shm.libcfu import openhash
+    buffers = []
+    fail = [False]
+    @cfuffi.callback('void*(size_t)')
+    def malloc_fn(size):
+        if fail[0]:
+            return cfuffi.NULL
+        buf = cfuffi.new('char[]', size)
+        buffers.append(buf)
+        return buf
+    @cfuffi.callback('void(void*)')
+    def free_fn(ptr):
+        pass
+    keysize = cfuffi.cast('size_t', -1)
+    ht = openhash.new_with_malloc_fn(malloc_fn, free_fn)
+    i = 0
+    while openhash.capacity(ht) == 8:
+        assert openhash.put_data(ht, 'key%d' % i, keysize, cfuffi.NULL, 0,
+                                 cfuffi.NULL) == 1
+        i += 1
+    # neither the keys nor a bigger array can be allocated
+    fail[0] = True
+    assert openhash.put_data(ht, 'other', keysize, cfuffi.NULL, 0,
+                             cfuffi.NULL) == -1
+    assert openhash.num_entries(ht) == i
+    # replacing a value does not allocate
+    assert openhash.put_data(ht, 'key0', keysize, cfuffi.NULL, 0,
+                             cfuffi.NULL) == 0
+    #
+    # with NOCOPY_KEYS, the table fills up to the last free slot, but not
+    # further
+    openhash.set_flag(ht, openhash.NOCOPY_KEYS)
+    capacity = openhash.capacity(ht)
+    keys = [cfuffi.new('char[]', 'nocopy%d' % j) for j in range(capacity)]
+    results = [openhash.put_data(ht, key, keysize, cfuffi.NULL, 0, cfuffi.NULL)
+               for key in keys]
+    assert results.count(1) == capacity - 1 - i
+    assert results[-1] == -1
+    assert openhash.num_entries(ht) == capacity - 1
+    for j in range(i):
+        assert openhash.exists_data(ht, 'key%d' % j, keysize)
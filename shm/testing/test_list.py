@@ -79,6 +79,36 @@ def test_setitem(pyffi):
     assert l[0] == 42
     assert l[-1] == 43
 
+def test_version(pyffi):
+    LT = ListType(pyffi, 'long', ResizableList)
+    l = LT(range(5))
+    assert l.version == 0
+    l[0] = 42
+    assert l.version == 1
+    l.append(43)
+    assert l.version == 2
+    l[0]
+    len(l)
+    assert l.version == 2
+    assert l.seqlock.sequence == 4
+
+def test_optimistic_read(pyffi):
+    LT = ListType(pyffi, 'long', ResizableList)
+    l = LT(range(5))
+    assert l.optimistic_read(l.__getitem__, 3) == 3
+    assert l.optimistic_read(list, l) == range(5)
+    py.test.raises(IndexError, l.optimistic_read, l.__getitem__, 5)
+
+def test_grow_does_not_free(pyffi):
+    # lock-free readers may still be reading the old array: it is left to
+    # the GC
+    LT = ListType(pyffi, 'const char*', ResizableList)
+    l = LT(['hello', 'world'])
+    old = pyffi.ffi.cast('char**', l.lst.items)
+    l.append('!')
+    assert l.lst.size == 4
+    assert [pyffi.ffi.string(p) for p in old[0:2]] == ['hello', 'world']
+
 def test_iter(pyffi):
     LT = ListType(pyffi, 'long')
     l = LT(range(5))
@@ -62,3 +62,17 @@ def test_recursive_lock():
     lock.release()
     lock.release()
     
+
+def test_free_mutex():
+    import gc
+    lock = ShmLock()
+    stats = sharedmem.rw_stats()
+    del lock
+    gc.collect()
+    stats2 = sharedmem.rw_stats()
+    assert stats2['allocations'] == stats['allocations'] - 1
+    for i in range(10):
+        lock = ShmLock()
+        del lock
+    # the mutexes reuse the same block
+    assert sharedmem.rw_stats() == stats2
@@ -0,0 +1,153 @@
+import time
+import py
+import cffi
+from shm.sharedmem import sharedmem
+from shm.seqlock import ShmSeqLock
+from shm.pyffi import PyFFI
+from shm.dict import DictType
+from shm.list import ListType, ResizableList
+from shm.testing.util import SubProcess
+
+PATH = '/cffi-shm-testing'
+sharedmem.init(PATH)
+
+def test_sequence():
+    lock = ShmSeqLock()
+    assert lock.sequence == 0
+    start = lock.rd_begin()
+    assert not lock.rd_retry(start)
+    with lock:
+        assert lock.sequence == 1
+        assert lock.rd_retry(start)
+    assert lock.sequence == 2
+    assert lock.rd_retry(start)
+    assert not lock.rd_retry(lock.rd_begin())
+
+def test_read_retry():
+    lock = ShmSeqLock()
+    calls = []
+    def fn(x):
+        calls.append(x)
+        if len(calls) == 1:
+            # simulate a concurrent write
+            lock.wr_acquire()
+            lock.wr_release()
+        return x*2
+    assert lock.read(fn, 21) == 42
+    assert calls == [21, 21]
+    #
+    def fail():
+        calls.append(None)
+        if len(calls) == 3:
+            lock.wr_acquire()
+            lock.wr_release()
+            raise IndexError
+        raise KeyError
+    py.test.raises(KeyError, lock.read, fail)
+    assert len(calls) == 4
+
+def test_from_pointer():
+    ffi = cffi.FFI()
+    lock = ShmSeqLock()
+    lock2 = ShmSeqLock.from_pointer(int(ffi.cast('long', lock.as_cdata())))
+    with lock:
+        assert lock2.sequence == 1
+
+@py.test.mark.parametrize('engine', ['chain', 'open'])
+def test_concurrent_reader(tmpdir, engine):
+    def child(path, engine, lock_addr, arr_addr, d_addr, sd_addr):
+        import time
+        import cffi
+        from shm.sharedmem import sharedmem
+        from shm.seqlock import ShmSeqLock
+        from shm.pyffi import PyFFI
+        from shm.dict import DictType
+        #
+        sharedmem.open_readonly(path)
+        ffi = cffi.FFI()
+        lock = ShmSeqLock.from_pointer(lock_addr)
+        arr = ffi.cast('long*', arr_addr)
+        DT = DictType(PyFFI(ffi), 'long', 'long', engine=engine)
+        d = DT.from_pointer(d_addr)
+        SDT = DictType(PyFFI(ffi), 'const char*', 'long', engine=engine)
+        sd = SDT.from_pointer(sd_addr)
+        keys = ['key%d' % i for i in range(8)]
+        end = time.time() + 0.5
+        while time.time() < end:
+            a, b = lock.read(lambda: (arr[0], arr[1]))
+            assert a == b
+            assert d.optimistic_read(d.__getitem__, -1) == 42
+            # the keys are being deleted: the reader must never follow the
+            # pointers of a freed entry or key
+            for i in range(100):
+                found = sd.optimistic_read(sd.contains_many, keys)
+                assert len(found) == 8
+
+    ffi = cffi.FFI()
+    lock = ShmSeqLock()
+    arr = sharedmem.new_array(ffi, 'long', 2)
+    d = DictType(PyFFI(ffi), 'long', 'long', engine=engine)()
+    d[-1] = 42
+    sd = DictType(PyFFI(ffi), 'const char*', 'long', engine=engine)()
+    keys = ['key%d' % i for i in range(8)]
+    addrs = [int(ffi.cast('long', p))
+             for p in (lock.as_cdata(), arr, d.as_cdata(), sd.as_cdata())]
+    with SubProcess() as p:
+        for k in range(3):
+            p.background(tmpdir, child, PATH, engine, *addrs)
+        end = time.time() + 0.7
+        i = 0
+        while time.time() < end:
+            with lock:
+                arr[0] = i
+                arr[1] = i
+            # grow and shrink the dict, to rehash it
+            d[i % 1000] = i + 1
+            if i % 1000 == 999:
+                for j in range(1000):
+                    del d[j]
+            for j in range(10):
+                for key in keys:
+                    sd[key] = i + 1
+                for key in keys:
+                    del sd[key]
+            i += 1
+
+def test_concurrent_list_reader(tmpdir):
+    def child(path, slot_addr):
+        import time
+        import cffi
+        from shm.sharedmem import sharedmem
+        from shm.pyffi import PyFFI
+        from shm.list import ListType, ResizableList
+        #
+        sharedmem.open_readonly(path)
+        ffi = cffi.FFI()
+        LT = ListType(PyFFI(ffi), 'const char*', ResizableList)
+        slot = ffi.cast('void**', slot_addr)
+        end = time.time() + 0.5
+        while time.time() < end:
+            lst = LT.from_pointer(slot[0])
+            # the list is growing: the reader must never read the items of
+            # a freed array
+            items = lst.optimistic_read(list, lst)
+            assert items == ['item%d' % i for i in range(len(items))]
+
+    ffi = cffi.FFI()
+    LT = ListType(PyFFI(ffi), 'const char*', ResizableList)
+    slot = sharedmem.new_array(ffi, 'void*', 1)
+    lists = [LT()]
+    slot[0] = lists[-1].as_cdata()
+    with SubProcess() as p:
+        for k in range(3):
+            p.background(tmpdir, child, PATH,
+                         int(ffi.cast('long', slot)))
+        end = time.time() + 0.7
+        while time.time() < end:
+            # the readers may still be using the previous lists: keep them
+            # alive
+            lst = LT()
+            lists.append(lst)
+            slot[0] = lst.as_cdata()
+            for i in range(64):
+                lst.append('item%d' % i)
@@ -57,3 +57,13 @@ def test_init(pyffi):
     s = ST(['foo', 'bar'])
     assert len(s) == 2
     assert sorted(list(s)) == ['bar', 'foo']
+
+def test_expected_size(pyffi):
+    ST = pyffi.set('long', expected_size=100)
+    s = ST()
+    assert s.d.dictype.htlib.num_rehashes(s.d.ht) == 1
+    s = pyffi.set('long')(range(1000))
+    assert s.d.dictype.htlib.num_rehashes(s.d.ht) == 1
+    s.reserve(10000)
+    assert s.d.dictype.htlib.num_rehashes(s.d.ht) == 2
+    assert sorted(s) == range(1000)
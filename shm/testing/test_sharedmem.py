@@ -1,4 +1,5 @@
 import py
+import cffi
 from shm.sharedmem import Uninitialized_shm, RW_shm, RO_shm
 
 class MyGclib(object):
@@ -33,3 +34,17 @@ def test_open_readonly():
     my_sharedmem.open_readonly('/foo') # does not crash
     py.test.raises(ValueError, "my_sharedmem.init('/foo')")
     py.test.raises(ValueError, "my_sharedmem.open_readonly('/bar')")
+
+def test_scratch():
+    my_sharedmem = MySharedMemory()
+    my_sharedmem.open_readonly('/foo')
+    ffi = cffi.FFI()
+    s0 = my_sharedmem.new_string('unscoped')
+    with my_sharedmem.scratch() as outer:
+        s1 = my_sharedmem.new_string('hello')
+        with my_sharedmem.scratch() as inner:
+            p = my_sharedmem.new(ffi, 'long*')
+        a = my_sharedmem.new_array(ffi, 'long', 3)
+    assert outer.ptrs == [s1, a]
+    assert inner.ptrs == [p]
+    assert my_sharedmem._scratch.frames == []
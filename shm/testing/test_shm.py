@@ -178,6 +178,8 @@ def test_dict(tmpdir):
         assert d['hello'] == 1
         assert d['world'] == 2
         assert sorted(d.keys()) == ['hello', 'world']
+        assert d.version == 2
+        assert list(d.get_many(['world', 'foo', 'hello'], 0)) == [2, 0, 1]
 
     ffi = cffi.FFI()
     pyffi = PyFFI(ffi)
@@ -189,6 +191,37 @@ def test_dict(tmpdir):
     assert exec_child(tmpdir, child, PATH, dict_addr)
 
 
+def test_dict_rehashing(tmpdir):
+    def child(path, dict_addr, n):
+        import cffi
+        from shm.sharedmem import sharedmem
+        from shm.pyffi import PyFFI
+        from shm.dict import DictType
+        from shm.libcfu import cfuhash
+        #
+        pyffi = PyFFI(cffi.FFI())
+        DT = DictType(pyffi, 'long', 'long')
+        sharedmem.open_readonly(path)
+        d = DT.from_pointer(dict_addr)
+        assert cfuhash.is_rehashing(d.ht)
+        for i in range(n):
+            assert d[i] == i
+        assert n not in d
+        assert sorted(d.keys()) == range(n)
+
+    from shm.libcfu import cfuhash
+    ffi = cffi.FFI()
+    pyffi = PyFFI(ffi)
+    DT = DictType(pyffi, 'long', 'long')
+    d = DT()
+    n = 0
+    while not cfuhash.is_rehashing(d.ht) or n < 1000:
+        d[n] = n
+        n += 1
+    dict_addr = int(ffi.cast('long', d.ht))
+    assert exec_child(tmpdir, child, PATH, dict_addr, n)
+
+
 def test_dict_complex_key(tmpdir):
     def child(path, dict_addr):
         import cffi
@@ -209,6 +242,13 @@ def test_dict_complex_key(tmpdir):
         d = PersonDict.from_pointer(dict_addr)
         assert d[Person('Hello', 'World')] == 1
         assert d[Person('Foo', 'Bar')] == 2
+        #
+        # the strings are kept alive by the struct, and by nothing else
+        p = Person('Foo', 'Bar')
+        assert len(p._root) == 3
+        for i in range(1000):
+            assert Person('Foo', 'Bar') in d
+        assert sharedmem._scratch.frames == []
 
     ffi = cffi.FFI()
     pyffi = PyFFI(ffi)
@@ -225,3 +265,72 @@ def test_dict_complex_key(tmpdir):
     d[Person('Foo', 'Bar')] = 2
     dict_addr = int(ffi.cast('long', d.ht))
     assert exec_child(tmpdir, child, PATH, dict_addr)
+
+
+def test_dict_compiled_key(tmpdir):
+    # the child does not compile the hash functions of the key type: it
+    # interprets the fieldspec, and finds the same entries
+    def child(path, dict_addr):
+        import cffi
+        from shm.sharedmem import sharedmem
+        from shm.pyffi import PyFFI
+        #
+        sharedmem.open_readonly(path)
+        ffi = cffi.FFI()
+        pyffi = PyFFI(ffi)
+        ffi.cdef("""
+            typedef struct {
+                const char* name;
+                long age;
+            } Person;
+        """)
+        Person = pyffi.struct('Person')
+        assert Person.__fieldspec__.type_id == 0
+        PersonDict = pyffi.dict('Person*', 'long')
+        d = PersonDict.from_pointer(dict_addr)
+        for i in range(100):
+            assert d[Person(str(i), i)] == i
+        assert Person('0', 1) not in d
+
+    ffi = cffi.FFI()
+    pyffi = PyFFI(ffi)
+    ffi.cdef("""
+        typedef struct {
+            const char* name;
+            long age;
+        } Person;
+    """)
+    Person = pyffi.struct('Person', compiled_hash=True)
+    PersonDict = pyffi.dict('Person*', 'long')
+    d = PersonDict()
+    for i in range(100):
+        d[Person(str(i), i)] = i
+    dict_addr = int(ffi.cast('long', d.ht))
+    assert exec_child(tmpdir, child, PATH, dict_addr)
+
+
+def test_open_readonly_options(tmpdir):
+    def child(path, list_addr):
+        import cffi
+        from shm.sharedmem import sharedmem
+        from shm.pyffi import PyFFI
+        #
+        pyffi = PyFFI(cffi.FFI())
+        sharedmem.open_readonly(path, willneed=True, hugepages=True,
+                                prefetch=[list_addr])
+        stats = sharedmem.stats()
+        assert stats['attach_time'] > 0
+        assert stats['attach_willneed_size'] > 0
+        # the List struct and its items
+        assert stats['attach_prefetch_size'] >= 1000*8
+        LT = pyffi.list('long')
+        lst = LT.from_pointer(list_addr)
+        assert list(lst) == range(1000)
+
+    ffi = cffi.FFI()
+    pyffi = PyFFI(ffi)
+    LT = ListType(pyffi, 'long')
+    lst = LT(range(1000))
+    list_addr = int(ffi.cast('long', lst.lst))
+    sharedmem.publish_extents()
+    assert exec_child(tmpdir, child, PATH, list_addr)